@@ -0,0 +1,63 @@
+"""
+Time loading users and groups with the Adobe console connector, against a mocked UMAPI connection serving
+synthetic users a page at a time.  With --memory, the peak memory allocated during the load is measured
+instead (tracing allocations slows the load down, so the time isn't meaningful then).
+"""
+import argparse
+import time
+import tracemalloc
+
+import mock
+
+import user_sync.config.user_sync  # noqa: F401
+from user_sync.connector.directory_adobe_console import AdobeConsoleConnector
+
+
+def create_connector(user_count, group_count, groups_per_user, page_size):
+    def umapi_user(u):
+        return {'email': 'user{}@example.com'.format(u), 'username': 'user{}@example.com'.format(u),
+                'domain': 'example.com', 'type': 'federatedID', 'country': 'US', 'firstname': 'User',
+                'lastname': str(u), 'groups': ['Group {}'.format((u + g) % group_count)
+                                               for g in range(groups_per_user)]}
+
+    def query_multiple(object_type, page, url_params, query_params):
+        users = [umapi_user(u) for u in range(page * page_size, min((page + 1) * page_size, user_count))]
+        last_page = (page + 1) * page_size >= user_count
+        return users, last_page, user_count, -(-user_count // page_size), page + 1, page_size
+
+    with mock.patch('user_sync.connector.directory_adobe_console.create_umapi_auth'), \
+            mock.patch('umapi_client.Connection'):
+        connector = AdobeConsoleConnector({'authentication_method': 'oauth', 'integration': {'org_id': 'org'}})
+    connector.connection.query_multiple.side_effect = query_multiple
+    return connector
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--groups', type=int, default=200)
+    parser.add_argument('--groups-per-user', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=200)
+    parser.add_argument('--memory', action='store_true')
+    args = parser.parse_args()
+
+    connector = create_connector(args.users, args.groups, args.groups_per_user, args.page_size)
+    groups = ['Group {}'.format(g) for g in range(args.groups)]
+    with mock.patch('umapi_client.GroupsQuery', return_value=[{'groupName': g} for g in groups]):
+        if args.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        users = connector.load_users_and_groups(groups, [], False)
+        elapsed = time.perf_counter() - start
+        if args.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    print('users: {}, groups: {}'.format(len(users), len(groups)))
+    if args.memory:
+        print('peak memory: {:.0f} MB'.format(peak / 1e6))
+    else:
+        print('load time: {:.2f}s'.format(elapsed))
+
+
+if __name__ == '__main__':
+    main()
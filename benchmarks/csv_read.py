@@ -0,0 +1,45 @@
+"""
+Time reading the recognized columns of a large CSV file with CSVAdapter.read_csv_rows: with DictReader (the
+default), with the column index (only_recognized_columns) and with the column index over a memory-mapped file.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import user_sync.config.user_sync  # noqa: F401
+from user_sync.helper import CSVAdapter
+
+COLUMNS = ['email', 'firstname', 'lastname', 'country', 'groups', 'type', 'username', 'domain']
+
+
+def write_file(file_path, row_count, column_count):
+    header = COLUMNS + ['extra{}'.format(i) for i in range(column_count - len(COLUMNS))]
+    with open(file_path, 'w', encoding='utf8') as f:
+        f.write(','.join(header) + '\n')
+        for r in range(row_count):
+            values = ['user{}@example.com'.format(r), 'User', str(r), 'US', '"Group A,Group B"', 'federatedID',
+                      '', 'example.com']
+            values.extend('value{}'.format(i) for i in range(column_count - len(COLUMNS)))
+            f.write(','.join(values) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--columns', type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'users.csv')
+        write_file(file_path, args.rows, args.columns)
+        for name, options in (('DictReader', {}),
+                              ('column index', {'only_recognized_columns': True}),
+                              ('column index with mmap', {'only_recognized_columns': True, 'memory_map': True})):
+            start = time.perf_counter()
+            count = sum(1 for _ in CSVAdapter.read_csv_rows(file_path, COLUMNS, **options))
+            print('{}: {:.2f}s for {} rows'.format(name, time.perf_counter() - start, count))
+
+
+if __name__ == '__main__':
+    main()
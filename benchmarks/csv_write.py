@@ -0,0 +1,33 @@
+"""
+Time writing an Adobe-only user list with CSVAdapter.write_csv_rows, rows coming from a generator as
+write_stray_key_map makes them, both plain and gzip-compressed.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import user_sync.config.user_sync  # noqa: F401
+from user_sync.helper import CSVAdapter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=500000)
+    args = parser.parse_args()
+
+    def rows():
+        for r in range(args.rows):
+            yield {'type': 'federatedID', 'email': 'user{}@example.com'.format(r), 'domain': 'example.com'}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for file_name in ('strays.csv', 'strays.csv.gz'):
+            file_path = os.path.join(temp_dir, file_name)
+            start = time.perf_counter()
+            CSVAdapter.write_csv_rows(file_path, ['type', 'email', 'domain'], rows())
+            print('{}: {:.2f}s for {} rows ({} bytes)'.format(file_name, time.perf_counter() - start, args.rows,
+                                                             os.path.getsize(file_path)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Count the LDAP searches and the entries fetched with their attributes when all users are loaded, against
+ldap3's in-process mock server.  Each user should be fetched once, however many groups are mapped.
+"""
+import argparse
+import time
+
+import ldap3
+import mock
+
+import user_sync.config.user_sync  # noqa: F401
+from user_sync.connector.directory_ldap import LDAPDirectoryConnector
+
+BASE_DN = 'dc=example,dc=com'
+
+
+def create_connector(user_count, group_count):
+    def create_connection(server, **kwargs):
+        connection = Connection(server, client_strategy=ldap3.MOCK_SYNC)
+        for g in range(group_count):
+            connection.strategy.add_entry('cn=Group {},ou=groups,{}'.format(g, BASE_DN), {
+                'objectClass': 'groupOfNames', 'cn': 'Group {}'.format(g)})
+        for u in range(user_count):
+            connection.strategy.add_entry('cn=user{},ou=users,{}'.format(u, BASE_DN), {
+                'objectClass': 'person', 'cn': 'user{}'.format(u), 'mail': 'user{}@example.com'.format(u),
+                'givenName': 'User', 'sn': str(u),
+                'memberOf': ['cn=Group {},ou=groups,{}'.format(u % group_count, BASE_DN)]})
+        connection.bind()
+        return connection
+
+    Connection = ldap3.Connection
+    with mock.patch('ldap3.Connection', side_effect=create_connection):
+        return LDAPDirectoryConnector({
+            'host': 'ldap://ldap.example.com',
+            'base_dn': BASE_DN,
+            'all_users_filter': '(objectClass=person)',
+            'group_filter_format': '(&(objectClass=groupOfNames)(cn={group}))',
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=20)
+    args = parser.parse_args()
+
+    connector = create_connector(args.users, args.groups)
+    search = connector.iter_search_result
+    fetched = []
+
+    def iter_search_result(*search_args, **kwargs):
+        for dn, record in search(*search_args, **kwargs):
+            if record:
+                fetched.append(dn)
+            yield dn, record
+
+    groups = ['Group {}'.format(g) for g in range(args.groups)]
+    with mock.patch.object(connector, 'iter_search_result', side_effect=iter_search_result) as searches:
+        start = time.perf_counter()
+        users = list(connector.load_users_and_groups(groups, [], True))
+        elapsed = time.perf_counter() - start
+    print('users: {}, groups: {}'.format(len(users), len(groups)))
+    print('searches: {}'.format(searches.call_count))
+    print('entries fetched with attributes: {} (groups and users: {})'.format(len(fetched),
+                                                                           len(groups) + args.users))
+    print('load time: {:.2f}s'.format(elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -69,6 +69,7 @@ setup(name='user-sync',
               'winkerberos',
               'pywin32'
           ],
+          'parquet': ['pyarrow'],
           'test': test_deps,
           'setup': setup_deps,
       },
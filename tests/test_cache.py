@@ -1,7 +1,11 @@
+import json
 from pathlib import Path
 from datetime import datetime, timedelta
 from user_sync.cache.base import CacheBase
+from user_sync.cache.fingerprint import FingerprintCache
+from user_sync.cache.ldap import LDAPGroupCache, LDAPSnapshotCache
 from user_sync.cache.sign import SignCache
+from user_sync.cache.umapi import UmapiCache
 from sign_client.model import DetailedUserInfo, GroupInfo, UserGroupInfo, SettingsInfo
 
 
@@ -210,3 +214,91 @@ def test_table_rebuild(tmp_path):
     cache = SignCache(store_path, 'primary')
     assert cache.should_refresh
     assert cache.get_version() == SignCache.VERSION
+
+def test_umapi_db_file(tmp_path):
+    """Ensure creation of umapi cache files, with metadata kept per org"""
+    store_path: Path = tmp_path / 'cache' / 'umapi'
+    UmapiCache(store_path, 'org1')
+    cache = UmapiCache(store_path, 'org2', refresh_interval=60)
+    assert (store_path / "org1.db").exists()
+    assert (store_path / "org1-meta.db").exists()
+    assert (store_path / "org2-meta.db").exists()
+    assert cache.should_refresh
+    assert cache.refresh_interval == 60
+
+def test_umapi_cache_user(tmp_path):
+    """Insert a umapi user to cache and look it up by email and username"""
+    store_path: Path = tmp_path / 'cache' / 'umapi'
+    cache = UmapiCache(store_path, 'org')
+    cache.cache_user({'email': 'User@example.com', 'username': 'user', 'domain': 'example.com', 'groups': ['Group A']})
+    assert list(cache.get_users())[0]['groups'] == ['Group A']
+    assert cache.get_user('user@example.com')['username'] == 'user'
+    assert cache.get_user('USER', 'example.com')['email'] == 'User@example.com'
+    assert cache.get_user('user', 'example.org') is None
+
+def test_umapi_cache_update_delete(tmp_path):
+    """Update the email of a cached umapi user, then delete it"""
+    store_path: Path = tmp_path / 'cache' / 'umapi'
+    cache = UmapiCache(store_path, 'org')
+    user = {'email': 'user@example.com', 'username': 'jdoe', 'domain': 'example.com'}
+    cache.cache_user(user)
+    user['email'] = 'user@example.org'
+    cache.update_user('user@example.com', user)
+    assert cache.get_user('user@example.com') is None
+    assert cache.get_user('user@example.org') is not None
+    cache.delete_user('user@example.org')
+    assert list(cache.get_users()) == []
+
+def test_fingerprint_cache(tmp_path):
+    """Save fingerprints, then replace them"""
+    store_path: Path = tmp_path / 'cache' / 'fingerprint'
+    cache = FingerprintCache(store_path, refresh_interval=60)
+    assert (store_path / "fingerprint.db").exists()
+    assert (store_path / "fingerprint-meta.db").exists()
+    assert cache.should_refresh
+    assert cache.get_fingerprints() == {}
+    cache.save_fingerprints({'key1': 'abc', 'key2': 'def'})
+    cache.save_fingerprints({'key1': 'ghi'})
+    assert FingerprintCache(store_path).get_fingerprints() == {'key1': 'ghi'}
+    cache.set_state({'options': 'abc'})
+    assert FingerprintCache(store_path).get_state() == {'options': 'abc'}
+
+
+def test_ldap_group_cache(tmp_path):
+    """Cache group DNs, then clear them"""
+    store_path: Path = tmp_path / 'cache' / 'ldap'
+    cache = LDAPGroupCache(store_path, refresh_interval=60)
+    assert (store_path / "ldap-groups.db").exists()
+    assert cache.should_refresh
+    cache.cache_group_dns({'Group A': 'cn=Group A,dc=example,dc=com', 'Group B': 'cn=B,dc=example,dc=com'})
+    cache.cache_group_dns({'Group B': 'cn=Group B,dc=example,dc=com'})
+    assert LDAPGroupCache(store_path).get_group_dns() == {'Group A': 'cn=Group A,dc=example,dc=com',
+                                                          'Group B': 'cn=Group B,dc=example,dc=com'}
+    cache.set_state({'signature': '[]'})
+    assert LDAPGroupCache(store_path).get_state() == {'signature': '[]'}
+    cache.clear_all()
+    assert cache.get_group_dns() == {}
+    assert cache.get_state() == {}
+
+
+def test_ldap_snapshot_cache(tmp_path):
+    """Save snapshot entries and state, then update them"""
+    store_path: Path = tmp_path / 'cache' / 'ldap'
+    cache = LDAPSnapshotCache(store_path)
+    assert (store_path / "ldap-snapshot.db").exists()
+    assert cache.should_refresh
+    cache.update_records({'cn=a': {'mail': ['a@example.com']}, 'cn=b': {'mail': ['b@example.com']}})
+    cache.set_state({'high_water_mark': '10'})
+    cache.update_records({'cn=c': {'mail': ['c@example.com'], 'objectGUID': [b'\x00\xff'], 'uSNChanged': 12}},
+                         ['cn=a', 'cn=c'])
+    cache = LDAPSnapshotCache(store_path)
+    assert cache.get_records() == {'cn=b': {'mail': ['b@example.com']},
+                                   'cn=c': {'mail': ['c@example.com'], 'objectGUID': [b'\x00\xff'], 'uSNChanged': 12}}
+    assert cache.get_records()['cn=b']['MAIL'] == ['b@example.com']
+    # records are kept as JSON, so reading the cache can't run code
+    record, = cache.db_conn.execute("select record from entries where dn = 'cn=b'").fetchone()
+    assert json.loads(record) == {'mail': ['b@example.com']}
+    assert cache.get_state() == {'high_water_mark': '10'}
+    cache.clear_all()
+    assert cache.get_records() == {}
+    assert cache.get_state() == {}
@@ -0,0 +1,57 @@
+import mock
+import pytest
+
+import user_sync.config.user_sync  # noqa: F401
+from user_sync.connector.directory_adobe_console import AdobeConsoleConnector
+
+
+def umapi_user(u, groups):
+    return {'email': 'user{}@example.com'.format(u), 'username': 'user{}@example.com'.format(u),
+            'domain': 'example.com', 'type': 'federatedID' if u % 2 else 'adobeID', 'country': 'US',
+            'firstname': 'User', 'lastname': str(u), 'groups': groups}
+
+
+UMAPI_USERS = [
+    umapi_user(0, ['Group A', 'group a', 'Group B']),
+    umapi_user(1, ['Group B']),
+    umapi_user(2, []),
+    umapi_user(3, ['GROUP A', 'Group C']),
+]
+
+
+@pytest.fixture
+def console_connector():
+    with mock.patch('user_sync.connector.directory_adobe_console.create_umapi_auth'), \
+            mock.patch('umapi_client.Connection'):
+        connector = AdobeConsoleConnector({'authentication_method': 'oauth', 'integration': {'org_id': 'org'}})
+
+    def query_multiple(object_type, page, url_params, query_params):
+        assert object_type == 'user'
+        users = UMAPI_USERS[page * 3:page * 3 + 3]
+        return users, page * 3 + 3 >= len(UMAPI_USERS), len(UMAPI_USERS), 2, page + 1, 3
+    connector.connection.query_multiple.side_effect = query_multiple
+    with mock.patch('umapi_client.GroupsQuery') as groups_query:
+        groups_query.return_value = [{'groupName': g} for g in ['Group A', 'Group B', 'Group C']]
+        yield connector
+
+
+def test_load_users_and_groups(console_connector):
+    users = console_connector.load_users_and_groups(['group a', 'Group B', 'Missing'], [], False)
+    users = {u['email']: u for u in users}
+    assert sorted(users) == ['user0@example.com', 'user1@example.com', 'user3@example.com']
+    assert users['user0@example.com']['groups'] == ['group a', 'Group B']
+    assert users['user3@example.com']['groups'] == ['group a']
+    assert list(console_connector.iter_group_members('GROUP B')) == [
+        'adobeid,user0@example.com,example.com', 'federatedid,user1@example.com,example.com']
+    assert sorted(console_connector.user_keys_by_group) == ['group a', 'group b', 'group c']
+    assert len(console_connector.load_users_and_groups(['Group C'], [], True)) == 4
+    # the users are read in two pages, and only kept once converted
+    assert console_connector.connection.query_multiple.call_count == 4
+    assert not hasattr(console_connector, 'umapi_users')
+
+
+def test_identity_type_filter(console_connector):
+    console_connector.filter_by_identity_type = 'federatedID'
+    users = console_connector.load_users_and_groups(['Group A'], [], True)
+    assert sorted(u['email'] for u in users) == ['user1@example.com', 'user3@example.com']
+    assert list(console_connector.iter_group_members('Group A')) == ['federatedid,user3@example.com,example.com']
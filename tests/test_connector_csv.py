@@ -0,0 +1,138 @@
+import csv
+import functools
+import json
+
+import mock
+import pytest
+
+import user_sync.config.user_sync  # noqa: F401
+from user_sync.connector.directory_csv import CSVDirectoryConnector
+from user_sync.error import AssertionException
+from user_sync.helper import CSVAdapter, ExternalSorter
+
+ROWS = [
+    'email,firstname,lastname,country,groups,type,username,domain,department',
+    'user2@example.com,User,Two,us,Group A,,,,Sales',
+    'user1@example.com,User,One,gb,Group A,federatedID,,,',
+    'invalid,Invalid,User,us,Group A,,,,',
+    'user2@example.com,,,,Group B,,,,Marketing',
+    'user3@example.com,User,Three,us,Group B,badType,,,',
+    'user1@example.com,,,,"Group B,Group C",,user1,,',
+    'user3@example.com,User,Three,us,Group C,,,,',
+]
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    def _csv_file(rows):
+        path = tmp_path / 'users.csv'
+        path.write_text('\n'.join(rows) + '\n')
+        return str(path)
+    return _csv_file
+
+
+def load_users(file_path, **options):
+    options.update(file_path=file_path)
+    connector = CSVDirectoryConnector(options)
+    return {u['email']: u for u in connector.load_users_and_groups([], ['department'], True)}
+
+
+@pytest.mark.parametrize('memory_map', [False, True])
+def test_load_users_and_groups(csv_file, memory_map):
+    users = load_users(csv_file(ROWS), memory_map=memory_map)
+    assert sorted(users) == ['user1@example.com', 'user2@example.com', 'user3@example.com']
+    assert users['user1@example.com']['groups'] == ['Group A', 'Group B', 'Group C']
+    assert users['user1@example.com']['username'] == 'user1'
+    assert users['user1@example.com']['domain'] == 'example.com'
+    assert users['user2@example.com']['firstname'] == 'User'
+    assert users['user2@example.com']['country'] == 'US'
+    assert users['user2@example.com']['source_attributes']['department'] == 'Marketing'
+    # the row with a bad identity type drops the user, and the next row starts again
+    assert users['user3@example.com']['groups'] == ['Group C']
+
+
+@pytest.mark.parametrize('streaming_mode', ['sorted', 'sort'])
+def test_streaming_mode(csv_file, streaming_mode):
+    expected = load_users(csv_file(ROWS))
+    rows = ROWS if streaming_mode == 'sort' else ROWS[:1] + sorted(ROWS[1:], key=lambda r: r.split(',')[0])
+    file_path = csv_file(rows)
+    sorter = functools.partial(ExternalSorter, run_size=2)
+    with mock.patch('user_sync.connector.directory_csv.ExternalSorter', side_effect=sorter) as external_sorter:
+        connector = CSVDirectoryConnector({'file_path': file_path, 'streaming_mode': streaming_mode})
+        users = connector.load_users_and_groups([], ['department'], True)
+        assert not isinstance(users, (list, dict))
+        assert {u['email']: u for u in users} == expected
+    assert external_sorter.call_count == (1 if streaming_mode == 'sort' else 0)
+
+
+def test_single_row_streaming_mode(csv_file):
+    rows = ROWS[:1] + [row for row in ROWS[1:] if 'Group A' in row]
+    users = load_users(csv_file(rows), streaming_mode='single_row')
+    assert users == load_users(csv_file(rows))
+    with pytest.raises(AssertionException):
+        load_users(csv_file(rows), streaming_mode='unsorted')
+
+
+@pytest.mark.parametrize('memory_map', [False, True])
+def test_read_csv_rows(csv_file, memory_map):
+    file_path = csv_file(['email,ignored,firstname,email', 'a@example.com,x,"Multi\nLine",b@example.com',
+                          '', 'c@example.com,y', 'd@example.com,z,Ünïcode,e@example.com,extra'])
+    columns = ['email', 'firstname', 'lastname']
+    expected = [{k: v for k, v in row.items() if k in columns}
+                for row in CSVAdapter.read_csv_rows(file_path, columns)]
+    rows = list(CSVAdapter.read_csv_rows(file_path, columns, only_recognized_columns=True, memory_map=memory_map))
+    assert rows == expected
+    assert rows[0] == {'email': 'b@example.com', 'firstname': 'Multi\nLine'}
+    assert rows[1] == {'email': None, 'firstname': None}
+    assert rows[2]['firstname'] == 'Ünïcode'
+    assert list(CSVAdapter.read_csv_rows(csv_file(['']), columns, only_recognized_columns=True,
+                                         memory_map=memory_map)) == []
+
+
+def csv_records(rows):
+    """The rows as records, leaving out empty values and with the groups as lists"""
+    records = []
+    for row in csv.DictReader(rows):
+        record = {k: v for k, v in row.items() if v}
+        if 'groups' in record:
+            record['groups'] = record['groups'].split(',')
+        records.append(record)
+    return records
+
+
+def test_jsonl_input(csv_file, tmp_path):
+    expected = load_users(csv_file(ROWS))
+    file_path = tmp_path / 'users.jsonl'
+    file_path.write_text('\n'.join(json.dumps(r) for r in csv_records(ROWS)) + '\n\n')
+    assert load_users(str(file_path)) == expected
+    file_path.write_text('{"email": "user@example.com"}\n[1, 2]\n')
+    with pytest.raises(AssertionException):
+        load_users(str(file_path))
+
+
+def test_parquet_input(csv_file, tmp_path):
+    file_path = str(tmp_path / 'users.parquet')
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        with pytest.raises(AssertionException):
+            load_users(file_path)
+        return
+    expected = load_users(csv_file(ROWS))
+    records = csv_records(ROWS)
+    columns = {name: [r.get(name) for r in records] for name in ROWS[0].split(',')}
+    columns['unused'] = list(range(len(records)))
+    pyarrow.parquet.write_table(pyarrow.table(columns), file_path)
+    assert load_users(file_path) == expected
+
+
+def test_write_csv_rows(tmp_path):
+    file_path = str(tmp_path / 'users.csv')
+    rows = ({'email': 'user{}@example.com'.format(u), 'firstname': 'User'} for u in range(3))
+    CSVAdapter.write_csv_rows(file_path, ['email', 'firstname', 'lastname'], rows)
+    assert list(CSVAdapter.read_csv_rows(file_path, ['email', 'firstname', 'lastname'])) == [
+        {'email': 'user{}@example.com'.format(u), 'firstname': 'User', 'lastname': ''} for u in range(3)]
+    # fields that have no column are an error, rather than being left out
+    with pytest.raises(ValueError):
+        CSVAdapter.write_csv_rows(file_path, ['email'], [{'email': 'user@example.com', 'firstname': 'User'}])
@@ -0,0 +1,295 @@
+import threading
+import time
+
+import ldap3
+import mock
+import pytest
+
+import user_sync.config.user_sync  # noqa: F401
+from user_sync.connector.directory_ldap import LDAPDirectoryConnector, LDAPValueFormatter
+from user_sync.error import AssertionException
+
+BASE_DN = 'dc=example,dc=com'
+Connection = ldap3.Connection
+
+
+def populate(connection, group_count=5, users_per_group=3):
+    for g in range(group_count):
+        connection.strategy.add_entry('cn=Group {},ou=groups,{}'.format(g, BASE_DN), {
+            'objectClass': 'groupOfNames', 'cn': 'Group {}'.format(g)})
+    for u in range(group_count * users_per_group):
+        group_dn = 'cn=Group {},ou=groups,{}'.format(u % group_count, BASE_DN)
+        connection.strategy.add_entry('cn=user{},ou=users,{}'.format(u, BASE_DN), {
+            'objectClass': 'person', 'cn': 'user{}'.format(u), 'mail': 'user{}@example.com'.format(u),
+            'givenName': 'User', 'sn': str(u), 'memberOf': [group_dn]})
+
+
+@pytest.fixture
+def ldap_connector():
+    def _ldap_connector(**options):
+        def create_connection(server, **kwargs):
+            calls.append((server, kwargs))
+            if isinstance(server, ldap3.ServerPool):
+                server = server.servers[0]
+            connection = Connection(server, client_strategy=ldap3.MOCK_SYNC)
+            if not connections:
+                populate(connection)
+            connection.bind()
+            connections.append(connection)
+            return connection
+
+        connections = []
+        calls = []
+        caller_options = {
+            'host': 'ldap://ldap.example.com',
+            'base_dn': BASE_DN,
+            'all_users_filter': '(objectClass=person)',
+            'group_filter_format': '(&(objectClass=groupOfNames)(cn={group}))',
+        }
+        caller_options.update(options)
+        with mock.patch('ldap3.Connection', side_effect=create_connection):
+            connector = LDAPDirectoryConnector(caller_options)
+        connector.connection_calls = calls
+        return connector
+    return _ldap_connector
+
+
+def test_connections_option(ldap_connector):
+    assert len(ldap_connector().pool) == 1
+    connector = ldap_connector(connections=4)
+    assert len(connector.pool) == 4
+    assert connector.connection is connector.pool.connections[0]
+    with pytest.raises(AssertionException):
+        ldap_connector(connections=0)
+
+
+def test_server_pool(ldap_connector):
+    connector = ldap_connector(host=['ldap://dc1.example.com', 'ldap://dc2.example.com'], pool_strategy='Round_Robin',
+                               timeout=10, reconnect_tries=3, connections=2)
+    assert len(connector.connection_calls) == 2
+    server, kwargs = connector.connection_calls[0]
+    assert isinstance(server, ldap3.ServerPool)
+    assert [s.host for s in server.servers] == ['dc1.example.com', 'dc2.example.com']
+    assert server.strategy == ldap3.ROUND_ROBIN
+    assert kwargs['client_strategy'] == ldap3.RESTARTABLE
+    assert kwargs['receive_timeout'] == 10
+    assert connector.connection.strategy.restartable_tries == 3
+    # a single host is connected to directly, as before
+    server, kwargs = ldap_connector().connection_calls[0]
+    assert isinstance(server, ldap3.Server)
+    assert 'client_strategy' not in kwargs
+    with pytest.raises(AssertionException):
+        ldap_connector(host=['ldap://dc1.example.com'], pool_strategy='fastest')
+
+
+def test_server_pool_unreachable():
+    """A pool of servers that are all down fails, rather than waiting for one of them to come up"""
+    errors = []
+
+    def connect():
+        try:
+            LDAPDirectoryConnector({'host': ['ldap://127.0.0.1:1', 'ldap://127.0.0.1:2'], 'base_dn': BASE_DN,
+                                    'timeout': 1, 'reconnect_tries': 1})
+        except Exception as e:
+            errors.append(e)
+
+    # the pool waits between its rounds of the servers
+    with mock.patch('ldap3.core.pooling.sleep') as sleep:
+        thread = threading.Thread(target=connect, daemon=True)
+        thread.start()
+        thread.join(10)
+    assert not thread.is_alive()
+    assert len(errors) == 1 and isinstance(errors[0], AssertionException)
+    assert sleep.call_count == 2
+
+
+@pytest.mark.parametrize('connections', [1, 3])
+def test_load_users_and_groups(ldap_connector, connections):
+    connector = ldap_connector(connections=connections)
+    groups = ['Group {}'.format(g) for g in range(5)] + ['Missing']
+    with mock.patch.object(connector, 'iter_search_result', wraps=connector.iter_search_result) as search:
+        users = {u['email']: u for u in connector.load_users_and_groups(groups, ['cn'], False)}
+    # one search to find all the groups, and one for the members of each group found
+    assert search.call_count == 6
+    if connections > 1:
+        assert {c[0][4] for c in search.call_args_list[1:]} <= set(connector.pool)
+    assert len(users) == 15
+    for u in range(15):
+        user = users['user{}@example.com'.format(u)]
+        assert user['groups'] == ['Group {}'.format(u % 5)]
+        assert user['lastname'] == str(u)
+        assert user['source_attributes']['cn'] == ['user{}'.format(u)]
+    assert set(connector.user_by_dn) == {'cn=user{},ou=users,{}'.format(u, BASE_DN) for u in range(15)}
+
+
+def test_single_pass_lookup(ldap_connector):
+    groups = ['Group 0', 'Group 3', 'Missing']
+    results = []
+    for single_pass in (False, True):
+        connector = ldap_connector(single_pass_lookup=single_pass)
+        connector.connection.strategy.add_entry('cn=ungrouped,ou=users,{}'.format(BASE_DN), {
+            'objectClass': 'person', 'cn': 'ungrouped', 'mail': 'ungrouped@example.com'})
+        with mock.patch.object(connector, 'iter_search_result', wraps=connector.iter_search_result) as search:
+            users = connector.load_users_and_groups(groups, [], True)
+            results.append({u['email']: sorted(u['groups']) for u in users})
+        if single_pass:
+            # one search for the groups and one for all the users, and none for the members of each group
+            assert search.call_count == 2
+    assert results[0] == results[1]
+    assert len(results[1]) == 16
+    assert results[1]['user3@example.com'] == ['Group 3']
+    assert results[1]['ungrouped@example.com'] == []
+    with pytest.raises(AssertionException):
+        ldap_connector(single_pass_lookup=True, group_member_filter_format='(isMemberOf={group_dn})')
+
+
+def test_find_ldap_group_dns(ldap_connector):
+    connector = ldap_connector(group_lookup_batch_size=2)
+    groups = ['Group 0', 'group 1', 'Group 2', 'Missing', 'Group 4']
+    with mock.patch.object(connector, 'iter_search_result', wraps=connector.iter_search_result) as search:
+        group_dns = connector.find_ldap_group_dns(groups)
+    assert search.call_count == 3
+    assert group_dns == {g: 'cn={},ou=groups,{}'.format(g.capitalize(), BASE_DN) for g in groups if g != 'Missing'}
+    # a group filter that can't be combined is run for each group
+    connector = ldap_connector(group_filter_format='(&(objectClass=groupOfNames)(|(cn={group})(name={group})))')
+    with mock.patch.object(connector, 'find_ldap_group_dn', wraps=connector.find_ldap_group_dn) as find_group:
+        assert connector.find_ldap_group_dns(groups) == group_dns
+    assert find_group.call_count == 5
+
+
+def test_group_cache(ldap_connector, tmp_path):
+    cache_options = {'path': str(tmp_path / 'cache' / 'ldap')}
+    groups = ['Group 0', 'Group 1']
+    connector = ldap_connector(cache=cache_options)
+    assert connector.resolve_group_dns(groups) == {g: 'cn={},ou=groups,{}'.format(g, BASE_DN) for g in groups}
+    connector = ldap_connector(cache=cache_options)
+    with mock.patch.object(connector, 'find_ldap_group_dns', wraps=connector.find_ldap_group_dns) as find_groups:
+        group_dns = connector.resolve_group_dns(groups + ['Group 2'])
+    # only the group that wasn't cached is looked up
+    find_groups.assert_called_once_with(['Group 2'])
+    assert list(group_dns) == ['Group 0', 'Group 1', 'Group 2']
+    # the cached DNs are dropped when the group search settings change
+    connector = ldap_connector(cache=cache_options, group_filter_format='(&(objectClass=groupOfNames)(name={group}))')
+    with mock.patch.object(connector, 'find_ldap_group_dns', return_value={}) as find_groups:
+        assert connector.resolve_group_dns(groups) == {}
+    find_groups.assert_called_once_with(groups)
+
+
+def test_all_users_read_once(ldap_connector):
+    """Each user's attributes are only fetched once, however many groups are mapped"""
+    connector = ldap_connector()
+    for u in range(15, 100):
+        connector.connection.strategy.add_entry('cn=user{},ou=users,{}'.format(u, BASE_DN), {
+            'objectClass': 'person', 'cn': 'user{}'.format(u), 'mail': 'user{}@example.com'.format(u)})
+    fetched = []
+
+    def iter_search_result(base_dn, scope, filter_string, attributes, connection=None):
+        for dn, record in search(base_dn, scope, filter_string, attributes, connection):
+            if record:
+                fetched.append(dn)
+            yield dn, record
+
+    search = connector.iter_search_result
+    groups = ['Group {}'.format(g) for g in range(5)]
+    with mock.patch.object(connector, 'iter_search_result', side_effect=iter_search_result) as searches:
+        users = list(connector.load_users_and_groups(groups, [], True))
+    # one search for the groups, one for all the users and one for the members of each group
+    assert searches.call_count == 7
+    # only the group names and the users are fetched with their attributes
+    assert len(fetched) == 5 + 100
+    assert len(users) == 100
+    assert sum(1 for u in users if u['groups']) == 15
+
+
+@pytest.mark.parametrize('string_format', [None, '{mail}', '{givenName} {sn}', '{idType}ID', 'federatedID', '{{mail}}',
+                                           '{sn!r}', '{sn:>5}'])
+def test_value_formatter(string_format):
+    """The compiled formatter gives the same results as the generic one"""
+    formatter = LDAPValueFormatter(string_format)
+    records = [{}, {'mail': 'user@example.com', 'givenName': ['User'], 'sn': ['One', 'Two'], 'idType': 'federated'},
+               {'mail': [], 'givenName': 'User', 'sn': ''}, {'mail': [None], 'sn': ['One']},
+               {'mail': [b'user@example.com']}]
+    for record in records:
+        assert formatter.generate_value(record) == LDAPValueFormatter.generate_value(formatter, record)
+
+
+@pytest.mark.parametrize('connections', [1, 3])
+def test_two_steps_lookup(ldap_connector, connections):
+    connector = ldap_connector(connections=connections,
+                               two_steps_lookup={'group_member_attribute_name': 'member', 'nested_group': True})
+    user_dn = 'cn=user{},ou=users,' + BASE_DN
+    connector.connection.strategy.add_entry('cn=Nested,ou=groups,{}'.format(BASE_DN), {
+        'objectClass': 'groupOfNames', 'cn': 'Nested', 'member': [user_dn.format(1), user_dn.format(2)]})
+    connector.connection.strategy.add_entry('cn=Parent,ou=groups,{}'.format(BASE_DN), {
+        'objectClass': 'groupOfNames', 'cn': 'Parent',
+        'member': ['cn=Nested,ou=groups,{}'.format(BASE_DN), user_dn.format(0), user_dn.format(1)]})
+    with mock.patch.object(connector, 'iter_search_result', wraps=connector.iter_search_result) as search:
+        users = {u['email']: u for u in connector.load_users_and_groups(['Parent', 'Nested'], [], False)}
+    assert {email: u['groups'] for email, u in users.items()} == {
+        'user0@example.com': ['Parent'],
+        'user1@example.com': ['Parent', 'Nested'],
+        'user2@example.com': ['Parent', 'Nested'],
+    }
+    # each member is only read once, although the members of the nested group are in both groups
+    member_searches = [c[0][0] for c in search.call_args_list[1:]]
+    assert sorted(member_searches) == sorted([user_dn.format(u) for u in range(3)] +
+                                             ['cn=Nested,ou=groups,{}'.format(BASE_DN)])
+    assert set(connector.member_dns_by_dn) == {'cn=Parent,ou=groups,{}'.format(BASE_DN),
+                                               'cn=Nested,ou=groups,{}'.format(BASE_DN)} | \
+        {user_dn.format(u) for u in range(3)}
+
+
+def test_incremental_lookup(ldap_connector, tmp_path):
+    connector = ldap_connector(incremental_lookup=True, cache={'path': str(tmp_path / 'cache' / 'ldap'),
+                                                               'deletion_check_interval': 3600})
+    connection = connector.connection
+    groups = ['Group 0', 'Group 1']
+    with mock.patch.object(connector, 'get_high_water_mark', return_value=('dc1', 100)):
+        users = {u['email']: u for u in connector.load_users_and_groups(groups, [], True)}
+    assert len(users) == 15
+    assert users['user5@example.com']['groups'] == ['Group 0']
+
+    user_dn = 'cn=user{},ou=users,' + BASE_DN
+    connection.modify(user_dn.format(5), {'sn': [(ldap3.MODIFY_REPLACE, ['Changed'])],
+                                          'uSNChanged': [(ldap3.MODIFY_REPLACE, ['150'])],
+                                          'distinguishedName': [(ldap3.MODIFY_REPLACE, [user_dn.format(5)])]})
+    connection.strategy.add_entry(user_dn.format(15), {
+        'objectClass': 'person', 'cn': 'user15', 'mail': 'user15@example.com', 'uSNChanged': '160',
+        'distinguishedName': user_dn.format(15), 'memberOf': ['cn=Group 1,ou=groups,{}'.format(BASE_DN)]})
+    connection.delete(user_dn.format(10))
+    connector.user_by_dn = {}
+    with mock.patch.object(connector, 'get_high_water_mark', return_value=('dc1', 200)), \
+            mock.patch.object(connector, 'iter_search_result', wraps=connector.iter_search_result) as search:
+        users = {u['email']: u for u in connector.load_users_and_groups(groups, [], True)}
+    searches = [(c[0][2], c[0][3]) for c in search.call_args_list]
+    # the deletion check isn't due yet, so the users aren't listed and the deleted one is still in the snapshot
+    all_users_filter = str(connector.options['all_users_filter'])
+    assert [attributes for f, attributes in searches if f == all_users_filter] == []
+    assert '(uSNChanged>=101)' in [f for f, _ in searches]
+    assert len(users) == 16
+    assert user_dn.format(10) in connector.snapshot.get_records()
+    assert users['user5@example.com']['lastname'] == 'Changed'
+    assert users['user15@example.com']['groups'] == ['Group 1']
+    assert connector.snapshot.get_state()['high_water_mark'] == '200'
+
+    # once it is due, all the users are only listed by DN, to find the deleted ones
+    connector.snapshot.set_state({'deletions_checked': str(time.time() - 3600)})
+    connector.user_by_dn = {}
+    with mock.patch.object(connector, 'get_high_water_mark', return_value=('dc1', 200)), \
+            mock.patch.object(connector, 'iter_search_result', wraps=connector.iter_search_result) as search:
+        users = {u['email']: u for u in connector.load_users_and_groups(groups, [], True)}
+    searches = [(c[0][2], c[0][3]) for c in search.call_args_list]
+    assert [attributes for f, attributes in searches if f == all_users_filter] == [[ldap3.NO_ATTRIBUTES]]
+    assert len(users) == 15
+    assert 'user10@example.com' not in users
+    assert user_dn.format(10) not in connector.snapshot.get_records()
+    assert float(connector.snapshot.get_state()['deletions_checked']) > time.time() - 60
+
+    # the snapshot is rebuilt when connected to a different server
+    connector.user_by_dn = {}
+    with mock.patch.object(connector, 'get_high_water_mark', return_value=('dc2', 10)), \
+            mock.patch.object(connector, 'iter_search_result', wraps=connector.iter_search_result) as search:
+        connector.load_users_and_groups(groups, [], True)
+    assert '(objectClass=person)' in [c[0][2] for c in search.call_args_list]
+    with pytest.raises(AssertionException):
+        ldap_connector(incremental_lookup=True)
@@ -0,0 +1,227 @@
+import json
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import mock
+import pytest
+from okta.models.user.User import User
+
+import user_sync.config.user_sync  # noqa: F401
+from user_sync.connector.directory_okta import OktaDirectoryConnector, OktaRateLimiter
+from user_sync.error import AssertionException
+
+HOST = 'https://example.okta.com'
+
+
+class MockResponse:
+    def __init__(self, body, next_url=None, headers=None, status_code=200):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.links = {'next': {'url': next_url}} if next_url else {}
+        self.headers = headers or {}
+
+
+class MockOkta:
+    """Serves groups and paged group members like the Okta API"""
+    def __init__(self, group_count=3, users_per_group=5, page_size=2):
+        self.groups = {'Group {}'.format(g): 'g{}'.format(g) for g in range(group_count)}
+        self.members = {gid: [self.user(g * users_per_group + u) for u in range(users_per_group)]
+                        for g, gid in enumerate(self.groups.values())}
+        # the first user is in every group
+        for members in self.members.values():
+            members.append(self.user(0))
+        self.page_size = page_size
+        self.group_page_size = None
+        self.search_supported = True
+        self.requests = []
+        self.threads = set()
+        self.rate_limit = None
+        self.rate_limit_reset = None
+        self.delay = 0
+
+    @staticmethod
+    def user(u):
+        return {'id': 'u{}'.format(u), 'status': 'SUSPENDED' if u == 1 else 'ACTIVE',
+                'profile': {'login': 'user{}@example.com'.format(u), 'email': 'user{}@example.com'.format(u),
+                            'firstName': 'User', 'lastName': str(u), 'countryCode': 'us'}}
+
+    def get(self, url, headers=None):
+        self.requests.append(url)
+        self.threads.add(threading.get_ident())
+        if self.delay:
+            time.sleep(self.delay)
+        headers = {}
+        if self.rate_limit is not None:
+            headers = {'X-Rate-Limit-Remaining': str(max(self.rate_limit - len(self.requests), 0)),
+                       'X-Rate-Limit-Reset': str(self.rate_limit_reset)}
+        parsed = urlparse(url)
+        params = parse_qs(parsed.query)
+        path = parsed.path.rstrip('/').split('/')[3:]
+        if path == ['groups']:
+            query = params.get('q', [''])[0]
+            groups = [{'id': gid, 'profile': {'name': name}} for name, gid in self.groups.items()
+                      if name.startswith(query)]
+            if 'search' in params:
+                if not self.search_supported:
+                    return MockResponse({'errorSummary': 'Invalid search'}, status_code=400)
+                names = [re.sub(r'\\(.)', r'\1', n) for n in
+                         re.findall(r'profile\.name eq "((?:[^"\\]|\\.)*)"', params['search'][0])]
+                return MockResponse([g for g in groups if g['profile']['name'] in names], headers=headers)
+            start = int(params.get('after', ['0'])[0])
+            if query or not self.group_page_size or start + self.group_page_size >= len(groups):
+                return MockResponse(groups[start:], headers=headers)
+            next_url = '{}/api/v1/groups/?after={}'.format(HOST, start + self.group_page_size)
+            return MockResponse(groups[start:start + self.group_page_size], next_url, headers=headers)
+        gid = path[1]
+        start = int(params.get('after', ['0'])[0])
+        page_size = int(params.get('limit', [self.page_size])[0])
+        page = self.members[gid][start:start + page_size]
+        next_url = None
+        if start + page_size < len(self.members[gid]):
+            next_url = '{}/api/v1/groups/{}/users?after={}&limit={}'.format(HOST, gid, start + page_size, page_size)
+        return MockResponse(page, next_url, headers=headers)
+
+
+@pytest.fixture
+def okta_api():
+    api = MockOkta()
+    with mock.patch('okta.framework.ApiClient.requests.get', side_effect=api.get):
+        yield api
+
+
+@pytest.fixture
+def okta_connector():
+    def _okta_connector(**options):
+        caller_options = {'host': HOST, 'api_token': 'token'}
+        caller_options.update(options)
+        return OktaDirectoryConnector(caller_options)
+    return _okta_connector
+
+
+@pytest.mark.parametrize('connections', [1, 4])
+def test_load_users_and_groups(okta_api, okta_connector, connections):
+    connector = okta_connector(connections=connections)
+    okta_api.delay = 0.01
+    okta_api.group_page_size = 2
+    groups = ['Group 0', 'Group 1', 'Group 2', 'Missing']
+    with mock.patch.object(connector, 'convert_user', wraps=connector.convert_user) as convert_user:
+        users = {u['email']: u for u in connector.load_users_and_groups(groups, ['login'], False)}
+    # user1 is suspended, so filtered out
+    assert len(users) == 14
+    assert users['user0@example.com']['groups'] == ['Group 0', 'Group 1', 'Group 2']
+    assert users['user7@example.com']['groups'] == ['Group 1']
+    assert users['user7@example.com']['country'] == 'US'
+    assert users['user7@example.com']['source_attributes']['login'] == 'user7@example.com'
+    # user0 is only converted once
+    assert convert_user.call_count == 14
+    # one search for the groups, and three pages of members for each group found
+    assert len(okta_api.requests) == 1 + 3 * 3
+    assert 'search=' in okta_api.requests[0]
+    assert sorted(connector.group_by_name) == ['Group 0', 'Group 1', 'Group 2']
+    if connections > 1:
+        assert len(okta_api.threads) > 1
+    with pytest.raises(AssertionException):
+        okta_connector(connections=0)
+
+
+def test_load_group_index(okta_api, okta_connector):
+    connector = okta_connector(group_lookup_batch_size=2)
+    okta_api.groups['Quoted "Group" \\'] = 'g3'
+    groups = ['Group 0', ' Group 2', 'Missing', 'Group 0', 'Quoted "Group" \\']
+    connector.load_group_index(groups)
+    # the names are looked up two at a time, leaving out the groups that aren't mapped
+    assert len(okta_api.requests) == 2
+    assert sorted(connector.group_by_name) == ['Group 0', 'Group 2', 'Quoted "Group" \\']
+    assert connector.find_group('Group 1') is None
+    # if the search fails, all the groups are listed instead
+    okta_api.requests = []
+    okta_api.search_supported = False
+    okta_api.group_page_size = 2
+    connector.load_group_index(groups)
+    assert len(okta_api.requests) == 1 + 2
+    assert sorted(connector.group_by_name) == ['Group 0', 'Group 1', 'Group 2', 'Quoted "Group" \\']
+    with pytest.raises(AssertionException):
+        okta_connector(group_lookup_batch_size=0)
+
+
+def test_rate_limiter(okta_api, okta_connector):
+    connector = okta_connector()
+    reset = int(time.time()) + 30
+    okta_api.rate_limit, okta_api.rate_limit_reset = 3, reset
+    with mock.patch('user_sync.connector.directory_okta.time.sleep') as sleep:
+        connector.load_users_and_groups(['Group 0'], [], False)
+    # the second response leaves only the reserve of 1 request, so the third request waits for the reset,
+    # after which requests go ahead until another response says the limit is near
+    assert len(okta_api.requests) == 4
+    assert sleep.call_count == 2
+    assert 0 < sleep.call_args[0][0] <= 30
+    limiter = OktaRateLimiter(1)
+    limiter.update(MockResponse([], headers={'X-Rate-Limit-Remaining': '1', 'X-Rate-Limit-Reset': str(reset + 600)}))
+    with mock.patch('user_sync.connector.directory_okta.time.sleep') as sleep:
+        limiter.wait()
+    sleep.assert_called_once_with(OktaRateLimiter.max_wait)
+
+    # the lock is free while waiting, and a response reported meanwhile is taken into account after waking
+    def report_response(_):
+        assert not limiter.lock.locked()
+        remaining = '1' if sleep.call_count == 1 else '10'
+        limiter.update(MockResponse([], headers={'X-Rate-Limit-Remaining': remaining,
+                                                 'X-Rate-Limit-Reset': str(reset)}))
+    limiter.update(MockResponse([], headers={'X-Rate-Limit-Remaining': '1', 'X-Rate-Limit-Reset': str(reset)}))
+    with mock.patch('user_sync.connector.directory_okta.time.sleep', side_effect=report_response) as sleep:
+        limiter.wait()
+    assert sleep.call_count == 2
+    assert limiter.remaining == 9
+
+
+def test_filter_users(okta_api, okta_connector):
+    connector = okta_connector(all_users_filter='user.status == "ACTIVE" and user.profile.lastName != "4"')
+    users = [mock.Mock(status='ACTIVE', profile=mock.Mock(lastName=str(u))) for u in range(6)]
+    users[2].status = 'SUSPENDED'
+    with mock.patch('user_sync.connector.directory_okta.compile', create=True, side_effect=compile) as compiler:
+        filtered = connector.filter_users(iter(users), connector.options['all_users_filter'])
+        assert next(filtered) is users[0]
+        assert list(filtered) == [users[1], users[3], users[5]]
+        # the configured predicate was compiled when the connector was created
+        assert compiler.call_count == 0
+        assert list(connector.filter_users(users, 'len([c for c in user.status if c == "S"]) > 1')) == [users[2]]
+        assert compiler.call_count == 1
+    with pytest.raises(AssertionException):
+        list(connector.filter_users(users, 'user.status.missing()'))
+    with pytest.raises(AssertionException):
+        okta_connector(all_users_filter='user.status ==')
+    # the filtering time is counted afresh for each load
+    connector.filter_time = 1000.0
+    connector.load_users_and_groups(['Group 0'], [], False)
+    assert 0 < connector.filter_time < 1000.0
+
+
+def test_projected_fields(okta_api, okta_connector):
+    connector = okta_connector(search_page_size=3)
+    with mock.patch.object(connector.groups_client, 'get_group_all_user_records',
+                           wraps=connector.groups_client.get_group_all_user_records) as get_records:
+        users = {u['email']: u for u in connector.load_users_and_groups(['Group 0'], ['department'], False)}
+    assert get_records.call_args[0][1] == ['login', 'firstName', 'lastName', 'countryCode', 'email', 'department']
+    assert len(users) == 4
+    assert users['user3@example.com']['lastname'] == '3'
+    assert users['user3@example.com']['source_attributes']['department'] is None
+    # six members in pages of three
+    assert len(okta_api.requests) == 1 + 2
+    assert 'limit=3' in okta_api.requests[1]
+
+    get_fields = OktaDirectoryConnector.get_filter_profile_fields
+    assert get_fields('user.status == "ACTIVE" and user.profile.department in ("A", "B")') == {'department'}
+    assert get_fields('user.created is not None') is None
+    assert get_fields('getattr(user, "status") == "ACTIVE"') is None
+    assert get_fields('user.profile["department"] == "A"') is None
+
+    # a filter that needs more than the profile reads whole users
+    connector = okta_connector(all_users_filter='user.status == "ACTIVE" and user.created is None')
+    members = list(connector.iter_groups_member_records(['Group 0'], ['email'], None))[0][1]
+    assert all(isinstance(member, User) for member in members)
+    users = list(connector.load_users_and_groups(['Group 0'], [], False))
+    assert len(users) == 4
+    with pytest.raises(AssertionException):
+        okta_connector(search_page_size=0)
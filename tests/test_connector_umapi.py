@@ -0,0 +1,240 @@
+import logging
+import threading
+
+import mock
+import pytest
+import umapi_client
+
+from user_sync.connector.connector_umapi import ActionManager, Commands, UmapiConnector
+from user_sync.error import AssertionException
+
+
+class MockConnection:
+    def __init__(self):
+        self.throttle_actions = 10
+        self.throttle_commands = 10
+        self.throttle_groups = 10
+        self.sync_started = False
+        self.sync_ended = False
+        self.batches = []
+        self.threads = set()
+
+    def execute_single(self, action, immediate=False):
+        return self.execute_multiple([action], immediate)
+
+    def execute_multiple(self, actions, immediate=True):
+        self.threads.add(threading.get_ident())
+        self.batches.append(list(actions))
+        return 0, len(actions), len(actions)
+
+    def execute_queued(self):
+        return 0, 0, 0
+
+
+class MockQueuedConnection(MockConnection):
+    """Queues actions like a real connection, and fails any batch containing a failing action"""
+    def __init__(self, fail_user=None):
+        super().__init__()
+        self.queue = []
+        self.fail_user = fail_user
+
+    def execute_multiple(self, actions, immediate=True):
+        actions = self.queue + list(actions)
+        sent = 0
+        error = None
+        while len(actions) >= (1 if immediate else self.throttle_actions):
+            batch, actions = actions[:self.throttle_actions], actions[self.throttle_actions:]
+            self.batches.append(batch)
+            sent += len(batch)
+            if any(a.frame['user'] == self.fail_user for a in batch):
+                error = Exception('failed')
+        self.queue = actions
+        if error:
+            raise umapi_client.BatchError([error], len(actions), sent, 0)
+        return len(actions), sent, sent
+
+    def execute_queued(self):
+        return self.execute_multiple([], immediate=True)
+
+
+@pytest.fixture
+def action_manager():
+    def _action_manager(pool_size=1):
+        pool = [MockConnection() for _ in range(pool_size)]
+        return ActionManager(pool[0], 'org_id', logging.getLogger('test'), pool)
+    return _action_manager
+
+
+@pytest.fixture
+def cached_connector(tmp_path):
+    UmapiConnector.create_conn = False
+    connector = UmapiConnector('', {
+        'authentication_method': 'oauth',
+        'enterprise': {'org_id': 'org_id'},
+        'cache': {'path': str(tmp_path / 'cache')},
+    })
+    UmapiConnector.create_conn = True
+    return connector
+
+
+def add_actions(action_manager, count, results):
+    for i in range(count):
+        action = action_manager.create_action(Commands('user{}@example.com'.format(i)))
+        action.update(firstname='user{}'.format(i))
+        action_manager.add_action(action, lambda r: results.append(r['action'].frame['user']))
+
+
+def test_dispatch_disabled(action_manager):
+    am = action_manager()
+    assert not am.dispatch
+    results = []
+    add_actions(am, 5, results)
+    assert len(am.connection.batches) == 5
+    assert results == ['user{}@example.com'.format(i) for i in range(5)]
+
+
+def test_dispatch_order(action_manager):
+    am = action_manager(4)
+    assert am.dispatch
+    results = []
+    add_actions(am, 95, results)
+    # the first 40 actions are dispatched as soon as the pool is saturated
+    assert len(results) == 80
+    am.flush()
+    assert not am.has_work()
+    assert results == ['user{}@example.com'.format(i) for i in range(95)]
+    batches = [b for c in am.pool for b in c.batches]
+    assert len(batches) == 10
+    assert sum(len(b) for b in batches) == 95
+
+
+def test_dispatch_sync_signals(action_manager):
+    am = action_manager(3)
+    am.connection.sync_started = True
+    am.connection.sync_ended = True
+    results = []
+    add_actions(am, 25, results)
+    am.flush()
+    assert len(results) == 25
+    first, last = am.connection.batches[0], am.connection.batches[-1]
+    assert first[0].frame['user'] == 'user0@example.com'
+    assert last[-1].frame['user'] == 'user24@example.com'
+
+
+def test_dispatch_batch_error(action_manager):
+    am = action_manager(2)
+
+    def fail(actions, immediate=True):
+        raise umapi_client.BatchError([Exception('failed')], 0, len(actions), 0)
+    am.pool[1].execute_multiple = fail
+    am.pool[0].execute_multiple = fail
+    results = []
+    for i in range(3):
+        action = am.create_action(Commands('user{}@example.com'.format(i)))
+        am.add_action(action, lambda r: results.append(r['is_success']))
+    am.flush()
+    assert results == [False, False, False]
+    assert am.get_statistics() == (3, 3)
+
+
+def test_dispatch_unavailable(action_manager):
+    """The other batches are still processed when one of them can't be sent"""
+    am = action_manager(3)
+
+    def unavailable(actions, immediate=True):
+        if any(a.frame['user'] == 'user12@example.com' for a in actions):
+            raise umapi_client.UnavailableError(3, 30, None)
+        return 0, len(actions), len(actions)
+    for connection in am.pool:
+        connection.execute_multiple = unavailable
+    results = []
+    for i in range(25):
+        action = am.create_action(Commands('user{}@example.com'.format(i)))
+        action.update(firstname='user{}'.format(i))
+        am.add_action(action, lambda r: results.append((r['action'].frame['user'], r['is_success'])))
+    with pytest.raises(AssertionException):
+        am.flush()
+    assert not am.has_work()
+    # the batch of user10 to user19 failed, and the batches either side of it still count
+    assert results == [('user{}@example.com'.format(i), not 10 <= i < 20) for i in range(25)]
+    assert am.get_statistics() == (25, 10)
+
+
+def test_split_actions(action_manager):
+    am = ActionManager(MockQueuedConnection(fail_user='user1@example.com'), 'org_id', logging.getLogger('test'))
+    results = []
+    for i in range(6):
+        action = am.create_action(Commands('user{}@example.com'.format(i)))
+        # user3 gets enough groups to be split into eight actions, straddling two batches
+        groups = ['Group {}'.format(g) for g in range(800 if i == 3 else 1)]
+        action.add_to_groups(groups=groups)
+        am.add_action(action, lambda r: results.append((r['action'].frame['user'], r['is_success'])))
+    # user0 to user2 and the first seven parts of user3 are sent in the first batch
+    # (which fails, because of user1), and the rest of user3 has to wait for the next
+    assert results == [('user{}@example.com'.format(i), False) for i in range(3)]
+    am.flush()
+    assert not am.has_work()
+    assert [len(b) for b in am.connection.batches] == [10, 3]
+    assert results[3:] == [('user3@example.com', False), ('user4@example.com', True), ('user5@example.com', True)]
+    assert am.get_statistics() == (6, 4)
+
+
+def test_cache_refresh(cached_connector):
+    users = [{'email': 'user@example.com', 'username': 'user@example.com', 'domain': 'example.com',
+              'groups': ['Group A']}]
+    with mock.patch.object(UmapiConnector, 'query_users', return_value=iter(users)) as query_users:
+        assert cached_connector.cache.should_refresh
+        assert list(cached_connector.iter_users()) == users
+        assert not cached_connector.cache.should_refresh
+        assert list(cached_connector.iter_users()) == users
+        assert list(cached_connector.iter_users(in_group='group a')) == users
+        assert list(cached_connector.iter_users(in_group='group b')) == []
+        assert query_users.call_count == 1
+
+
+def test_update_cache(cached_connector):
+    cache = cached_connector.cache
+    commands = Commands('user@example.com', None)
+    commands.add_user({'email': 'user@example.com', 'firstname': 'Test', 'country': 'US',
+                       'id_type': 'federatedID', 'option': 'ignoreIfAlreadyExists'})
+    commands.add_groups({'Group A', 'Group B'})
+    cached_connector.update_cache(commands)
+    user = cache.get_user('user@example.com')
+    assert user['domain'] == 'example.com'
+    assert sorted(user['groups']) == ['Group A', 'Group B']
+
+    commands = Commands('user@example.com', None)
+    commands.update_user({'email': 'new@example.com', 'lastname': 'User'})
+    commands.remove_groups({'group a'})
+    cached_connector.update_cache(commands)
+    user = cache.get_user('new@example.com')
+    assert user['lastname'] == 'User'
+    assert user['groups'] == ['Group B']
+
+    commands = Commands('new@example.com', None)
+    commands.remove_from_org(False)
+    cached_connector.update_cache(commands)
+    assert list(cache.get_users()) == []
+
+
+def test_cache_callback(cached_connector):
+    commands = Commands('user@example.com', None)
+    commands.add_user({'email': 'user@example.com', 'id_type': 'federatedID'})
+    results = []
+    callback = cached_connector.cache_callback(commands, results.append)
+    callback({'is_success': False})
+    assert cached_connector.cache.get_user('user@example.com') is None
+    callback({'is_success': True})
+    assert cached_connector.cache.get_user('user@example.com') is not None
+    assert len(results) == 2
+
+
+def test_get_user(cached_connector):
+    cached_connector.cache.cache_user({'email': 'user@example.com', 'username': 'user@example.com'})
+    cached_connector.connection = MockConnection()
+    with mock.patch('umapi_client.UserQuery') as user_query:
+        user_query.return_value.result.return_value = {}
+        assert cached_connector.get_user('user@example.com') is None
+        cached_connector.cache.should_refresh = False
+        assert cached_connector.get_user('user@example.com')['email'] == 'user@example.com'
+        assert user_query.call_count == 1
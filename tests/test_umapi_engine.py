@@ -1,5 +1,9 @@
 import csv
+import gzip
 import re
+import threading
+import time
+from concurrent.futures import CancelledError
 
 import mock
 import pytest
@@ -9,7 +13,8 @@ from mock import MagicMock
 from tests.util import compare_iter
 from user_sync.connector.connector_umapi import Commands
 from user_sync.engine.common import AdobeGroup
-from user_sync.engine.umapi import UmapiTargetInfo, UmapiConnectors, RuleProcessor, MultiIndex
+from user_sync.engine.umapi import UmapiTargetInfo, UmapiConnectors, RuleProcessor, MultiIndex, DirectoryUserRecord
+from user_sync.helper import ExternalSorter
 
 
 @pytest.fixture
@@ -326,6 +331,154 @@ def test_read_desired_user_groups_basic(rule_processor, mock_dir_user):
     assert 'console group' in rp.umapi_info_by_name[None].get_desired_groups(email=mock_dir_user['email'], username=mock_dir_user['username'])['desired_groups']
     assert mock_dir_user['email'] == rp.filtered_directory_user_index.data[0]['email']
 
+
+def test_prefetch_umapi_users(rule_processor, mock_umapi_user):
+    rp = rule_processor
+    connectors = {'sec1': MockUmapiConnector(name='sec1'), 'sec2': MockUmapiConnector(name='sec2')}
+    connectors['sec1'].users = [mock_umapi_user]
+    rp.get_umapi_info('sec1').add_mapped_group('Group A')
+    with rp.prefetch_umapi_users(connectors) as prefetched:
+        # secondaries with no mapped groups are never synced, so they aren't fetched
+        assert list(prefetched) == ['sec1']
+        assert prefetched['sec1'].result() == [mock_umapi_user]
+
+    # an error stops the fetches in flight, and leaving the context waits for them to end
+    fetching = threading.Event()
+
+    def iter_users():
+        while True:
+            fetching.set()
+            yield mock_umapi_user
+            time.sleep(0.001)
+    connectors['sec1'].iter_users = iter_users
+    with pytest.raises(ValueError):
+        with rp.prefetch_umapi_users(connectors) as prefetched:
+            fetching.wait(1)
+            raise ValueError()
+    assert prefetched['sec1'].done()
+    assert isinstance(prefetched['sec1'].exception(), CancelledError)
+
+    rp.push_umapi = True
+    with rp.prefetch_umapi_users(connectors) as prefetched:
+        assert prefetched == {}
+
+
+def test_sort_merge_umapi_users(get_mock_user):
+    def run_sync(sort_merge):
+        AdobeGroup.index_map = {}
+        rp = RuleProcessor({'sort_merge': sort_merge, 'process_groups': True, 'exclude_unmapped_users': False,
+                            'update_user_info': True, 'stray_list_output_path': 'strays.csv',
+                            'username_filter_regex': re.compile(r'^(?!user9)')})
+        directory_connector = mock.MagicMock()
+        directory_connector.load_users_and_groups.return_value = [
+            get_mock_user('user3', groups=['Group A']),
+            get_mock_user('user1', groups=['Group A']),
+            get_mock_user('user2', groups=['Group B']),
+            # matched by email, and by username alone
+            get_mock_user('user5', groups=['Group A'], username='u5'),
+            get_mock_user('user6', groups=['Group A'], username='u6'),
+            get_mock_user('user8', groups=['Group A'], username='u8'),
+            # read but not selected, with a different identity type than the adobe user it matches
+            get_mock_user('user9', groups=['Group A'], identity_type='adobeID', firstname='Changed'),
+        ]
+        mappings = {'Group A': [AdobeGroup.create('Console Group')]}
+        umapi_connectors = mock_umapi_connectors()
+        umapi_connectors.primary_connector.users = [
+            get_mock_user('user4', is_umapi_user=True, groups=['Console Group']),
+            get_mock_user('user2', is_umapi_user=True, groups=['Console Group']),
+            get_mock_user('user1', is_umapi_user=True),
+            get_mock_user('user5', is_umapi_user=True, username='u5'),
+            get_mock_user('old6', is_umapi_user=True, username='u6'),
+            # shares its username with an earlier user, so is ignored
+            get_mock_user('user7', is_umapi_user=True, username='u5'),
+            get_mock_user('user8', is_umapi_user=True),
+            get_mock_user('user9', is_umapi_user=True, groups=['Console Group']),
+        ]
+        rp.prepare_umapi_infos()
+        if sort_merge:
+            rp.read_sorted_directory_users(mappings, directory_connector)
+        else:
+            rp.read_desired_user_groups(mappings, directory_connector)
+        primary_commands, _ = rp.sync_umapi_users(umapi_connectors)
+        commands = sorted((c.user, [(a[0], sorted(a[1]) if isinstance(a[1], set) else a[1]) for a in c.do_list])
+                          for c in primary_commands)
+        return commands, rp.stray_key_map, rp.action_summary
+
+    def mock_umapi_connectors():
+        return UmapiConnectors(MockUmapiConnector(), {})
+
+    sorted_commands, sorted_strays, sorted_summary = run_sync(True)
+    commands, strays, _ = run_sync(False)
+    assert sorted_commands == commands
+    assert [c[0] for c in sorted_commands] == ['user1@example.com', 'user2@example.com', 'user3@example.com',
+                                               'user5@example.com', 'user6@example.com', 'user8@example.com']
+    assert sorted_strays == strays
+    assert sorted(k.split(',')[1] for k in sorted_strays[None]) == ['user4@example.com', 'user9@example.com']
+    assert sorted_summary['directory_users_read'] == 7
+    assert sorted_summary['directory_users_selected'] == 6
+
+
+def test_incremental_sync(get_mock_user, tmp_path):
+    def read_users(users, **options):
+        AdobeGroup.index_map = {}
+        rp = RuleProcessor({'incremental': True, 'incremental_state_path': str(tmp_path), 'process_groups': True,
+                            **options})
+        directory_connector = mock.MagicMock()
+        directory_connector.load_users_and_groups.return_value = users
+        rp.read_desired_user_groups({'Group A': [AdobeGroup.create('Console Group')]}, directory_connector)
+        rp.select_incremental_users()
+        return rp
+
+    def save(rp):
+        umapi_connectors = UmapiConnectors(MockUmapiConnector(), {})
+        umapi_connectors.primary_connector.action_manager.get_statistics = lambda: (1, 0)
+        rp.save_sync_state(umapi_connectors)
+
+    rp = read_users([get_mock_user('user1', groups=['Group A']), get_mock_user('user2'), get_mock_user('user3')])
+    # the first sync has no saved state, so it's a full sync
+    assert rp.incremental_emails is None
+    assert len(rp.filtered_directory_user_index.data) == 3
+    save(rp)
+
+    rp = read_users([get_mock_user('user1'), get_mock_user('user2')])
+    assert rp.incremental_emails == ['user1@example.com', 'user3@example.com']
+    assert rp.incremental_unchanged_count == 1
+    assert [u['email'] for u in rp.filtered_directory_user_index.data] == ['user1@example.com']
+    assert [u['email'] for u in rp.get_umapi_info(None).get_desired_groups_by_user_key().data] == ['user1@example.com']
+
+    umapi_connector = MockUmapiConnector()
+    umapi_connector.get_user = lambda email: get_mock_user(email, is_umapi_user=True) if email != 'user3@example.com' else None
+    assert [u['email'] for u in rp.get_umapi_users(rp.get_umapi_info(None), umapi_connector)] == ['user1@example.com']
+
+    # failed actions leave the saved state alone
+    umapi_connectors = UmapiConnectors(MockUmapiConnector(), {})
+    rp.save_sync_state(umapi_connectors)
+    rp = read_users([get_mock_user('user1'), get_mock_user('user2')])
+    assert rp.incremental_emails == ['user1@example.com', 'user3@example.com']
+    # skipped strays stay in the saved state until they are processed
+    rp.strays_skipped = True
+    save(rp)
+    rp = read_users([get_mock_user('user1'), get_mock_user('user2')])
+    assert rp.incremental_emails == ['user3@example.com']
+    save(rp)
+    rp = read_users([get_mock_user('user1'), get_mock_user('user2')])
+    assert rp.incremental_emails == []
+
+    # changing the sync options makes a full sync, after which the new options are the saved ones
+    rp = read_users([get_mock_user('user1'), get_mock_user('user2')], update_user_info=True)
+    assert rp.incremental_emails is None
+    save(rp)
+    rp = read_users([get_mock_user('user1'), get_mock_user('user2')], update_user_info=True)
+    assert rp.incremental_emails == []
+
+
+def test_external_sorter():
+    items = [(i * 7919) % 1000 for i in range(1000)]
+    sorter = ExternalSorter(key=lambda i: -i, run_size=64)
+    assert list(sorter.sort(items)) == sorted(items, reverse=True)
+    assert list(sorter.sort([])) == []
+
+
 @mock.patch('user_sync.helper.CSVAdapter.read_csv_rows')
 def test_read_stray_key_map(csv_reader, rule_processor):
     csv_mock_data = [
@@ -416,6 +569,24 @@ def test_write_stray_key_map(rule_processor, tmpdir):
         assert compare_iter(actual, expected)
 
 
+def test_stray_key_map_gzip(rule_processor, tmpdir):
+    tmp_file = str(tmpdir.join('strays_test.csv.gz'))
+    stray_key_map = {
+        None: {
+            'enterpriseID,adobe.user1@example.com,,adobe.user1@example.com': set(),
+            'federatedID,adobe.user2@example.com,,adobe.user2@example.com': set()
+        }}
+    rule_processor.stray_list_output_path = tmp_file
+    rule_processor.stray_key_map = stray_key_map
+    rule_processor.write_stray_key_map()
+    with gzip.open(tmp_file, 'rt', newline='') as our_file:
+        assert next(csv.reader(our_file)) == ['type', 'email', 'domain']
+
+    reader = RuleProcessor({})
+    reader.read_stray_key_map(tmp_file)
+    assert reader.stray_key_map == {None: {k: None for k in stray_key_map[None]}}
+
+
 def test_log_after_mapping_hook_scope(rule_processor, log_stream):
     rp = rule_processor
     stream, logger = log_stream
@@ -593,3 +764,28 @@ def test_multi_index_update(test_data):
     user = user_index.get(email=user['email'], username=user['username'])
     assert user['firstname'] == 'Test Updated'
     assert user['lastname'] == 'User 001 Updated'
+
+
+def test_multi_index_interned_keys(test_data):
+    test_data[0]['username'] = test_data[0]['email']
+    user_index = MultiIndex(data=test_data, key_names=['email', 'username'])
+    email_key, = [k for k in user_index.index['email'] if k == 'user1@example.com']
+    username_key, = [k for k in user_index.index['username'] if k == 'user1@example.com']
+    assert email_key is username_key
+
+
+def test_directory_user_record(mock_dir_user):
+    mock_dir_user['custom'] = 'value'
+    record = DirectoryUserRecord(mock_dir_user)
+    assert record == mock_dir_user
+    assert dict(record) == mock_dir_user
+    assert record['custom'] == 'value'
+    assert record.get('missing') is None
+    del record['country']
+    assert 'country' not in record
+    with pytest.raises(KeyError):
+        _ = record['country']
+    record.update({'email': 'new@example.com'})
+    assert record['email'] == 'new@example.com'
+    user_index = MultiIndex(data=[record], key_names=['email', 'username'])
+    assert user_index.get(email='NEW@example.com') is record
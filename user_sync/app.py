@@ -137,7 +137,7 @@ def info():
               help="specify what action to take on Adobe users that don't match users from the "
                    "directory.  Options are 'exclude' (from all changes), "
                    "'preserve' (as is except for --process-groups, the default), "
-                   "'write-file f' (preserve and list them), "
+                   "'write-file f' (preserve and list them, gzip-compressed if f ends in .gz), "
                    "'remove-adobe-groups' (but do not remove users)"
                    "'remove' (users but preserve cloud storage), "
                    "'delete' (users and their cloud storage), ",
@@ -147,7 +147,8 @@ def info():
 @click.option('--adobe-only-user-list',
               help="instead of computing Adobe-only users (Adobe users with no matching users "
                    "in the directory) by comparing Adobe users with directory users, "
-                   "the list is read from a file (see --adobe-only-user-action write-file). "
+                   "the list is read from a file (see --adobe-only-user-action write-file), "
+                   "which is gzip-compressed if its name ends in .gz. "
                    "When using this option, you must also specify what you want done with Adobe-only "
                    "users by also including --adobe-only-user-action and one of its arguments",
               type=str,
@@ -167,10 +168,18 @@ def info():
               metavar='ldap|okta|csv|adobe_console [path-to-file.csv]')
 @click.option('--exclude-unmapped-users/--include-unmapped-users', default=None,
               help='Exclude users that is not part of a mapped group from being created on Adobe side')
+@click.option('--incremental/--no-incremental', default=None,
+              help='only sync the users that changed in the directory since the last successful sync, '
+                   'with a full sync at the interval set in the incremental_sync config section.')
 @click.option('--process-groups/--no-process-groups', default=None,
               help='if membership in mapped groups differs between the enterprise directory and Adobe sides, '
                    'the group membership is updated on the Adobe side so that the memberships in mapped '
                    'groups match those on the enterprise directory side.')
+@click.option('--sort-merge/--no-sort-merge', default=None,
+              help='compare directory and Adobe users by merging both lists sorted by email and then by '
+                   'username, spilling to temporary files as needed, instead of indexing them in memory. '
+                   'This bounds the memory used by the sync itself, but most directory connectors still load '
+                   'all their users.  Secondary umapi connectors are not supported.')
 @click.option('--strategy',
               help="whether to fetch and sync the Adobe directory against the customer directory "
                    "or just to push each customer user to the Adobe side.  Default is to fetch and sync.",
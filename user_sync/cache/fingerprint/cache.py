@@ -0,0 +1,70 @@
+from ..base import CacheBase
+from .schema import fingerprints as fingerprints_schema
+from .schema import state as state_schema
+from pathlib import Path
+from typing import Optional
+
+
+class FingerprintCache(CacheBase):
+    """
+    The state of each directory user as of the last successful sync, kept as a hash of the
+    user's mapped attributes and desired groups.  The refresh interval is the time between
+    full syncs; should_refresh means the next sync must reconcile every user.  The state holds
+    the sync options the fingerprints were saved under, since changing those changes every user.
+    """
+    # increment this every time there are changes to table schema or data model
+    VERSION: int = 2
+
+    def __init__(self, store_path: Path, refresh_interval: Optional[int] = None) -> None:
+        self.cache_meta_filename = 'fingerprint-meta.db'
+        if refresh_interval is not None:
+            self.refresh_interval = refresh_interval
+        self.init(store_path)
+        db_path = store_path / 'fingerprint.db'
+        if not db_path.exists():
+            self.should_refresh = True
+            self.db_conn = self.get_db_conn(db_path)
+            for s in [fingerprints_schema, state_schema]:
+                self.db_conn.execute(s)
+            self.db_conn.commit()
+        else:
+            self.db_conn = self.get_db_conn(db_path)
+        if self.get_version() != self.VERSION:
+            self.rebuild_tables()
+            self.init_meta()
+            self.should_refresh = True
+        super().__init__()
+
+    def rebuild_tables(self):
+        self.db_conn.execute("drop table if exists fingerprints")
+        self.db_conn.execute("drop table if exists state")
+        for s in [fingerprints_schema, state_schema]:
+            self.db_conn.execute(s)
+        self.db_conn.commit()
+
+    def get_fingerprints(self) -> dict:
+        cur = self.db_conn.cursor()
+        cur.execute("select user_key, fingerprint from fingerprints")
+        fingerprints = dict(cur.fetchall())
+        cur.close()
+        return fingerprints
+
+    def save_fingerprints(self, fingerprints: dict):
+        """
+        Replace the stored fingerprints with the given map of user key to fingerprint
+        """
+        self.db_conn.execute("delete from fingerprints")
+        self.db_conn.executemany("insert into fingerprints(user_key, fingerprint) values (?,?)",
+                                 fingerprints.items())
+        self.db_conn.commit()
+
+    def get_state(self) -> dict:
+        cur = self.db_conn.cursor()
+        cur.execute("select name, value from state")
+        state = dict(cur.fetchall())
+        cur.close()
+        return state
+
+    def set_state(self, state: dict):
+        self.db_conn.executemany("insert or replace into state(name, value) values (?,?)", state.items())
+        self.db_conn.commit()
@@ -0,0 +1,13 @@
+fingerprints = """
+create table if not exists fingerprints (
+    user_key text not null unique,
+    fingerprint text not null
+);
+"""
+
+state = """
+create table if not exists state (
+    name text not null unique,
+    value text not null
+);
+"""
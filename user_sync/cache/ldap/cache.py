@@ -0,0 +1,160 @@
+from ..base import CacheBase
+from .schema import group_dns as group_dns_schema
+from .schema import group_state as group_state_schema
+from .schema import snapshot_entries as snapshot_entries_schema
+from .schema import snapshot_state as snapshot_state_schema
+from pathlib import Path
+from typing import Optional
+import base64
+import json
+
+from ldap3.utils.ciDict import CaseInsensitiveDict
+
+
+class LDAPGroupCache(CacheBase):
+    """
+    The DN found for each mapped group name, so that group DNs don't have to be looked up on every run.
+    Groups that were not found are never cached.  The state holds the search settings the DNs were found
+    with, so they can be dropped when those change.
+    """
+    # increment this every time there are changes to table schema or data model
+    VERSION: int = 2
+
+    def __init__(self, store_path: Path, refresh_interval: Optional[int] = None) -> None:
+        self.cache_meta_filename = 'ldap-groups-meta.db'
+        if refresh_interval is not None:
+            self.refresh_interval = refresh_interval
+        self.init(store_path)
+        db_path = store_path / 'ldap-groups.db'
+        if not db_path.exists():
+            self.should_refresh = True
+            self.db_conn = self.get_db_conn(db_path)
+            for s in [group_dns_schema, group_state_schema]:
+                self.db_conn.execute(s)
+            self.db_conn.commit()
+        else:
+            self.db_conn = self.get_db_conn(db_path)
+        if self.get_version() != self.VERSION:
+            self.rebuild_tables()
+            self.init_meta()
+            self.should_refresh = True
+        super().__init__()
+
+    def rebuild_tables(self):
+        self.db_conn.execute("drop table if exists group_dns")
+        self.db_conn.execute("drop table if exists state")
+        for s in [group_dns_schema, group_state_schema]:
+            self.db_conn.execute(s)
+        self.db_conn.commit()
+
+    def clear_all(self):
+        self.db_conn.execute("delete from group_dns")
+        self.db_conn.execute("delete from state")
+        self.db_conn.commit()
+
+    def get_group_dns(self) -> dict:
+        cur = self.db_conn.cursor()
+        cur.execute("select group_name, group_dn from group_dns")
+        group_dns = dict(cur.fetchall())
+        cur.close()
+        return group_dns
+
+    def cache_group_dns(self, group_dns: dict):
+        self.db_conn.executemany("insert or replace into group_dns(group_name, group_dn) values (?,?)",
+                                 group_dns.items())
+        self.db_conn.commit()
+
+    def get_state(self) -> dict:
+        cur = self.db_conn.cursor()
+        cur.execute("select name, value from state")
+        state = dict(cur.fetchall())
+        cur.close()
+        return state
+
+    def set_state(self, state: dict):
+        self.db_conn.executemany("insert or replace into state(name, value) values (?,?)", state.items())
+        self.db_conn.commit()
+
+
+class LDAPSnapshotCache(CacheBase):
+    """
+    A local copy of the LDAP user entries, with the search state it was taken with (such as the
+    high-water mark of changes it includes), so that later runs only have to read the entries that
+    changed.  The refresh interval is the time between full reads of the directory.  Records are stored
+    as JSON, with bytes values base64-encoded and any other value that JSON can't hold as a string.
+    """
+    # increment this every time there are changes to table schema or data model
+    VERSION: int = 2
+
+    def __init__(self, store_path: Path, refresh_interval: Optional[int] = None) -> None:
+        self.cache_meta_filename = 'ldap-snapshot-meta.db'
+        if refresh_interval is not None:
+            self.refresh_interval = refresh_interval
+        self.init(store_path)
+        db_path = store_path / 'ldap-snapshot.db'
+        if not db_path.exists():
+            self.should_refresh = True
+            self.db_conn = self.get_db_conn(db_path)
+            for s in [snapshot_entries_schema, snapshot_state_schema]:
+                self.db_conn.execute(s)
+            self.db_conn.commit()
+        else:
+            self.db_conn = self.get_db_conn(db_path)
+        if self.get_version() != self.VERSION:
+            self.rebuild_tables()
+            self.init_meta()
+            self.should_refresh = True
+        super().__init__()
+
+    def rebuild_tables(self):
+        self.db_conn.execute("drop table if exists entries")
+        self.db_conn.execute("drop table if exists state")
+        for s in [snapshot_entries_schema, snapshot_state_schema]:
+            self.db_conn.execute(s)
+        self.db_conn.commit()
+
+    def clear_all(self):
+        self.db_conn.execute("delete from entries")
+        self.db_conn.execute("delete from state")
+        self.db_conn.commit()
+
+    def get_records(self) -> dict:
+        cur = self.db_conn.cursor()
+        cur.execute("select dn, record from entries")
+        # attribute names are case-insensitive, as in the search results the records came from
+        records = {dn: CaseInsensitiveDict(json.loads(record, object_hook=self.decode_value)) for dn, record in cur}
+        cur.close()
+        return records
+
+    def update_records(self, records: dict, deleted_dns=()):
+        """
+        Remove the entries with the given DNs, then add (or replace) the given map of DN to record
+        """
+        self.db_conn.executemany("delete from entries where dn = ?", ((dn,) for dn in deleted_dns))
+        self.db_conn.executemany("insert or replace into entries(dn, record) values (?,?)",
+                                 ((dn, json.dumps(dict(record), default=self.encode_value))
+                                  for dn, record in records.items()))
+        self.db_conn.commit()
+
+    @staticmethod
+    def encode_value(value):
+        if isinstance(value, bytes):
+            return {'__bytes__': base64.b64encode(value).decode('ascii')}
+        return str(value)
+
+    @staticmethod
+    def decode_value(obj: dict):
+        if len(obj) == 1 and '__bytes__' in obj:
+            return base64.b64decode(obj['__bytes__'])
+        return obj
+
+    def get_state(self) -> dict:
+        cur = self.db_conn.cursor()
+        cur.execute("select name, value from state")
+        state = dict(cur.fetchall())
+        cur.close()
+        return state
+
+    def set_state(self, state: dict):
+        self.db_conn.executemany("insert or replace into state(name, value) values (?,?)", state.items())
+        self.db_conn.commit()
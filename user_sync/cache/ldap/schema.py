@@ -0,0 +1,27 @@
+group_dns = """
+create table if not exists group_dns (
+    group_name text not null unique,
+    group_dn text not null
+);
+"""
+
+group_state = """
+create table if not exists state (
+    name text not null unique,
+    value text not null
+);
+"""
+
+snapshot_entries = """
+create table if not exists entries (
+    dn text not null unique,
+    record text not null
+);
+"""
+
+snapshot_state = """
+create table if not exists state (
+    name text not null unique,
+    value text not null
+);
+"""
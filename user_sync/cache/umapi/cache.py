@@ -0,0 +1,103 @@
+from ..base import CacheBase
+from .schema import umapi_users as umapi_users_schema
+from .schema import umapi_users_username_index as umapi_users_username_index_schema
+from pathlib import Path
+from typing import Optional
+import json
+import sqlite3
+
+
+class UmapiCache(CacheBase):
+    # increment this every time there are changes to table schema or data model
+    VERSION: int = 1
+
+    def __init__(self, store_path: Path, org_name: str, refresh_interval: Optional[int] = None) -> None:
+        sqlite3.register_converter("umapi_user", convert_user)
+        # primary and secondary orgs may share a store path, but each is refreshed on its own schedule
+        self.cache_meta_filename = f"{org_name}-meta.db"
+        if refresh_interval is not None:
+            self.refresh_interval = refresh_interval
+        self.init(store_path)
+        db_path = store_path / f"{org_name}.db"
+        if not db_path.exists():
+            self.should_refresh = True
+            self.db_conn = self.get_db_conn(db_path)
+            for s in [umapi_users_schema, umapi_users_username_index_schema]:
+                self.db_conn.execute(s)
+            self.db_conn.commit()
+        else:
+            self.db_conn = self.get_db_conn(db_path)
+        if self.get_version() != self.VERSION:
+            self.rebuild_tables()
+            self.init_meta()
+            self.should_refresh = True
+        super().__init__()
+
+    @staticmethod
+    def get_db_conn(db_path: Path) -> sqlite3.Connection:
+        # users may be read on a prefetch thread, but the cache is never used by two threads at once
+        return sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+
+    def rebuild_tables(self):
+        self.db_conn.execute("drop table if exists users")
+        for s in [umapi_users_schema, umapi_users_username_index_schema]:
+            self.db_conn.execute(s)
+        self.db_conn.commit()
+
+    def clear_all(self):
+        self.db_conn.execute("delete from users")
+        self.db_conn.commit()
+
+    def cache_users(self, users: list[dict]):
+        self.db_conn.executemany("insert or replace into users(email, username, domain, user) values (?,?,?,?)",
+                                 [user_row(u) for u in users])
+        self.db_conn.commit()
+
+    def cache_user(self, user: dict):
+        self.cache_users([user])
+
+    def update_user(self, email: str, user: dict):
+        self.db_conn.execute("update users set email = ?, username = ?, domain = ?, user = ? where email = ?",
+                             user_row(user) + (email.lower(), ))
+        self.db_conn.commit()
+
+    def delete_user(self, email: str):
+        self.db_conn.execute("delete from users where email = ?", (email.lower(), ))
+        self.db_conn.commit()
+
+    def get_users(self):
+        cur = self.db_conn.cursor()
+        cur.execute("select user from users")
+        for r in cur:
+            yield r[0]
+        cur.close()
+
+    def get_user(self, user: str, domain: Optional[str] = None) -> Optional[dict]:
+        """
+        Look up a user by email, or by username (and domain, if the username isn't email-type)
+        """
+        user = user.lower()
+        cur = self.db_conn.cursor()
+        cur.execute("select user from users where email = ?", (user, ))
+        r = cur.fetchone()
+        if r is None:
+            if '@' in user or not domain:
+                cur.execute("select user from users where username = ?", (user, ))
+            else:
+                cur.execute("select user from users where username = ? and domain = ?", (user, domain.lower()))
+            r = cur.fetchone()
+        cur.close()
+        return r[0] if r is not None else None
+
+
+def user_row(user: dict) -> tuple:
+    return (user['email'].lower(), (user.get('username') or user['email']).lower(),
+            (user.get('domain') or '').lower(), adapt_user(user))
+
+
+def adapt_user(user: dict) -> bytes:
+    return json.dumps(user).encode('utf8')
+
+
+def convert_user(s: bytes) -> dict:
+    return json.loads(s)
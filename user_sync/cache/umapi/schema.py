@@ -0,0 +1,12 @@
+umapi_users = """
+create table if not exists users (
+    email text not null unique,
+    username text not null,
+    domain text,
+    user umapi_user
+);
+"""
+
+umapi_users_username_index = """
+create index if not exists users_username on users (username);
+"""
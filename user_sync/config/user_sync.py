@@ -44,12 +44,14 @@ class UMAPIConfigLoader(ConfigLoader):
     ROOT_CONFIG_PATH_KEYS = {'/adobe_users/connectors/umapi': (True, True, None),
                              '/directory_users/connectors/*': (True, False, None),
                              '/directory_users/extension': (True, False, None),
+                             '/incremental_sync/state_path': (False, False, None),
                              '/logging/file_log_directory': (False, False, "logs"),
                              }
 
     # like ROOT_CONFIG_PATH_KEYS, but for non-root configuration files
     SUB_CONFIG_PATH_KEYS = {'/enterprise/priv_key_path': (True, False, None),
-                            '/integration/priv_key_path': (True, False, None)}
+                            '/integration/priv_key_path': (True, False, None),
+                            '/cache/path': (False, False, None)}
 
     # default values for reading configuration files
     # these are in alphabetical order!  Always add new ones that way!
@@ -68,7 +70,9 @@ class UMAPIConfigLoader(ConfigLoader):
         'connector': ['ldap'],
         'encoding_name': 'utf8',
         'exclude_unmapped_users': False,
+        'incremental': False,
         'process_groups': False,
+        'sort_merge': False,
         'ssl_cert_verify': True,
         'strategy': 'sync',
         'test_mode': False,
@@ -163,6 +167,12 @@ class UMAPIConfigLoader(ConfigLoader):
             else:
                 raise AssertionException('Unknown option "%s" for adobe-only-user-action' % adobe_action)
 
+        # --sort-merge
+        if options['sort_merge'] and options['strategy'] == 'push':
+            raise AssertionException('You cannot specify --sort-merge when using "push" strategy')
+        if options['sort_merge'] and options['incremental']:
+            raise AssertionException('You cannot specify both --sort-merge and --incremental')
+
         # --users and --adobe-only-user-list conflict with each other, so we need to disambiguate.
 
         stray_list_input_path = None
@@ -535,6 +545,16 @@ class UMAPIConfigLoader(ConfigLoader):
         if group_removals_only is not None:
             options['group_removals_only'] = group_removals_only
         
+        # incremental sync state
+        incremental_config = self.main_config.get_dict_config('incremental_sync', True)
+        if incremental_config:
+            options['incremental_state_path'] = incremental_config.get_string('state_path', True)
+            full_sync_interval = incremental_config.get_int('full_sync_interval', True)
+            if full_sync_interval is not None:
+                options['full_sync_interval'] = full_sync_interval
+        if options['incremental'] and not options['incremental_state_path']:
+            raise AssertionException("'incremental_sync' must have a 'state_path' to use --incremental")
+
         # now get the directory extension, if any
         extension_config = self.get_directory_extension_options()
         options['extension_enabled'] = flags.get_flag('UST_EXTENSION')
@@ -22,6 +22,9 @@ import json
 import logging
 # import helper
 import math
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import jwt
 import umapi_client
@@ -35,6 +38,7 @@ from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
 from user_sync.connector.umapi_util import create_umapi_auth
 from user_sync.config import common as config_common
+from user_sync.cache.umapi import UmapiCache
 
 try:
     from jwt.contrib.algorithms.pycrypto import RSAAlgorithm
@@ -86,9 +90,16 @@ class UmapiConnector(object):
 
         server_builder.set_int_value('timeout', 120)
         server_builder.set_int_value('retries', 3)
+        server_builder.set_int_value('connections', 1)
         server_builder.set_value('ssl_verify', bool, None)
         options['server'] = server_options = server_builder.get_options()
 
+        cache_config = caller_config.get_dict_config('cache', True)
+        cache_builder = config_common.OptionsBuilder(cache_config)
+        cache_builder.set_string_value('path', None)
+        cache_builder.set_int_value('refresh_interval', None)
+        options['cache'] = cache_options = cache_builder.get_options()
+
         enterprise_config = caller_config.get_dict_config('enterprise')
         enterprise_builder = config_common.OptionsBuilder(enterprise_config)
         enterprise_builder.require_string_value('org_id')
@@ -103,6 +114,9 @@ class UmapiConnector(object):
         if enterprise_options[tech_field] is not None and options['authentication_method'] == 'oauth':
             raise AssertionException(f"'{tech_field}' should not be set for oauth authentication")
 
+        if server_options['connections'] < 1:
+            raise AssertionException("'connections' must be 1 or greater")
+
         # Override with old umapi entry if present
         if options['server']['ssl_verify'] is not None:
             options['ssl_cert_verify'] = options['server']['ssl_verify']
@@ -111,11 +125,16 @@ class UmapiConnector(object):
         self.logger = logging.getLogger(__name__)
         if server_config:
             server_config.report_unused_values(self.logger)
+        if cache_config:
+            cache_config.report_unused_values(self.logger)
         if self.uses_business_id is not None:
             self.logger.warning("NOTICE: uses_business_id is deprecated. Please remove it from your UMAPI config file.")
         self.logger.debug('UMAPI initialized with options: %s', options)
 
         self.org_id = org_id = enterprise_options['org_id']
+        self.cache = None
+        if cache_options['path'] is not None:
+            self.cache = UmapiCache(Path(cache_options['path']), org_id, cache_options['refresh_interval'])
         # open the connection
         um_endpoint = "https://" + server_options['host'] + server_options['endpoint']
         if self.create_conn:
@@ -132,22 +151,31 @@ class UmapiConnector(object):
                     options['authentication_method'],
                     self.logger,
                 )
-                self.connection = connection = umapi_client.Connection(
-                    org_id=org_id,
-                    auth=auth,
-                    endpoint=um_endpoint,
-                    test_mode=options['test_mode'],
-                    user_agent="user-sync/" + app_version,
-                    timeout=float(server_options['timeout']),
-                    max_retries=server_options['retries'],
-                    ssl_verify=options['ssl_cert_verify']
-                )
+
+                def create_connection():
+                    return umapi_client.Connection(
+                        org_id=org_id,
+                        auth=auth,
+                        endpoint=um_endpoint,
+                        test_mode=options['test_mode'],
+                        user_agent="user-sync/" + app_version,
+                        timeout=float(server_options['timeout']),
+                        max_retries=server_options['retries'],
+                        ssl_verify=options['ssl_cert_verify']
+                    )
+
+                self.connection = connection = create_connection()
+                # additional connections are only used to send actions concurrently.
+                # they share the auth object, so the access token is only fetched once
+                pool = [connection]
+                for _ in range(server_options['connections'] - 1):
+                    pool.append(create_connection())
 
             except Exception as e:
                 raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
             self.logger.debug('%s: connection established', self.name)
             # wrap the connection in an action manager
-            self.action_manager = ActionManager(connection, org_id, self.logger)
+            self.action_manager = ActionManager(connection, org_id, self.logger, pool)
         # this check must come after we fetch all the settings
         enterprise_config.report_unused_values(self.logger)
 
@@ -155,6 +183,43 @@ class UmapiConnector(object):
         return list(self.iter_users())
 
     def iter_users(self, in_group=None):
+        if self.cache is None:
+            yield from self.query_users(in_group)
+        elif not self.cache.should_refresh:
+            self.logger.debug('%s: reading users from cache', self.name)
+            yield from self.iter_cached_users(in_group)
+        elif in_group is None:
+            self.logger.debug('%s: refreshing user cache', self.name)
+            yield from self.refresh_cache()
+        else:
+            # a group query can't refresh the whole cache, so it goes straight to UMAPI
+            yield from self.query_users(in_group)
+
+    def iter_cached_users(self, in_group=None):
+        in_group = user_sync.helper.normalize_string(in_group)
+        for u in self.cache.get_users():
+            if in_group is None or in_group in {user_sync.helper.normalize_string(g) for g in u.get('groups', [])}:
+                yield u
+
+    def refresh_cache(self):
+        """
+        Read all users from UMAPI, replacing the cached users as we go.  The cache is only
+        marked as refreshed once every user has been read.
+        """
+        self.cache.clear_all()
+        batch = []
+        for u in self.query_users():
+            # store a copy, since the caller is free to modify the user it receives
+            batch.append(dict(u))
+            if len(batch) >= 1000:
+                self.cache.cache_users(batch)
+                batch = []
+            yield u
+        self.cache.cache_users(batch)
+        self.cache.should_refresh = False
+        self.cache.update_next_refresh()
+
+    def query_users(self, in_group=None):
         users = {}
         total_count = 0
         page_count = 0
@@ -179,6 +244,17 @@ class UmapiConnector(object):
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def get_user(self, user_string, domain=None):
+        """
+        Look up a single user by email or username; returns None if there's no such user
+        """
+        if self.cache is not None and not self.cache.should_refresh:
+            return self.cache.get_user(user_string, domain)
+        try:
+            return umapi_client.UserQuery(self.connection, user_string, domain).result() or None
+        except umapi_client.UnavailableError as e:
+            raise AssertionException("Error contacting UMAPI server: %s" % e)
+
     def get_groups(self):
         return list(self.iter_groups())
 
@@ -217,8 +293,73 @@ class UmapiConnector(object):
             action_manager = self.get_action_manager()
             action = action_manager.create_action(commands)
             if action is not None:
+                if self.cache is not None and not self.options['test_mode']:
+                    callback = self.cache_callback(commands, callback)
                 action_manager.add_action(action, callback)
 
+    def cache_callback(self, commands, callback=None):
+        """
+        Wrap an action callback so that the commands are also applied to the cache once they succeed
+        :type commands: Commands
+        :type callback: callable(dict)
+        """
+        def _callback(result):
+            if result['is_success']:
+                self.update_cache(commands)
+            if callable(callback):
+                callback(result)
+        return _callback
+
+    def update_cache(self, commands):
+        """
+        Apply the effect of successfully executed commands to the cached user
+        :type commands: Commands
+        """
+        user = self.cache.get_user(commands.user, commands.domain)
+        cached_email = user['email'] if user is not None else None
+        for command_name, params in commands.do_list:
+            if command_name == 'create':
+                if user is None:
+                    email = params['email']
+                    user = {
+                        'email': email,
+                        'username': commands.user,
+                        'domain': commands.domain or email[email.index('@') + 1:],
+                        'firstname': params.get('firstname'),
+                        'lastname': params.get('lastname'),
+                        'country': params.get('country'),
+                        'type': params.get('id_type'),
+                        'status': 'active',
+                        'groups': [],
+                    }
+                elif params.get('on_conflict') == umapi_client.IfAlreadyExistsOption.updateIfAlreadyExists:
+                    user.update({k: params[k] for k in ['firstname', 'lastname', 'country'] if k in params})
+            elif user is None:
+                # the user isn't cached yet, so it will be picked up on the next refresh
+                return
+            elif command_name == 'update':
+                user.update(params)
+            elif command_name == 'add_to_groups':
+                current_groups = {user_sync.helper.normalize_string(g) for g in user['groups']}
+                user['groups'].extend(g for g in params['groups']
+                                      if user_sync.helper.normalize_string(g) not in current_groups)
+            elif command_name == 'remove_from_groups':
+                if params.get('all_groups'):
+                    user['groups'] = []
+                else:
+                    groups_to_remove = {user_sync.helper.normalize_string(g) for g in params['groups']}
+                    user['groups'] = [g for g in user['groups']
+                                      if user_sync.helper.normalize_string(g) not in groups_to_remove]
+            elif command_name == 'remove_from_organization':
+                self.cache.delete_user(cached_email)
+                return
+        if user is None:
+            return
+        if cached_email is None:
+            self.cache.cache_user(user)
+        else:
+            self.cache.update_user(cached_email, user)
+
     def start_sync(self):
         """Send the start sync signal to the connector"""
         self.connection.start_sync()
@@ -308,18 +449,27 @@ class Commands(object):
 class ActionManager(object):
     next_request_id = 1
 
-    def __init__(self, connection, org_id, logger):
+    def __init__(self, connection, org_id, logger, pool=None):
         """
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type pool: list(umapi_client.Connection)
         """
         self.action_count = 0
         self.error_count = 0
         self.items = []
+        # the number of actions sent so far for the first item, when it was split across batches,
+        # and the batch-level error for those actions, if there was one
+        self.sent_parts = 0
+        self.pending_batch_error = None
         self.connection = connection
         self.org_id = org_id
         self.logger = logger.getChild('action')
+        # when there is more than one connection in the pool, actions are held in self.items
+        # and dispatched concurrently instead of being queued on the connection itself
+        self.pool = pool if pool else [connection]
+        self.dispatch = len(self.pool) > 1
 
     def get_statistics(self):
         """Return the count of actions sent so far, and how many had errors."""
@@ -359,22 +509,41 @@ class ActionManager(object):
         """
         item = {
             'action': action,
+            'parts': self.split_action(action),
             'callback': callback
         }
         self.items.append(item)
         self.action_count += 1
         self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
-        self._execute_action(action)
+        if not self.dispatch:
+            self._execute_action(item['parts'])
+        elif len(self.items) >= len(self.pool) * self.connection.throttle_actions:
+            self._dispatch_actions()
+
+    def split_action(self, action):
+        """
+        Split an action into the actions that will actually be sent, the same way the connection
+        would throttle it.  Doing this up front means we know how many of the actions in each
+        batch belong to each item, so results can be matched back to the right item.
+        Errors reported on the parts are still available from the original action.
+        :type action: umapi_client.UserAction
+        :rtype: list(umapi_client.Action)
+        """
+        action.maybe_split_groups(self.connection.throttle_groups)
+        if len(action.commands) > self.connection.throttle_commands:
+            return action.split(self.connection.throttle_commands)
+        return [action]
 
     def has_work(self):
         return len(self.items) > 0
 
-    def _execute_action(self, action):
+    def _execute_action(self, actions):
         """
-        :type action: umapi_client.UserAction
+        Queue the actions on the connection, which sends them whenever it has a full batch
+        :type actions: list(umapi_client.Action)
         """
         try:
-            _, sent, _ = self.connection.execute_single(action)
+            _, sent, _ = self.connection.execute_multiple(actions, immediate=False)
         except umapi_client.BatchError as e:
             self.process_sent_items(e.statistics[1], e)
         except umapi_client.UnavailableError as e:
@@ -382,7 +551,73 @@ class ActionManager(object):
         else:
             self.process_sent_items(sent)
 
+    def _dispatch_actions(self):
+        """
+        Send all held actions in batches, spreading the batches over the connection pool.
+        Results are processed in the order the actions were added, regardless of which
+        batch completes first.  If sending a batch raises, every batch is still waited for and
+        processed (the failed ones with the exception as their batch error), then the first
+        exception is raised.
+        """
+        batch_size = self.connection.throttle_actions
+        actions = [part for item in self.items for part in item['parts']]
+        batches = [actions[i:i + batch_size] for i in range(0, len(actions), batch_size)]
+        # the sync start signal has to go with the first batch and the sync end signal with
+        # the last one, and those signals are only ever set on the main connection
+        first_batch = batches.pop(0) if batches and self.connection.sync_started else None
+        last_batch = batches.pop() if batches and self.connection.sync_ended else None
+        if first_batch is not None:
+            self.process_sent_items(len(first_batch), self._send_batch(self.connection, first_batch))
+        if batches:
+            connections = queue.Queue()
+            for connection in self.pool:
+                connections.put(connection)
+            with ThreadPoolExecutor(max_workers=len(self.pool)) as executor:
+                futures = [executor.submit(self._send_pooled_batch, connections, batch) for batch in batches]
+            first_exception = None
+            for batch, future in zip(batches, futures):
+                exception = future.exception()
+                if exception is not None:
+                    first_exception = first_exception or exception
+                    self.process_sent_items(len(batch), exception)
+                else:
+                    self.process_sent_items(len(batch), future.result())
+            if first_exception is not None:
+                raise first_exception
+        if last_batch is not None:
+            self.process_sent_items(len(last_batch), self._send_batch(self.connection, last_batch))
+
+    def _send_pooled_batch(self, connections, actions):
+        """
+        :type connections: queue.Queue
+        :type actions: list(umapi_client.UserAction)
+        """
+        connection = connections.get()
+        try:
+            return self._send_batch(connection, actions)
+        finally:
+            connections.put(connection)
+
+    @staticmethod
+    def _send_batch(connection, actions):
+        """
+        Send a batch of actions right away, and return the batch-level error if there was one
+        :type connection: umapi_client.Connection
+        :type actions: list(umapi_client.UserAction)
+        :rtype: umapi_client.BatchError
+        """
+        try:
+            connection.execute_multiple(actions, immediate=True)
+        except umapi_client.BatchError as e:
+            return e
+        except umapi_client.UnavailableError as e:
+            raise AssertionException("Error contacting UMAPI server: %s" % e)
+        return None
+
     def flush(self):
+        if self.dispatch:
+            self._dispatch_actions()
+            return
         try:
             _, sent, _ = self.connection.execute_queued()
         except umapi_client.BatchError as e:
@@ -394,36 +629,53 @@ class ActionManager(object):
 
     def process_sent_items(self, total_sent, batch_error=None):
         """
-        Note items as sent, log any processing errors, and invoke any callbacks
-        :param total_sent: number of sent items from queue, must be >= 0
-        :param batch_error: exception for a batch-level error that affected all items, if there was one
+        Note items as sent, log any processing errors, and invoke any callbacks.
+        An item counts as sent once all the actions it was split into have been sent,
+        which can take more than one batch.
+        :param total_sent: number of actions sent from the queue, must be >= 0
+        :param batch_error: exception for a batch-level error that affected all actions sent, if there was one
         :return: 
         """
         # update queue
-        sent_items, self.items = self.items[:total_sent], self.items[total_sent:]
-
-        # collect sent actions, their errors, their callbacks
-        details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in sent_items]
+        self.sent_parts += total_sent
+        sent_count = 0
+        for item in self.items:
+            if len(item['parts']) > self.sent_parts:
+                break
+            self.sent_parts -= len(item['parts'])
+            sent_count += 1
+        sent_items, self.items = self.items[:sent_count], self.items[sent_count:]
+
+        # collect sent actions, their errors, the batch error that affected them (if any), their callbacks
+        details = [(item['action'], item['action'].execution_errors(), batch_error, item['callback'])
+                   for item in sent_items]
+        # the first item may have had parts sent in an earlier batch that failed
+        if details and self.pending_batch_error is not None:
+            action, errors, error, callback = details[0]
+            details[0] = (action, errors, error or self.pending_batch_error, callback)
+            self.pending_batch_error = None
+        # and the item still waiting for its remaining parts may have had parts sent in this batch
+        if batch_error and self.sent_parts:
+            self.pending_batch_error = batch_error
 
         # log errors
-        if batch_error:
-            request_ids = str([action.frame.get("requestID") for action, _, _ in details])
-            self.logger.critical("Unexpected response! Sent actions %s may have failed: %s", request_ids, batch_error)
-            self.error_count += total_sent
-        else:
-            for action, errors, _ in details:
-                if errors:
-                    self.error_count += 1
-                    for error in errors:
-                        self.logger.error('Error in requestID: %s (User: %s, Command: %s): code: "%s" message: "%s"',
-                                          action.frame.get("requestID"),
-                                          error.get("target", "<Unknown>"), error.get("command", "<Unknown>"),
-                                          error.get('errorCode', "<None>"), error.get('message', "<None>"))
+        for action, errors, error, _ in details:
+            if error:
+                self.logger.critical("Unexpected response! Sent action %s may have failed: %s",
+                                     action.frame.get("requestID"), error)
+                self.error_count += 1
+            elif errors:
+                self.error_count += 1
+                for e in errors:
+                    self.logger.error('Error in requestID: %s (User: %s, Command: %s): code: "%s" message: "%s"',
+                                      action.frame.get("requestID"),
+                                      e.get("target", "<Unknown>"), e.get("command", "<Unknown>"),
+                                      e.get('errorCode', "<None>"), e.get('message', "<None>"))
         # invoke callbacks
-        for action, errors, callback in details:
+        for action, errors, error, callback in details:
             if callable(callback):
                 callback({
                     "action": action,
-                    "is_success": not batch_error and not errors,
-                    "errors": [batch_error] if batch_error else errors
+                    "is_success": not error and not errors,
+                    "errors": [error] if error else errors
                 })
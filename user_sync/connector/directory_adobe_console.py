@@ -128,8 +128,9 @@ class AdobeConsoleConnector(DirectoryConnector):
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
         logger.debug('%s: connection established', self.name)
-        self.umapi_users = []
         self.user_by_usr_key = {}
+        # keys of the members of each (lowercase) group, built by load_umapi_users
+        self.user_keys_by_group = {}
 
     def set_additional_group_filters(self, _):
         pass
@@ -147,7 +148,7 @@ class AdobeConsoleConnector(DirectoryConnector):
 
         # Loading all the groups because UMAPI doesn't support group query. DOH!
         self.logger.info('Loading groups...')
-        umapi_groups = [g.lower() for g in self.iter_umapi_groups()]
+        umapi_groups = {g.lower() for g in self.iter_umapi_groups()}
         self.logger.info('Loading users...')
 
         # Loading all umapi users based on ID Type first before doing group filtering
@@ -223,27 +224,39 @@ class AdobeConsoleConnector(DirectoryConnector):
             raise AssertionException("Error to query groups from Adobe Console: %s" % e)
 
     def iter_group_members(self, group):
-        umapi_users = self.umapi_users
-        members = filter(lambda u: ('groups' in u and group.lower() in [g.lower() for g in u['groups']]), umapi_users)
-        for member in members:
-            user_key = self.generate_user_key(member['type'], member['username'], member['domain'])
-            yield user_key
+        yield from self.user_keys_by_group.get(group.lower(), ())
 
     def load_umapi_users(self, identity_type):
         try:
-            u_query = umapi_client.UsersQuery(self.connection)
-            umapi_users = u_query.all_results()
-
-            if not identity_type == 'all':
-                umapi_users = list(filter(lambda usr: usr['type'] == identity_type, umapi_users))
-
-            self.umapi_users = umapi_users
-            for user in umapi_users:
+            # index the users by group as they are loaded, so that the members of a group can be looked up
+            self.user_keys_by_group = user_keys_by_group = {}
+            for user in self.iter_umapi_users():
+                if not identity_type == 'all' and not user['type'] == identity_type:
+                    continue
                 # Generate unique user key because Username/Email is a bad unique identifier
                 user_key = self.generate_user_key(user['type'], user['username'], user['domain'])
                 self.user_by_usr_key[user_key] = self.convert_user(user)
+                for group in {g.lower() for g in user.get('groups') or ()}:
+                    user_keys_by_group.setdefault(group, []).append(user_key)
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def iter_umapi_users(self):
+        """
+        Yield the users of the org a page at a time.  Unlike iterating a UsersQuery, which keeps every page
+        it has read, this only holds on to one page of raw users.
+        :rtype iterator(dict)
+        """
+        u_query = umapi_client.UsersQuery(self.connection)
+        page = 0
+        last_page = False
+        while not last_page:
+            users, last_page = self.connection.query_multiple(u_query.object_type, page, u_query.url_params,
+                                                              u_query.query_params)[:2]
+            if not users:
+                break
+            yield from users
+            page += 1
+
     def generate_user_key(self, identity_type, username, domain):
         return '%s,%s,%s' % (normalize_string(identity_type), normalize_string(username), normalize_string(domain))
@@ -18,18 +18,25 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from itertools import groupby
+from operator import itemgetter
+
 import user_sync.connector.helper
 import user_sync.error
 import user_sync.identity_type
 from user_sync.connector.directory import DirectoryConnector
 from user_sync.config.common import DictConfig, OptionsBuilder
-from user_sync.helper import CSVAdapter
+from user_sync.helper import CSVAdapter, ExternalSorter
 from user_sync.config import user_sync as config
 from user_sync.config import common as config_common
 
 
 class CSVDirectoryConnector(DirectoryConnector):
     name = 'csv'
+    # options naming the columns of the user fields, in the order they appear if there is no header row
+    column_name_options = ('email_column_name', 'first_name_column_name', 'last_name_column_name',
+                           'country_column_name', 'groups_column_name', 'identity_type_column_name',
+                           'username_column_name', 'domain_column_name')
 
     def __init__(self, caller_options, *args, **kwargs):
         super(CSVDirectoryConnector, self).__init__(*args, **kwargs)
@@ -47,8 +54,13 @@ class CSVDirectoryConnector(DirectoryConnector):
         builder.set_string_value('identity_type_column_name', 'type')
         builder.set_string_value('user_identity_type', None)
         builder.set_string_value('logger_name', self.name)
+        builder.set_bool_value('memory_map', False)
+        builder.set_string_value('streaming_mode', None)
         builder.require_string_value('file_path')
         options = builder.get_options()
+        if options['streaming_mode'] not in (None, 'single_row', 'sorted', 'sort'):
+            raise user_sync.error.AssertionException(
+                "'streaming_mode' must be one of: single_row, sorted, sort (got '%s')" % options['streaming_mode'])
         self.options = options
         self.logger = logger = user_sync.connector.helper.create_logger(options)
         logger.debug('%s initialized with options: %s', self.name, options)
@@ -69,6 +81,8 @@ class CSVDirectoryConnector(DirectoryConnector):
         options = self.options
         file_path = options['file_path']
         self.logger.debug('Reading from: %s', file_path)
+        if options['streaming_mode'] is not None:
+            return self.iter_users(file_path, extended_attributes)
         self.users = users = self.read_users(file_path, extended_attributes)
         self.logger.debug('Number of users loaded: %d', len(users))
         return users.values()
@@ -80,97 +94,151 @@ class CSVDirectoryConnector(DirectoryConnector):
         :rtype dict
         """
         users = {}
+        column_names, recognized_column_names = self.get_column_names(extended_attributes)
+        for email, row in self.iter_rows(file_path, recognized_column_names):
+            user = users.get(email)
+            if user is None:
+                user = self.create_user(email)
+                users[email] = user
+            if not self.update_user(user, row, column_names, recognized_column_names):
+                del users[email]
+        return users
 
-        options = self.options
-        logger = self.logger
-
-        recognized_column_names = []
-
-        def get_column_name(key):
-            column_name = options[key]
-            recognized_column_names.append(column_name)
-            return column_name
-
-        email_column_name = get_column_name('email_column_name')
-        first_name_column_name = get_column_name('first_name_column_name')
-        last_name_column_name = get_column_name('last_name_column_name')
-        country_column_name = get_column_name('country_column_name')
-        groups_column_name = get_column_name('groups_column_name')
-        identity_type_column_name = get_column_name('identity_type_column_name')
-        username_column_name = get_column_name('username_column_name')
-        domain_column_name = get_column_name('domain_column_name')
-
+    def iter_users(self, file_path, extended_attributes):
+        """
+        Yield the users as the rows are read, according to the streaming mode: with 'single_row', each row
+        is a user; with 'sorted', the rows of each user are next to each other; and with 'sort', the rows are
+        first sorted by email (spilling to temporary files for big files).  Only the rows of one user are held
+        in memory, except while sorting.
+        :type file_path
+        :type extended_attributes: list
+        :rtype iterator(dict)
+        """
+        streaming_mode = self.options['streaming_mode']
+        column_names, recognized_column_names = self.get_column_names(extended_attributes)
+        rows = self.iter_rows(file_path, recognized_column_names)
+        if streaming_mode == 'single_row':
+            user_rows = ((email, (row,)) for email, row in rows)
+        else:
+            if streaming_mode == 'sort':
+                rows = ExternalSorter(key=itemgetter(0)).sort(rows)
+            user_rows = ((email, (row for _, row in group)) for email, group in groupby(rows, key=itemgetter(0)))
+        users_loaded = 0
+        for email, rows_of_user in user_rows:
+            user = None
+            for row in rows_of_user:
+                if user is None:
+                    user = self.create_user(email)
+                if not self.update_user(user, row, column_names, recognized_column_names):
+                    user = None
+            if user is not None:
+                users_loaded += 1
+                yield user
+        self.logger.debug('Number of users loaded: %d', users_loaded)
+
+    def get_column_names(self, extended_attributes):
+        """
+        Get the column names of the user fields (by option name), and the list of all the recognized column names
+        :type extended_attributes: list
+        :rtype (dict(str, str), list(str))
+        """
+        column_names = {key: self.options[key] for key in self.column_name_options}
         # extended attributes appear after the standard ones (if no header row)
-        recognized_column_names += extended_attributes
+        recognized_column_names = list(column_names.values()) + list(extended_attributes or [])
+        return column_names, recognized_column_names
 
+    def iter_rows(self, file_path, recognized_column_names):
+        """
+        Yield (email, row) for each row of the file that has a valid email
+        :type file_path
+        :type recognized_column_names: list(str)
+        :rtype iterator(str, dict)
+        """
+        options = self.options
+        logger = self.logger
+        email_column_name = options['email_column_name']
         line_read = 0
-        rows = CSVAdapter.read_csv_rows(file_path,
-                                        recognized_column_names=recognized_column_names,
-                                        logger=logger,
-                                        encoding=self.encoding,
-                                        delimiter=options['delimiter'])
+        rows = CSVAdapter.read_rows(file_path,
+                                    recognized_column_names=recognized_column_names,
+                                    logger=logger,
+                                    encoding=self.encoding,
+                                    delimiter=options['delimiter'],
+                                    only_recognized_columns=True,
+                                    memory_map=options['memory_map'])
         for row in rows:
             line_read += 1
             email = self.get_column_value(row, email_column_name)
             if email is None or email.find('@') < 0:
                 logger.warning('Missing or invalid email at row: %d; skipping', line_read)
                 continue
+            yield email, row
 
-            user = users.get(email)
-            if user is None:
-                user = user_sync.connector.helper.create_blank_user()
-                user['email'] = email
-                users[email] = user
-
-            first_name = self.get_column_value(row, first_name_column_name)
-            if first_name is not None:
-                user['firstname'] = first_name
-            else:
-                logger.debug('No value firstname for: %s', email)
-
-            last_name = self.get_column_value(row, last_name_column_name)
-            if last_name is not None:
-                user['lastname'] = last_name
-            else:
-                logger.debug('No value lastname for: %s', email)
-
-            country = self.get_column_value(row, country_column_name)
-            if country is not None:
-                user['country'] = country.upper()
-
-            groups = self.get_column_value(row, groups_column_name)
-            if groups is not None:
-                user['groups'].extend(groups.split(','))
-                user['member_groups'] = user['groups']
-
-            username = self.get_column_value(row, username_column_name)
-            if username is None:
-                username = email
-            user['username'] = username
-
-            identity_type = self.get_column_value(row, identity_type_column_name)
-            if identity_type:
-                try:
-                    user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
-                except user_sync.error.AssertionException as e:
-                    self.logger.warning('Skipping user %s: %s', username, e)
-                    del users[email]
-                    continue
-            else:
-                user['identity_type'] = self.user_identity_type
-
-            domain = self.get_column_value(row, domain_column_name)
-            if domain:
-                user['domain'] = domain
-            elif username != email:
-                user['domain'] = email[email.find('@') + 1:]
-
-            sa = {}
-            for col in recognized_column_names:
-                sa[col] = self.get_column_value(row, col)
-            user['source_attributes'] = sa
+    @staticmethod
+    def create_user(email):
+        """
+        :type email: str
+        :rtype dict
+        """
+        user = user_sync.connector.helper.create_blank_user()
+        user['email'] = email
+        return user
 
-        return users
+    def update_user(self, user, row, column_names, recognized_column_names):
+        """
+        Update a user with the values of one of its rows.  Returns False if the row makes the user invalid.
+        :type user: dict
+        :type row: dict
+        :type column_names: dict(str, str)
+        :type recognized_column_names: list(str)
+        :rtype bool
+        """
+        logger = self.logger
+        email = user['email']
+
+        first_name = self.get_column_value(row, column_names['first_name_column_name'])
+        if first_name is not None:
+            user['firstname'] = first_name
+        else:
+            logger.debug('No value firstname for: %s', email)
+
+        last_name = self.get_column_value(row, column_names['last_name_column_name'])
+        if last_name is not None:
+            user['lastname'] = last_name
+        else:
+            logger.debug('No value lastname for: %s', email)
+
+        country = self.get_column_value(row, column_names['country_column_name'])
+        if country is not None:
+            user['country'] = country.upper()
+
+        groups = self.get_column_value(row, column_names['groups_column_name'])
+        if groups is not None:
+            user['groups'].extend(groups.split(','))
+            user['member_groups'] = user['groups']
+
+        username = self.get_column_value(row, column_names['username_column_name'])
+        if username is None:
+            username = email
+        user['username'] = username
+
+        identity_type = self.get_column_value(row, column_names['identity_type_column_name'])
+        if identity_type:
+            try:
+                user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
+            except user_sync.error.AssertionException as e:
+                self.logger.warning('Skipping user %s: %s', username, e)
+                return False
+        else:
+            user['identity_type'] = self.user_identity_type
+
+        domain = self.get_column_value(row, column_names['domain_column_name'])
+        if domain:
+            user['domain'] = domain
+        elif username != email:
+            user['domain'] = email[email.find('@') + 1:]
+
+        user['source_attributes'] = {col: row.get(col) or None for col in recognized_column_names}
+        return True
 
     def set_additional_group_filters(self, _):
         pass
@@ -18,7 +18,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import json
+import queue
+import re
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import ldap3
 
@@ -33,11 +39,22 @@ from user_sync.config import common as config_common
 
 import platform
 import ssl
+from pathlib import Path
+
+from user_sync.cache.ldap import LDAPGroupCache, LDAPSnapshotCache
 
 
 class LDAPDirectoryConnector(DirectoryConnector):
     name = 'ldap'
 
+    pool_strategies = {
+        'first': ldap3.FIRST,
+        'random': ldap3.RANDOM,
+        'round_robin': ldap3.ROUND_ROBIN,
+    }
+    # seconds that a server pool leaves a server that didn't answer out, before trying it again
+    pool_exhaust_time = 60
+
     def __init__(self, caller_options, *args, **kwargs):
         super(LDAPDirectoryConnector, self).__init__(*args, **kwargs)
         caller_config = DictConfig('%s configuration' % self.name, caller_options)
@@ -47,6 +64,9 @@ class LDAPDirectoryConnector(DirectoryConnector):
 
         self.logger = logger = user_sync.connector.helper.create_logger(options)
         logger.debug('%s initialized with options: %s', self.name, options)
+        if options['incremental_lookup'] and len(options['hosts']) > 1 and options['pool_strategy'] != 'first':
+            logger.warning("With 'incremental_lookup', a '%s' pool_strategy rebuilds the snapshot whenever a run "
+                           "connects to a different server than the last one", options['pool_strategy'])
 
         LDAPValueFormatter.encoding = options['string_encoding']
         self.user_identity_type = user_sync.identity_type.parse_identity_type(options['user_identity_type'])
@@ -57,6 +77,14 @@ class LDAPDirectoryConnector(DirectoryConnector):
         self.user_given_name_formatter = LDAPValueFormatter(options['user_given_name_format'])
         self.user_surname_formatter = LDAPValueFormatter(options['user_surname_format'])
         self.user_country_code_formatter = LDAPValueFormatter(options['user_country_code_format'])
+        # the attributes needed for the user fields never change, so they are only listed once
+        self.user_attribute_names = []
+        for formatter in (self.user_given_name_formatter, self.user_surname_formatter,
+                          self.user_country_code_formatter, self.user_identity_type_formatter,
+                          self.user_email_formatter, self.user_username_formatter, self.user_domain_formatter):
+            self.user_attribute_names.extend(formatter.get_attribute_names())
+        if options['dynamic_group_member_attribute'] is not None:
+            self.user_attribute_names.append(str(options['dynamic_group_member_attribute']))
 
         auth_method = options['authentication_method'].lower()
         auth_cred_required = ['simple', 'ntlm']
@@ -104,16 +132,49 @@ class LDAPDirectoryConnector(DirectoryConnector):
         auto_bind = ldap3.AUTO_BIND_NO_TLS
         if options['require_tls_cert']:
             tls = ldap3.Tls(validate=ssl.CERT_REQUIRED, version=ssl.PROTOCOL_TLSv1_2)
+        connection_options = dict(auth)
+        if options['timeout'] is not None:
+            connection_options['receive_timeout'] = options['timeout']
+        if options['reconnect_tries'] > 0:
+            # a restartable connection reopens (and rebinds) itself when an operation fails
+            connection_options['client_strategy'] = ldap3.RESTARTABLE
         try:
-            server = ldap3.Server(host=options['host'], allowed_referral_hosts=True, tls=tls)
-            if server.ssl is False and tls is not None:
+            servers = [ldap3.Server(host=host, allowed_referral_hosts=True, tls=tls, connect_timeout=options['timeout'])
+                       for host in options['hosts']]
+            if any(server.ssl is False for server in servers) and tls is not None:
                 auto_bind = ldap3.AUTO_BIND_TLS_BEFORE_BIND
-            connection = Connection(server, auto_bind=auto_bind, read_only=True, **auth)
+            if len(servers) == 1:
+                server = servers[0]
+            else:
+                # an active pool checks that a server is up before connecting to it, and moves on to the next if not.
+                # it goes round the servers once more for each reconnect try, then fails rather than waiting forever
+                server = ldap3.ServerPool(servers, pool_strategy=self.pool_strategies[options['pool_strategy']],
+                                          active=options['reconnect_tries'] + 1, exhaust=self.pool_exhaust_time)
+
+            def create_connection():
+                connection = Connection(server, auto_bind=auto_bind, read_only=True, **connection_options)
+                if options['reconnect_tries'] > 0:
+                    connection.strategy.restartable_tries = options['reconnect_tries']
+                return connection
+
+            # additional connections are only used to search concurrently
+            pool = LDAPConnectionPool(create_connection, options['connections'])
         except Exception as e:
             raise AssertionException('LDAP connection failure: %s' % e)
-        self.connection = connection
+        self.connection = connection = pool.connections[0]
+        self.pool = pool
         logger.debug('Connected as %s', connection.extend.standard.who_am_i())
+        self.group_cache = None
+        if options['cache']['path'] is not None:
+            self.group_cache = LDAPGroupCache(Path(options['cache']['path']), options['cache']['refresh_interval'])
+        self.snapshot = None
+        if options['incremental_lookup']:
+            self.snapshot = LDAPSnapshotCache(Path(options['cache']['path']), options['cache']['refresh_interval'])
         self.user_by_dn = {}
+        # two-step lookup memos: the members listed in each DN read so far, and the user (or None) found for each
+        # member DN, so that neither is read more than once however many groups they appear in
+        self.member_dns_by_dn = {}
+        self.user_by_member_dn = {}
         self.additional_group_filters = None
 
     def set_additional_group_filters(self, additional_group_filters):
@@ -134,6 +195,9 @@ class LDAPDirectoryConnector(DirectoryConnector):
         builder.set_string_value('group_member_filter_format', None)
         builder.set_bool_value('require_tls_cert', False)
         builder.set_dict_value('two_steps_lookup', None)
+        builder.set_bool_value('single_pass_lookup', False)
+        builder.set_bool_value('incremental_lookup', False)
+        builder.set_string_value('member_of_attribute', str('memberOf'))
         builder.set_string_value('string_encoding', 'utf8')
         builder.set_string_value('user_identity_type_format', None)
         builder.set_string_value('user_email_format', str('{mail}'))
@@ -145,13 +209,50 @@ class LDAPDirectoryConnector(DirectoryConnector):
         builder.set_string_value('dynamic_group_member_attribute', None)
         builder.set_string_value('user_identity_type', None)
         builder.set_int_value('search_page_size', 200)
+        builder.set_int_value('connections', 1)
+        builder.set_int_value('group_lookup_batch_size', 100)
         builder.set_string_value('logger_name', LDAPDirectoryConnector.name)
         builder.set_string_value('authentication_method', str('simple'))
         builder.set_string_value('username', None)
-        builder.require_string_value('host')
+        builder.require_value('host', (str, list))
+        builder.set_string_value('pool_strategy', str('first'))
+        builder.set_value('timeout', int, None)
+        builder.set_int_value('reconnect_tries', 0)
         builder.require_string_value('base_dn')
         options = builder.get_options()
 
+        cache_config = caller_config.get_dict_config('cache', True)
+        cache_builder = config_common.OptionsBuilder(cache_config)
+        cache_builder.set_string_value('path', None)
+        cache_builder.set_int_value('refresh_interval', None)
+        cache_builder.set_int_value('deletion_check_interval', None)
+        options['cache'] = cache_builder.get_options()
+
+        if options['connections'] < 1:
+            raise AssertionException("'connections' must be 1 or greater")
+        options['hosts'] = [str(options['host'])] if isinstance(options['host'], str) else \
+            [str(host) for host in options['host']]
+        if not options['hosts']:
+            raise AssertionException("'host' must name at least one server")
+        options['pool_strategy'] = options['pool_strategy'].lower()
+        if options['pool_strategy'] not in LDAPDirectoryConnector.pool_strategies:
+            raise AssertionException("'pool_strategy' must be one of: %s" %
+                                     ', '.join(sorted(LDAPDirectoryConnector.pool_strategies)))
+
+        if options['single_pass_lookup']:
+            if options['two_steps_lookup'] is not None:
+                raise AssertionException("Cannot enable both 'single_pass_lookup' and 'two_steps_lookup' in config")
+            if options['group_member_filter_format']:
+                raise AssertionException(
+                    "Cannot define both 'single_pass_lookup' and 'group_member_filter_format' in config")
+
+        if options['incremental_lookup']:
+            if options['cache']['path'] is None:
+                raise AssertionException("'incremental_lookup' requires a cache 'path' to keep the directory snapshot in")
+            if options['two_steps_lookup'] is not None or options['single_pass_lookup']:
+                raise AssertionException(
+                    "Cannot enable 'incremental_lookup' with 'two_steps_lookup' or 'single_pass_lookup' in config")
+
         options['two_steps_enabled'] = False
         if options['two_steps_lookup'] is not None:
             ts_config = caller_config.get_dict_config('two_steps_lookup', True)
@@ -176,87 +277,392 @@ class LDAPDirectoryConnector(DirectoryConnector):
         :rtype (bool, iterable(dict))
         """
         options = self.options
-        user = {}
         base_dn = str(options['base_dn'])
         all_users_filter = str(options['all_users_filter'])
-        group_member_filter_format = str(options['group_member_filter_format'])
-        grouped_user_records = {}
         if options['two_steps_enabled']:
             group_member_attribute_name = str(options['two_steps_lookup']['group_member_attribute_name'])
 
-        # save all the users to memory for faster 2-steps lookup or all_users process
+        group_dns = self.resolve_group_dns(groups)
+
+        # in incremental mode, users are read from a local snapshot which is brought up to date first
+        if options['incremental_lookup']:
+            return self.load_users_incremental(groups, group_dns, extended_attributes, all_users)
+
+        # in single pass mode, all users and their groups are read with a single search
+        if all_users and options['single_pass_lookup']:
+            return self.load_users_single_pass(groups, group_dns, extended_attributes)
+
+        # if all users are requested, they are all read (once) before group membership is resolved,
+        # so the group searches only have to find out which of the users already read are members
         if all_users:
             try:
-                all_users_records = dict(self.iter_users(base_dn, all_users_filter, extended_attributes))
+                for _ in self.iter_users(base_dn, all_users_filter, extended_attributes):
+                    pass
             except Exception as e:
                 raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
 
         # for each group that's required, do one search for the users of that group
-        for group in groups:
-            group_users = 0
-            group_dn = self.find_ldap_group_dn(group)
-            if not group_dn:
-                self.logger.warning("No group found for: %s", group)
-                continue
-            group_member_subfilter = self.format_ldap_query_string(group_member_filter_format, group_dn=group_dn)
-            if not group_member_subfilter.startswith('('):
-                group_member_subfilter = str('(') + group_member_subfilter + str(')')
-            user_subfilter = all_users_filter
-            if not user_subfilter.startswith('('):
-                user_subfilter = str('(') + user_subfilter + str(')')
-            group_user_filter = str('(&') + group_member_subfilter + user_subfilter + str(')')
+        if options['two_steps_enabled']:
+            for group, group_dn in group_dns.items():
+                group_users = 0
+                # check to make sure user_dn are within the base_dn scope
+                member_dns = [user_dn for user_dn in self.iter_group_member_dns(group_dn, group_member_attribute_name)
+                              if self.is_dn_within_base_dn_scope(base_dn, user_dn)]
+                try:
+                    for user in self.iter_member_users(member_dns, extended_attributes):
+                        user['groups'].append(group)
+                        group_users += 1
+                except Exception as e:
+                    raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+                self.logger.debug('Count of users in group "%s": %d', group, group_users)
+        else:
+            if all_users:
+                # only the DNs of the members are needed
+                user_attribute_names, extra_attributes = [ldap3.NO_ATTRIBUTES], []
+            else:
+                user_attribute_names, extra_attributes = self.get_user_attribute_names(extended_attributes)
+            for group, result_iter in self.iter_group_search_results(group_dns, user_attribute_names):
+                group_users = 0
+                try:
+                    if all_users:
+                        members = ((dn, self.user_by_dn[dn]) for dn, _ in result_iter if dn in self.user_by_dn)
+                    else:
+                        members = self.iter_user_records(result_iter, extra_attributes)
+                    for user_dn, user in members:
+                        user['groups'].append(group)
+                        group_users += 1
+                except Exception as e:
+                    raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+                self.logger.debug('Count of users in group "%s": %d', group, group_users)
+
+        if all_users and groups:
+            self.log_grouped_user_counts()
+        self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
+        return self.user_by_dn.values()
+
+    def log_grouped_user_counts(self):
+        grouped_users = sum(1 for user in self.user_by_dn.values() if user['groups'])
+        self.logger.debug('Count of users in any groups: %d', grouped_users)
+        self.logger.debug('Count of users not in any groups: %d', len(self.user_by_dn) - grouped_users)
+
+    def load_users_incremental(self, groups, group_dns, extended_attributes, all_users):
+        """
+        Load users from the directory snapshot, after bringing it up to date with only the entries that
+        changed since the last run.  The group member searches only ask for DNs, since the snapshot has the
+        attributes: they still have to be run every time because a change in membership changes the group
+        entry, not the user entry.  See update_snapshot for when the snapshot is rebuilt, and how deleted
+        users are found.
+        :type groups: list(str)
+        :type group_dns: dict(str, str)
+        :type extended_attributes: list(str)
+        :type all_users: bool
+        :rtype iterable(dict)
+        """
+        user_attribute_names, extra_attributes = self.get_user_attribute_names(extended_attributes)
+        try:
+            records = self.update_snapshot(user_attribute_names)
+        except AssertionException:
+            raise
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading changed users: %s' % e)
+        if all_users:
+            for _ in self.iter_user_records(iter(records.items()), extra_attributes):
+                pass
+
+        for group, result_iter in self.iter_group_search_results(group_dns, [ldap3.NO_ATTRIBUTES]):
             group_users = 0
             try:
-                if options['two_steps_enabled']:
-                    for user_dn in self.iter_group_member_dns(group_dn, group_member_attribute_name):
-                        # check to make sure user_dn are within the base_dn scope
-                        if self.is_dn_within_base_dn_scope(base_dn, user_dn):
-                            # replace base_dn with user_dn and filter with all_users_filter to do user lookup based on DN
-                            result = list(self.iter_users(user_dn, all_users_filter, extended_attributes))
-                            if result:
-                                # iter_users should only return 1 user when doing two_steps lookup.
-                                if len(result) > 1:
-                                    raise AssertionException(
-                                        "Unexpected multiple LDAP object found in 'two_steps_lookup' mode for: %s" % user_dn)
-                                else:
-                                    user = result[0][1]
-                                    user['groups'].append(group)
-                                    group_users += 1
-                                    grouped_user_records[user_dn] = user
-                else:
-                    for user_dn, user in self.iter_users(base_dn, group_user_filter, extended_attributes):
+                for user_dn, _ in result_iter:
+                    if user_dn not in self.user_by_dn and user_dn in records:
+                        for _ in self.iter_user_records([(user_dn, records[user_dn])], extra_attributes):
+                            pass
+                    user = self.user_by_dn.get(user_dn)
+                    if user is not None:
                         user['groups'].append(group)
                         group_users += 1
-                        grouped_user_records[user_dn] = user
             except Exception as e:
                 raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
             self.logger.debug('Count of users in group "%s": %d', group, group_users)
 
-        # if all users are requested, do an additional search for all of them
-        if all_users:
-            ungrouped_users = 0
-            grouped_users = 0
-            try:
-                for user_dn, user in self.iter_users(base_dn, all_users_filter, extended_attributes):
-                    if not user['groups']:
-                        ungrouped_users += 1
-                    else:
-                        grouped_users += 1
-                if groups:
-                    self.logger.debug('Count of users in any groups: %d', grouped_users)
-                    self.logger.debug('Count of users not in any groups: %d', ungrouped_users)
-            except Exception as e:
-                raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+        if all_users and groups:
+            self.log_grouped_user_counts()
+        self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
+        return self.user_by_dn.values()
+
+    def update_snapshot(self, attributes):
+        """
+        Bring the directory snapshot up to date, and return its records by DN.  The whole directory is read
+        when there's no usable snapshot: the first time, after the cache refresh interval, when the search
+        settings have changed, or when connected to a different server (change numbers are local to each
+        server, so with a round_robin or random pool_strategy this happens whenever the server changes).
+        Otherwise only the entries with a uSNChanged above the last high-water mark are read again.
+        Deleted (and moved) entries leave no changed entry behind, so they stay in the snapshot until the
+        next rebuild, or until the next deletion check when the cache has a deletion_check_interval: that
+        lists the DNs (only) of all the users, and drops the entries that are no longer listed.
+        :type attributes: list(str)
+        :rtype dict(str, dict)
+        """
+        snapshot = self.snapshot
+        base_dn = str(self.options['base_dn'])
+        all_users_filter = str(self.options['all_users_filter'])
+        if not all_users_filter.startswith('('):
+            all_users_filter = str('(') + all_users_filter + str(')')
+        # the high-water mark is read first, so that changes made during the search are read again next time
+        server_name, high_water_mark = self.get_high_water_mark()
+        signature = json.dumps([base_dn, all_users_filter, sorted(attributes), server_name])
+        state = snapshot.get_state()
+        now = time.time()
+        deletions_checked = now
+        if snapshot.should_refresh or state.get('signature') != signature:
+            self.logger.info('Reading all users to rebuild the directory snapshot')
+            snapshot.clear_all()
+            records = dict((dn, record) for dn, record in
+                           self.iter_search_result(base_dn, ldap3.SUBTREE, all_users_filter, attributes)
+                           if dn is not None)
+            snapshot.update_records(records)
+            snapshot.should_refresh = False
+            snapshot.update_next_refresh()
+        else:
+            records = snapshot.get_records()
+            deletion_check_interval = self.options['cache']['deletion_check_interval']
+            deletions_checked = float(state.get('deletions_checked', 0))
+            user_dns = None
+            if deletion_check_interval is not None and now - deletions_checked >= deletion_check_interval:
+                # deleted entries have no uSNChanged to find them by, so whichever users are no longer listed are gone
+                self.logger.info('Listing all users to find the ones deleted from the directory')
+                user_dns = set(dn for dn, _ in
+                               self.iter_search_result(base_dn, ldap3.SUBTREE, all_users_filter,
+                                                       [ldap3.NO_ATTRIBUTES])
+                               if dn is not None)
+                deletions_checked = now
+            changed_filter = str('(uSNChanged>=%d)' % (int(state['high_water_mark']) + 1))
+            changed_dns = [dn for dn, _ in
+                           self.iter_search_result(base_dn, ldap3.SUBTREE, changed_filter, [ldap3.NO_ATTRIBUTES])
+                           if dn is not None]
+            # changed entries may no longer be users (or never were), so they're read again with the users filter
+            changed_records = {}
+            batch_size = 100
+            for i in range(0, len(changed_dns), batch_size):
+                dn_filter = str('').join(self.format_ldap_query_string('(distinguishedName={dn})', dn=dn)
+                                         for dn in changed_dns[i:i + batch_size])
+                filter_string = str('(&') + all_users_filter + str('(|') + dn_filter + str('))')
+                for dn, record in self.iter_search_result(base_dn, ldap3.SUBTREE, filter_string, attributes):
+                    if dn is not None:
+                        changed_records[dn] = record
+            # users added since the DNs were listed are kept, as they were read with the changed entries
+            deleted_dns = [] if user_dns is None else \
+                [dn for dn in records if dn not in user_dns and dn not in changed_records]
+            snapshot.update_records(changed_records, changed_dns + deleted_dns)
+            for dn in changed_dns + deleted_dns:
+                records.pop(dn, None)
+            records.update(changed_records)
+            self.logger.debug('Changed entries since the last run: %d (users: %d), deleted users: %d',
+                              len(changed_dns), len(changed_records), len(deleted_dns))
+        snapshot.set_state({'signature': signature, 'high_water_mark': str(high_water_mark),
+                            'deletions_checked': str(deletions_checked)})
+        return records
+
+    def get_high_water_mark(self):
+        """
+        Get the name of the directory server and the highest change number it has committed
+        :rtype (str, int)
+        """
+        connection = self.connection
+        try:
+            connection.search(search_base='', search_filter='(objectClass=*)', search_scope=ldap3.BASE,
+                              attributes=['dsServiceName', 'highestCommittedUSN'])
+            record = connection.entries[0].entry_attributes_as_dict
+            server_name = LDAPValueFormatter.get_attribute_value(record, 'dsServiceName', first_only=True)
+            high_water_mark = int(LDAPValueFormatter.get_attribute_value(record, 'highestCommittedUSN',
+                                                                         first_only=True))
+        except Exception as e:
+            raise AssertionException("'incremental_lookup' needs an Active Directory server, "
+                                     "but the highest committed USN could not be read: %s" % e)
+        return server_name, high_water_mark
 
+    def load_users_single_pass(self, groups, group_dns, extended_attributes):
+        """
+        Read all users with one search, and put each user in the mapped groups listed in their
+        member_of_attribute, rather than searching for the members of each group in turn
+        :type groups: list(str)
+        :type group_dns: dict(str, str)
+        :type extended_attributes: list(str)
+        :rtype iterable(dict)
+        """
+        options = self.options
+        member_of_attribute = str(options['member_of_attribute'])
+        groups_by_dn = {}
+        for group, group_dn in group_dns.items():
+            groups_by_dn.setdefault(group_dn.lower(), []).append(group)
+
+        user_attribute_names, extra_attributes = self.get_user_attribute_names(extended_attributes)
+        if member_of_attribute not in user_attribute_names:
+            user_attribute_names.append(member_of_attribute)
+        # the member DNs of the record being converted, since the converted user doesn't keep them
+        member_of = {}
+
+        def iter_records():
+            for dn, record in self.iter_search_result(str(options['base_dn']), ldap3.SUBTREE,
+                                                      str(options['all_users_filter']), user_attribute_names):
+                member_of['dns'] = LDAPValueFormatter.get_attribute_value(record, member_of_attribute) or []
+                yield dn, record
+
+        group_users = dict((group, 0) for group in groups)
+        try:
+            for user_dn, user in self.iter_user_records(iter_records(), extra_attributes):
+                member_dns = member_of['dns']
+                if isinstance(member_dns, str):
+                    member_dns = [member_dns]
+                for member_dn in member_dns:
+                    for group in groups_by_dn.get(member_dn.lower(), []):
+                        if group not in user['groups']:
+                            user['groups'].append(group)
+                            group_users[group] += 1
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+        for group, count in group_users.items():
+            self.logger.debug('Count of users in group "%s": %d', group, count)
+        if groups:
+            self.log_grouped_user_counts()
         self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
         return self.user_by_dn.values()
 
-    def find_ldap_group_dn(self, group):
+    def iter_group_search_results(self, group_dns, attributes):
+        """
+        Search for the members of each group, yielding (group, search results) in the order of the given groups.
+        :type group_dns: dict(str, str)
+        :type attributes: list(str)
+        :rtype iterable(str, iterable(list))
+        """
+        base_dn = str(self.options['base_dn'])
+        searches = [(base_dn, self.format_group_user_filter(group_dn)) for group_dn in group_dns.values()]
+        return zip(group_dns, self.iter_search_results(searches, attributes))
+
+    def iter_search_results(self, searches, attributes):
+        """
+        Run each of the given (base DN, filter) searches, yielding their results in order.
+        With a single connection the searches run one at a time, as the results are read.  With a pool of
+        connections the searches run concurrently, one per connection, but only the raw search results are
+        fetched on the worker threads: converting them to users (and so updating user_by_dn) is left to the
+        caller, on the calling thread.
+        :type searches: list(str, str)
+        :type attributes: list(str)
+        :rtype iterable(iterable(list))
+        """
+        if len(self.pool) == 1:
+            for base_dn, filter_string in searches:
+                yield self.iter_search_result(base_dn, ldap3.SUBTREE, filter_string, attributes)
+            return
+        with ThreadPoolExecutor(max_workers=len(self.pool)) as executor:
+            futures = [executor.submit(self._search_pooled, base_dn, filter_string, attributes)
+                       for base_dn, filter_string in searches]
+            for future in futures:
+                yield future.result()
+
+    def _search_pooled(self, base_dn, filter_string, attributes):
+        """
+        :type base_dn: str
+        :type filter_string: str
+        :type attributes: list(str)
+        :rtype list(list)
+        """
+        with self.pool.connection() as connection:
+            try:
+                return list(self.iter_search_result(base_dn, ldap3.SUBTREE, filter_string, attributes, connection))
+            except Exception as e:
+                raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+
+    def resolve_group_dns(self, groups):
+        """
+        Find the DN of each of the given groups, taking them from the group cache where possible.  The cache
+        is cleared after its refresh interval, or when the settings the groups are searched with have changed.
+        Groups that aren't found are left out (with a warning), so the result is in the order of the given groups.
+        :type groups: list(str)
+        :rtype dict(str, str)
+        """
+        cache = self.group_cache
+        cached_dns = {}
+        if cache is not None:
+            options = self.options
+            signature = json.dumps([str(options['base_dn']), str(options['group_filter_format']),
+                                    sorted(options['hosts'])])
+            if cache.should_refresh or cache.get_state().get('signature') != signature:
+                self.logger.debug('Refreshing LDAP group cache')
+                cache.clear_all()
+                cache.set_state({'signature': signature})
+                cache.should_refresh = False
+                cache.update_next_refresh()
+            else:
+                cached_dns = cache.get_group_dns()
+        missing_groups = [group for group in groups if group not in cached_dns]
+        found_dns = self.find_ldap_group_dns(missing_groups) if missing_groups else {}
+        if cache is not None and found_dns:
+            cache.cache_group_dns(found_dns)
+        group_dns = {}
+        for group in groups:
+            group_dn = cached_dns.get(group) or found_dns.get(group)
+            if not group_dn:
+                self.logger.warning("No group found for: %s", group)
+                continue
+            group_dns[group] = group_dn
+        return group_dns
+
+    def find_ldap_group_dns(self, groups):
+        """
+        Find the DNs of the given groups with as few searches as possible, by combining the
+        group filter for many groups into a single OR filter.  The group name has to be matched
+        against just one attribute in group_filter_format for this to work, e.g. (cn={group});
+        if it isn't (or group_lookup_batch_size is 0), each group is looked up on its own.
+        :type groups: list(str)
+        :rtype dict(str, str)
+        """
+        options = self.options
+        batch_size = options['group_lookup_batch_size']
+        group_filter_format = str(options['group_filter_format'])
+        match = re.search(r'\(([\w.;-]+)=\{group\}\)', group_filter_format)
+        if not batch_size or match is None or group_filter_format.count('{group}') > 1:
+            group_dns = {}
+            for group in groups:
+                group_dn = self.find_ldap_group_dn(group)
+                if group_dn:
+                    group_dns[group] = group_dn
+            return group_dns
+
+        name_attribute = match.group(1)
+        base_dn = str(options['base_dn'])
+        group_dns = {}
+        for i in range(0, len(groups), batch_size):
+            batch = groups[i:i + batch_size]
+            groups_by_name = {}
+            for group in batch:
+                groups_by_name.setdefault(group.lower(), []).append(group)
+            filter_string = str('(|') + str('').join(
+                self.format_ldap_query_string(group_filter_format, group=group) for group in batch) + str(')')
+            try:
+                records = list(self.iter_search_result(base_dn, ldap3.SUBTREE, filter_string, [name_attribute]))
+            except Exception as e:
+                raise AssertionException('Unexpected LDAP failure reading group info: %s' % e)
+            for group_dn, record in records:
+                if group_dn is None:
+                    continue
+                names = LDAPValueFormatter.get_attribute_value(record, name_attribute) or []
+                if isinstance(names, str):
+                    names = [names]
+                for name in names:
+                    for group in groups_by_name.get(name.lower(), []):
+                        if group in group_dns and group_dns[group] != group_dn:
+                            raise AssertionException("Multiple LDAP groups found for: %s" % group)
+                        group_dns[group] = group_dn
+        return group_dns
+
+    def find_ldap_group_dn(self, group, connection=None):
         """
         :type group: str
+        :type connection: ldap3.Connection
         :rtype str
         """
-        connection = self.connection
+        if connection is None:
+            connection = self.connection
         options = self.options
         base_dn = str(options['base_dn'])
         group_filter_format = str(options['group_filter_format'])
@@ -280,53 +686,98 @@ class LDAPDirectoryConnector(DirectoryConnector):
         return group memberships dns from specified membership attribute in LDAP group object
         :type group: str
         :type member_attribute: str
+        :type searched_dns: set(str)
         :rtype iterable(str)
         """
         if searched_dns is None:
-            searched_dns = []
-        connection = self.connection
+            searched_dns = set()
         nested_group_search = self.options['two_steps_lookup']['nested_group']
+        for member_dn in self.get_member_dns(group_dn, member_attribute):
+            # if nested_group search enabled, look up DN and see if group member attribute exist in that object
+            # This will recurse through until there is no nested group.
+            if member_dn not in searched_dns:
+                searched_dns.add(member_dn)
+                if nested_group_search:
+                    yield from self.iter_group_member_dns(member_dn, member_attribute, searched_dns)
+                yield member_dn
+
+    def get_member_dns(self, dn, member_attribute):
+        """
+        Read the members listed in the given object's membership attribute, which are only read once per DN
+        :type dn: str
+        :type member_attribute: str
+        :rtype list(str)
+        """
+        if dn in self.member_dns_by_dn:
+            return self.member_dns_by_dn[dn]
+        member_dns = []
+        connection = self.connection
         try:
-            connection.search(search_base=group_dn, search_filter='(objectClass=*)', search_scope=ldap3.SUBTREE,
+            connection.search(search_base=dn, search_filter='(objectClass=*)', search_scope=ldap3.SUBTREE,
                               attributes=member_attribute)
             result = connection.entries
             if result is not None:
                 record = result[0].entry_attributes_as_dict
-                member_dns = LDAPValueFormatter.get_attribute_value(record, member_attribute)
-                for member_dn in member_dns or []:
-                    # if nested_group search enabled, look up DN and see if group member attribute exist in that object
-                    # This will recurse through until there is no nested group.
-                    if member_dn not in searched_dns:
-                        searched_dns.append(member_dn)
-                        if nested_group_search:
-                            nested_members = self.iter_group_member_dns(member_dn, member_attribute, searched_dns)
-                            for nested_member_dn in nested_members:
-                                yield nested_member_dn
-                        yield member_dn
+                member_dns = LDAPValueFormatter.get_attribute_value(record, member_attribute) or []
+                if isinstance(member_dns, str):
+                    member_dns = [member_dns]
         except Exception as e:
-            self.logger.warning('Error lookup %s : %s', group_dn, e)
-            pass
+            self.logger.warning('Error lookup %s : %s', dn, e)
+        self.member_dns_by_dn[dn] = member_dns
+        return member_dns
+
+    def iter_member_users(self, member_dns, extended_attributes):
+        """
+        Find the users with the given DNs, for two-step lookup.  Users that have already been read are
+        reused, and the rest are read with one search each, concurrently when there is a pool of connections.
+        :type member_dns: list(str)
+        :type extended_attributes: list(str)
+        :rtype iterable(dict)
+        """
+        user_attribute_names, extra_attributes = self.get_user_attribute_names(extended_attributes)
+        unread_dns = [user_dn for user_dn in member_dns
+                      if user_dn not in self.user_by_dn and user_dn not in self.user_by_member_dn]
+        # replace base_dn with user_dn and filter with all_users_filter to do user lookup based on DN
+        all_users_filter = str(self.options['all_users_filter'])
+        searches = [(user_dn, all_users_filter) for user_dn in unread_dns]
+        for user_dn, result_iter in zip(unread_dns, self.iter_search_results(searches, user_attribute_names)):
+            result = list(self.iter_user_records(result_iter, extra_attributes))
+            # the search should only return 1 user when doing two_steps lookup.
+            if len(result) > 1:
+                raise AssertionException(
+                    "Unexpected multiple LDAP object found in 'two_steps_lookup' mode for: %s" % user_dn)
+            self.user_by_member_dn[user_dn] = result[0][1] if result else None
+        for user_dn in member_dns:
+            user = self.user_by_dn.get(user_dn) or self.user_by_member_dn.get(user_dn)
+            if user is not None:
+                yield user
 
     def iter_users(self, base_dn, users_filter, extended_attributes):
-        options = self.options
-        dynamic_group_member_attribute = options['dynamic_group_member_attribute']
-
-        user_attribute_names = []
-        user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_country_code_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_identity_type_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_email_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_username_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
-        if dynamic_group_member_attribute is not None:
-            user_attribute_names.append(str(dynamic_group_member_attribute))
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes)
+        result_iter = self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, user_attribute_names)
+        return self.iter_user_records(result_iter, extended_attributes)
 
+    def get_user_attribute_names(self, extended_attributes):
+        """
+        Get the attributes to request for each user, along with those extended attributes which are not
+        already requested for the user fields.
+        :type extended_attributes: list(str)
+        :rtype (list(str), list(str))
+        """
+        user_attribute_names = list(self.user_attribute_names)
         extended_attributes = [str(attr) for attr in extended_attributes]
         extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
         user_attribute_names.extend(extended_attributes)
+        return user_attribute_names, extended_attributes
 
-        result_iter = self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, user_attribute_names)
+    def iter_user_records(self, result_iter, extended_attributes):
+        """
+        Convert search results to users, saving each one in user_by_dn
+        :type result_iter: iterable(list)
+        :type extended_attributes: list(str)
+        :rtype iterable(str, dict)
+        """
+        dynamic_group_member_attribute = self.options['dynamic_group_member_attribute']
         for dn, record in result_iter:
             if dn is None:
                 continue
@@ -448,12 +899,14 @@ class LDAPDirectoryConnector(DirectoryConnector):
             return rdn[0][3:]
         return None
 
-    def iter_search_result(self, base_dn, scope, filter_string, attributes):
+    def iter_search_result(self, base_dn, scope, filter_string, attributes, connection=None):
         """
         type: filter_string: str
         type: attributes: list(str)
+        type: connection: ldap3.Connection
         """
-        connection = self.connection
+        if connection is None:
+            connection = self.connection
         search_page_size = self.options['search_page_size']
         if search_page_size == 0:
             connection.search(base_dn, filter_string, scope, attributes=attributes)
@@ -533,6 +986,42 @@ class LDAPDirectoryConnector(DirectoryConnector):
         return False
 
 
+class LDAPConnectionPool(object):
+    """
+    A fixed set of connections to the directory, each of which is used by one search at a time.
+    When there are several servers, each connection picks one according to the pool strategy,
+    and moves on to the next server that answers if its own goes down.
+    """
+
+    def __init__(self, create_connection, size):
+        """
+        :type create_connection: function
+        :type size: int
+        """
+        self.connections = [create_connection() for _ in range(size)]
+        self.available = queue.Queue()
+        for connection in self.connections:
+            self.available.put(connection)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(self.connections)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of the block, waiting for one to be free if need be
+        :rtype ldap3.Connection
+        """
+        connection = self.available.get()
+        try:
+            yield connection
+        finally:
+            self.available.put(connection)
+
+
 class LDAPValueFormatter(object):
     encoding = 'utf8'
 
@@ -548,6 +1037,54 @@ class LDAPValueFormatter(object):
             attribute_names = [str(item[1]) for item in formatter.parse(string_format) if item[1]]
         self.string_format = string_format
         self.attribute_names = attribute_names
+        # generate_value is called for every record, so it is replaced by a version specialized for this format
+        self.generate_value = self.compile()
+
+    def compile(self):
+        """
+        Make a function that does the same as generate_value for this format, but does as little as possible
+        per record: a format that is just one attribute (such as {mail}) becomes a direct lookup of that
+        attribute, and a format with no attributes becomes a constant.  Other formats only build the values
+        and fill in the template.
+        :rtype function
+        """
+        string_format = self.string_format
+        attribute_names = self.attribute_names
+        if string_format is None:
+            return lambda record: (None, None)
+        if not attribute_names:
+            try:
+                value = string_format.format()
+            except (IndexError, KeyError):
+                # positional fields can't be filled in from a record, so leave the error to generate_value
+                return lambda record: LDAPValueFormatter.generate_value(self, record)
+            return lambda record: (value, None)
+        if string_format == '{' + attribute_names[0] + '}':
+            attribute_name = attribute_names[0]
+
+            def generate_value(record):
+                value = record.get(attribute_name)
+                if not value:
+                    return None, attribute_name
+                if not isinstance(value, str):
+                    value = value[0]
+                    if value is None:
+                        return None, attribute_name
+                return (value if isinstance(value, str) else format(value)), attribute_name
+            return generate_value
+
+        get_attribute_value = self.get_attribute_value
+        format_map = string_format.format_map
+
+        def generate_value(record):
+            values = {}
+            for attribute_name in attribute_names:
+                value = get_attribute_value(record, attribute_name, first_only=True)
+                if value is None:
+                    return None, attribute_name
+                values[attribute_name] = value
+            return format_map(values), attribute_name
+        return generate_value
 
     def get_attribute_names(self):
         """
@@ -18,10 +18,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import ast
+import json
+import string
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
 import okta
 import requests
-import string
+from okta.framework.ApiClient import ApiClient
 from okta.framework.OktaError import OktaError
+from okta.framework.PagedResults import PagedResults
+from okta.models.user.User import User
+from okta.models.usergroup.UserGroup import UserGroup
 
 import user_sync.connector.helper
 import user_sync.helper
@@ -55,10 +67,19 @@ class OktaDirectoryConnector(DirectoryConnector):
         builder.set_string_value('user_country_code_format', str('{countryCode}'))
         builder.set_string_value('user_identity_type', None)
         builder.set_string_value('logger_name', self.name)
+        builder.set_int_value('connections', 1)
+        builder.set_int_value('group_lookup_batch_size', 20)
+        builder.set_value('search_page_size', int, None)
         host = builder.require_string_value('host')
         api_token = caller_config.get_credential('api_token', host)
 
         options = builder.get_options()
+        if options['connections'] < 1:
+            raise AssertionException("'connections' must be 1 or greater")
+        if options['group_lookup_batch_size'] < 1:
+            raise AssertionException("'group_lookup_batch_size' must be 1 or greater")
+        if options['search_page_size'] is not None and options['search_page_size'] < 1:
+            raise AssertionException("'search_page_size' must be 1 or greater")
 
         OKTAValueFormatter.encoding = options['string_encoding']
         self.user_identity_type = user_sync.identity_type.parse_identity_type(options['user_identity_type'])
@@ -83,14 +104,25 @@ class OktaDirectoryConnector(DirectoryConnector):
             host = "https://" + host
 
         self.user_by_uid = {}
+        # the mapped groups by name, looked up in bulk at the start of each load (see load_group_index)
+        self.group_by_name = None
+        # filter predicates by source string, so that each one is only compiled once
+        self.compiled_filters = {}
+        # the time spent filtering users in the current load
+        self.filter_time = 0.0
+        self.compile_filter(options['all_users_filter'])
 
         logger.debug('%s initialized with options: %s', self.name, options)
 
         logger.info('Connecting to: %s', host)
 
+        # the clients share a rate limiter, since Okta's rate limits apply to the whole org
+        self.rate_limiter = OktaRateLimiter(options['connections'])
         try:
-            self.users_client = okta.UsersClient(host, api_token)
-            self.groups_client = okta.UserGroupsClient(host, api_token)
+            self.users_client = RateLimitedUsersClient(host, api_token)
+            self.users_client.rate_limiter = self.rate_limiter
+            self.groups_client = RateLimitedUserGroupsClient(host, api_token)
+            self.groups_client.rate_limiter = self.rate_limiter
         except OktaError as e:
             raise AssertionException("Error connecting to Okta: %s" % e)
 
@@ -111,11 +143,19 @@ class OktaDirectoryConnector(DirectoryConnector):
 
         self.logger.info('Loading users...')
         self.user_by_uid = user_by_uid = {}
-
-        for group in groups:
+        self.filter_time = 0.0
+
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes)
+        profile_fields = self.get_projected_fields(user_attribute_names, all_users_filter)
+        if profile_fields is None:
+            self.logger.debug('Filter uses more than the status and profile of users, reading whole users')
+        self.load_group_index(groups)
+        # users are filtered and converted once, however many groups they are members of
+        converted_users = {}
+        for group, members in self.iter_groups_member_records(groups, user_attribute_names, profile_fields):
             total_group_members = 0
             total_group_users = 0
-            for user in self.iter_group_members(group, all_users_filter, extended_attributes):
+            for user in self.iter_converted_users(members, all_users_filter, extended_attributes, converted_users):
                 total_group_members += 1
 
                 uid = user.get('uid')
@@ -129,17 +169,60 @@ class OktaDirectoryConnector(DirectoryConnector):
 
             self.logger.debug('Group %s members: %d users: %d', group, total_group_members, total_group_users)
 
+        self.logger.debug('Time spent filtering users: %.3fs', self.filter_time)
         return user_by_uid.values()
 
     def set_additional_group_filters(self, _):
         self.logger.warn("Additional group rules are not supported by the Okta connector")
 
+    def load_group_index(self, groups):
+        """
+        Look up the given groups by name, many at a time, and index them so that find_group doesn't have to
+        query Okta for each group.  Each lookup searches for up to group_lookup_batch_size exact names; if Okta
+        won't run the search, all the groups are listed instead.  The group_filter_format is only checked here,
+        since an exact name match is found whatever the query.
+        :type groups: list(str)
+        """
+        group_filter_format = self.options['group_filter_format']
+        try:
+            group_filter_format.format(group='')
+        except KeyError as e:
+            raise AssertionException("Bad format key in group query (%s): %s" % (group_filter_format, e))
+        self.group_by_name = None
+        names = list(dict.fromkeys(group.strip() for group in groups))
+        batch_size = self.options['group_lookup_batch_size']
+        found_groups = []
+        try:
+            try:
+                for i in range(0, len(names), batch_size):
+                    search = ' or '.join('profile.name eq "%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+                                         for name in names[i:i + batch_size])
+                    found_groups.extend(self.groups_client.get_all_groups(search))
+            except OktaError as e:
+                self.logger.warning("Unable to search for groups, listing all groups instead: %s", e)
+                found_groups = self.groups_client.get_all_groups()
+        except OktaError as e:
+            self.logger.warning("Unable to list groups")
+            raise AssertionException("Okta error listing groups: %s" % e)
+        except requests.exceptions.SSLError as ce:
+            if "doesn't match either of '*.okta.com', 'okta.com" in str(ce):
+                raise AssertionException("Invalid hostname: %s" % ce)
+            raise
+        group_by_name = {}
+        for group in found_groups:
+            # the first group wins, as it does when querying for one
+            group_by_name.setdefault(group.profile.name, group)
+        self.logger.debug('Indexed %d groups', len(group_by_name))
+        self.group_by_name = group_by_name
+
     def find_group(self, group):
         """
         :type group: str
         :rtype UserGroup
         """
         group = group.strip()
+        if self.group_by_name is not None:
+            return self.group_by_name.get(group)
         options = self.options
         group_filter_format = options['group_filter_format']
         try:
@@ -169,7 +252,93 @@ class OktaDirectoryConnector(DirectoryConnector):
         :type extended_attributes: list
         :rtype iterator(str, str)
         """
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes)
+        members = self.get_group_member_records(group, user_attribute_names)
+        if members is not None:
+            yield from self.iter_converted_users(members, filter_string, extended_attributes)
 
+    def iter_groups_member_records(self, groups, user_attribute_names, profile_fields=None):
+        """
+        Fetch the members of each group, yielding (group, member records) in the order of the given groups
+        and skipping groups that aren't found.  With more than one connection, the groups are fetched
+        concurrently; only the requests run on the worker threads, so the records can be converted
+        (and merged into user_by_uid) on the calling thread.
+        :type groups: list(str)
+        :type user_attribute_names: list(str)
+        :type profile_fields: list(str) or None
+        :rtype iterator(str, list)
+        """
+        if self.options['connections'] == 1:
+            results = ((group, self.get_group_member_records(group, user_attribute_names, profile_fields))
+                       for group in groups)
+            for group, members in results:
+                if members is not None:
+                    yield group, members
+            return
+        with ThreadPoolExecutor(max_workers=self.options['connections']) as executor:
+            futures = [executor.submit(self.get_group_member_records, group, user_attribute_names, profile_fields)
+                       for group in groups]
+            for group, future in zip(groups, futures):
+                members = future.result()
+                if members is not None:
+                    yield group, members
+
+    def get_group_member_records(self, group, user_attribute_names, profile_fields=None):
+        """
+        Get all the members of a group, or None if there is no such group.  If profile fields are given,
+        the members are read as lightweight records with only those fields (see get_projected_fields).
+        :type group: str
+        :type user_attribute_names: list(str)
+        :type profile_fields: list(str) or None
+        :rtype list(okta.models.user.User)
+        """
+        res_group = self.find_group(group)
+        if not res_group:
+            self.logger.warning("No group found for: %s", group)
+            return None
+        page_size = self.options['search_page_size']
+        try:
+            if profile_fields is not None:
+                return self.groups_client.get_group_all_user_records(res_group.id, profile_fields, page_size)
+            attr_dict = OKTAValueFormatter.get_extended_attribute_dict(user_attribute_names)
+            return self.groups_client.get_group_all_users(res_group.id, attr_dict, page_size)
+        except OktaError as e:
+            self.logger.warning("Unable to get_group_users")
+            raise AssertionException("Okta error querying for group users: %s" % e)
+
+    def iter_converted_users(self, members, filter_string, extended_attributes, converted_users=None):
+        """
+        Filter and convert members.  Members already in converted_users (by id) are taken from there, and others
+        are added to it (as None if they are filtered out or can't be converted), so that users in several groups
+        are only filtered and converted once.
+        :type members: list(okta.models.user.User)
+        :type filter_string: str
+        :type extended_attributes: list(str)
+        :type converted_users: dict(str, dict) or None
+        :rtype iterator(dict)
+        """
+        if converted_users is None:
+            converted_users = {}
+        for member in members:
+            if member.id in converted_users:
+                user = converted_users[member.id]
+            else:
+                user = None
+                # Filtering users based all_users_filter query in config
+                for selected in self.filter_users((member,), filter_string):
+                    user = self.convert_user(selected, extended_attributes)
+                converted_users[member.id] = user
+            if not user:
+                continue
+            yield (user)
+
+    def get_user_attribute_names(self, extended_attributes):
+        """
+        Get the profile attributes needed for each user, along with those extended attributes which are not
+        already needed for the user fields.
+        :type extended_attributes: list(str)
+        :rtype (list(str), list(str))
+        """
         user_attribute_names = []
         user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
         user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
@@ -180,23 +349,57 @@ class OktaDirectoryConnector(DirectoryConnector):
         user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
         extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
         user_attribute_names.extend(extended_attributes)
+        return user_attribute_names, extended_attributes
 
-        res_group = self.find_group(group)
-        if res_group:
-            try:
-                attr_dict = OKTAValueFormatter.get_extended_attribute_dict(user_attribute_names)
-                members = self.groups_client.get_group_all_users(res_group.id, attr_dict)
-            except OktaError as e:
-                self.logger.warning("Unable to get_group_users")
-                raise AssertionException("Okta error querying for group users: %s" % e)
-            # Filtering users based all_users_filter query in config
-            for member in self.filter_users(members, filter_string):
-                user = self.convert_user(member, extended_attributes)
-                if not user:
-                    continue
-                yield (user)
-        else:
-            self.logger.warning("No group found for: %s", group)
+    def get_projected_fields(self, user_attribute_names, filter_string):
+        """
+        Get the profile fields needed to convert and filter users: those of the formatters and extended attributes,
+        the login and those the filter uses.  Returns None if the filter uses anything of a user but its id,
+        status and profile fields, in which case the whole user has to be read.
+        :type user_attribute_names: list(str)
+        :type filter_string: str
+        :rtype list(str) or None
+        """
+        filter_fields = self.get_filter_profile_fields(filter_string)
+        if filter_fields is None:
+            return None
+        profile_fields = ['login']
+        for field in user_attribute_names + sorted(filter_fields):
+            if field not in profile_fields:
+                profile_fields.append(field)
+        return profile_fields
+
+    @staticmethod
+    def get_filter_profile_fields(filter_string):
+        """
+        Find the profile fields used by a predicate of the form user.status or user.profile.<field>,
+        or None if the predicate uses the user in any other way
+        :type filter_string: str
+        :rtype set(str) or None
+        """
+        try:
+            expression = ast.parse(filter_string, mode='eval')
+        except SyntaxError:
+            return None
+        parents = {}
+        for node in ast.walk(expression):
+            for child in ast.iter_child_nodes(node):
+                parents[child] = node
+        profile_fields = set()
+        for node in ast.walk(expression):
+            if not (isinstance(node, ast.Name) and node.id == 'user'):
+                continue
+            parent = parents.get(node)
+            if not isinstance(parent, ast.Attribute):
+                return None
+            if parent.attr == 'profile':
+                parent = parents.get(parent)
+                if not isinstance(parent, ast.Attribute):
+                    return None
+                profile_fields.add(parent.attr)
+            elif parent.attr not in ('id', 'status'):
+                return None
+        return profile_fields
 
     def convert_user(self, record, extended_attributes):
 
@@ -293,19 +496,193 @@ class OktaDirectoryConnector(DirectoryConnector):
         return users
 
     def filter_users(self, users, filter_string):
-        # Allow the following builtin functions to be used in eval()
+        """
+        Lazily filter the users with a predicate, which is compiled the first time it is used
+        :type users: iterable(okta.models.user.User)
+        :type filter_string: str
+        :rtype iterator(okta.models.user.User)
+        """
+        predicate = self.compile_filter(filter_string)
+        for user in users:
+            start = time.perf_counter()
+            try:
+                selected = predicate(user)
+            except Exception as e:
+                raise AssertionException("Error filtering with predicate (%s): %s" % (filter_string, e))
+            finally:
+                self.filter_time += time.perf_counter() - start
+            if selected:
+                yield user
+
+    def compile_filter(self, filter_string):
+        """
+        Compile a predicate expression on "user" into a function of the user
+        :type filter_string: str
+        :rtype function
+        """
+        if filter_string in self.compiled_filters:
+            return self.compiled_filters[filter_string]
+        # Allow the following builtin functions to be used in the predicate
         whitelist = {
             "len": len, "int": int, "float": float, "str": str, "enumerate": enumerate, "filter": filter,
             "getattr": getattr, "hasattr": hasattr, "list": list, "map": map, "max": max, "min": min,
             "range": range, "sorted": sorted, "sum": sum, "tuple": tuple, "zip": zip
         }
-
         try:
-            return list(filter(lambda user: eval(filter_string, {"__builtins__": whitelist}, {"user": user}), users))
-        except SyntaxError as e:
+            expression = ast.parse(filter_string, mode='eval')
+        except SyntaxError:
             raise AssertionException("Invalid syntax in predicate (%s): cannot evaluate" % filter_string)
-        except Exception as e:
-            raise AssertionException("Error filtering with predicate (%s): %s" % (filter_string, e))
+        # wrap the expression in "lambda user: ...", so it is compiled once and then just called for each user
+        arguments = ast.arguments(posonlyargs=[], args=[ast.arg(arg='user')], kwonlyargs=[], kw_defaults=[],
+                                  defaults=[])
+        function = ast.fix_missing_locations(ast.Expression(body=ast.Lambda(args=arguments, body=expression.body)))
+        predicate = eval(compile(function, '<all_users_filter>', 'eval'), {"__builtins__": whitelist})
+        self.compiled_filters[filter_string] = predicate
+        return predicate
+
+
+class OktaRateLimiter(object):
+    """
+    Paces requests to Okta by the X-Rate-Limit-* headers of its responses: once the requests remaining
+    in the current rate limit window are down to the reserve (one per connection, for the requests that
+    may already be in flight), every request waits for the window to reset.
+    """
+    # Okta's rate limit windows are a minute long, so never wait longer than that (e.g. because of clock skew)
+    max_wait = 60
+
+    def __init__(self, reserve):
+        """
+        :type reserve: int
+        """
+        self.reserve = reserve
+        self.remaining = None
+        self.reset = 0
+        # the number of responses reported, to tell whether any were while waiting
+        self.updates = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Wait until a request can be made without going over the rate limit.  The lock is only held to
+        check the budget, not while sleeping, so that the other connections can still report responses;
+        the budget is checked again after waking, in case one of them started a new window meanwhile.
+        """
+        waited_for = None
+        while True:
+            with self.lock:
+                if self.remaining is None:
+                    return
+                if self.remaining > self.reserve:
+                    self.remaining -= 1
+                    return
+                # nothing has been reported since the wait, so the window it was waiting for has reset
+                if waited_for == self.updates:
+                    self.remaining = None
+                    return
+                delay = min(self.reset - time.time(), self.max_wait)
+                if delay <= 0:
+                    self.remaining = None
+                    return
+                waited_for = self.updates
+            time.sleep(delay)
+
+    def update(self, response):
+        """
+        :type response: requests.Response
+        """
+        try:
+            remaining = int(response.headers['X-Rate-Limit-Remaining'])
+            reset = int(response.headers['X-Rate-Limit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            self.remaining = remaining
+            self.reset = reset
+            self.updates += 1
+
+
+class RateLimitedApiClient(ApiClient):
+    """
+    Makes every GET request wait on the client's rate limiter, and report the rate limit headers back to it.
+    Requests that still hit the rate limit are retried by the SDK with its own backoff.
+    """
+    rate_limiter = None
+
+    def get(self, url, params=None, attempts=0):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+        response = super(RateLimitedApiClient, self).get(url, params, attempts)
+        if self.rate_limiter is not None:
+            self.rate_limiter.update(response)
+        return response
+
+
+class RateLimitedUsersClient(RateLimitedApiClient, okta.UsersClient):
+    pass
+
+
+class RateLimitedUserGroupsClient(RateLimitedApiClient, okta.UserGroupsClient):
+
+    def get_all_groups(self, search=None):
+        """
+        Get every group (or every group matching the given search expression), following the pages of the
+        listing with our get
+        :type search: str or None
+        :rtype list(okta.models.usergroup.UserGroup)
+        """
+        total_results = []
+        # the SDK doesn't quote parameters, and search expressions have spaces and quotes in them
+        response = self.get_path('/', {'search': quote(search)} if search else None)
+        while True:
+            results = PagedResults(response, UserGroup)
+            total_results.extend(results.result())
+            if results.is_last_page():
+                break
+            response = self.get(results.next_url)
+        return total_results
+
+    def get_group_all_users(self, gid, extended_attribute=None, limit=None):
+        """
+        The same as the SDK's get_group_all_users, except that the pages after the first are also fetched with
+        our get (the SDK calls the base class get for those), and that the page size can be given
+        :type gid: str
+        :type extended_attribute: dict or None
+        :type limit: int or None
+        :rtype list(okta.models.user.User)
+        """
+        total_results = []
+        response = self.get_path('/{0}/users'.format(gid), {'limit': limit} if limit else None)
+        while True:
+            results = PagedResults(response, User)
+            total_results.extend(results.result(extended_attribute=extended_attribute))
+            if results.is_last_page():
+                break
+            response = self.get(results.next_url)
+        return total_results
+
+    def get_group_all_user_records(self, gid, profile_fields, limit=None):
+        """
+        Like get_group_all_users, but returns lightweight records that have only the id, the status and the given
+        profile fields of each user.  Okta can't filter group members or leave fields out of them, so this saves
+        building the SDK's models (and parsing all their dates) for every member instead.
+        As with the SDK's models, empty profile fields are None.
+        :type gid: str
+        :type profile_fields: list(str)
+        :type limit: int or None
+        :rtype list(types.SimpleNamespace)
+        """
+        total_results = []
+        response = self.get_path('/{0}/users'.format(gid), {'limit': limit} if limit else None)
+        while True:
+            for user in json.loads(response.text):
+                profile = user.get('profile') or {}
+                total_results.append(types.SimpleNamespace(
+                    id=user.get('id'), status=user.get('status') or None,
+                    profile=types.SimpleNamespace(**{field: profile.get(field) or None for field in profile_fields})))
+            if 'next' not in response.links:
+                break
+            response = self.get(response.links['next']['url'])
+        return total_results
 
 
 class OKTAValueFormatter(object):
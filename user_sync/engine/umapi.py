@@ -19,15 +19,26 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib
+import heapq
+import json
 import logging
-from itertools import chain
+import sys
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, groupby
 from collections import defaultdict
+from collections.abc import MutableMapping
+from operator import itemgetter
+from pathlib import Path
 
 import user_sync.connector.connector_umapi
 import user_sync.error
 import user_sync.identity_type
+from user_sync.cache.fingerprint import FingerprintCache
 from user_sync.connector.connector_umapi import UmapiConnector
-from user_sync.helper import normalize_string, CSVAdapter, JobStats
+from user_sync.helper import normalize_string, CSVAdapter, ExternalSorter, JobStats
 from user_sync.config.common import check_max_limit
 
 from .common import AdobeGroup, PRIMARY_TARGET_NAME
@@ -49,11 +60,15 @@ class RuleProcessor(object):
         'exclude_users': [],
         'extended_attributes': set(),
         'extension_enabled': False,
+        'full_sync_interval': 86400,
         'group_removals_only': False,
+        'incremental': False,
+        'incremental_state_path': None,
         'process_groups': False,
         'max_adobe_only_users': 200,
         'new_account_type': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
         'remove_strays': False,
+        'sort_merge': False,
         'strategy': 'sync',
         'stray_list_input_path': None,
         'stray_list_output_path': None,
@@ -63,6 +78,15 @@ class RuleProcessor(object):
         'username_filter_regex': None,
     }
 
+    # the options that change what a sync does for users whose directory entries haven't changed,
+    # so an incremental sync does a full sync when any of them changes
+    incremental_sync_options = [
+        'adobe_group_filter', 'default_country_code', 'delete_strays', 'disentitle_strays', 'exclude_groups',
+        'exclude_identity_types', 'exclude_strays', 'exclude_unmapped_users', 'exclude_users', 'group_removals_only',
+        'new_account_type', 'process_groups', 'remove_strays', 'update_attributes', 'update_user_info',
+        'username_filter_regex',
+    ]
+
     def __init__(self, caller_options):
         """
         :type caller_options:dict
@@ -72,6 +96,8 @@ class RuleProcessor(object):
         self.options = options
         self.directory_user_index = MultiIndex([], ['email', 'username'])
         self.filtered_directory_user_index = MultiIndex([], ['email', 'username'])
+        # in sort-merge mode, the selected directory users are kept (sorted) here instead of in the indexes
+        self.sorted_directory_users = iter(())
         self.umapi_info_by_name = {}
         self.adobeid_user_by_email = {}
         # counters for action summary log
@@ -121,12 +147,24 @@ class RuleProcessor(object):
             self.read_stray_key_map(options['stray_list_input_path'])
         self.stray_list_output_path = options['stray_list_output_path']
 
+        # in incremental mode, the directory users as of the last successful sync are kept in the state store.
+        # incremental_emails is the set of users to fetch from the umapis (None when syncing every user),
+        # and directory_fingerprints is the state to save once this sync succeeds.
+        self.sync_state = None
+        self.incremental_emails = None
+        self.incremental_unchanged_count = 0
+        self.directory_fingerprints = None
+        if options['incremental']:
+            self.sync_state = FingerprintCache(Path(options['incremental_state_path']), options['full_sync_interval'])
+
         # determine what processing is needed on strays
         self.will_manage_strays = (options['process_groups'] or options['disentitle_strays'] or
                                    options['remove_strays'] or options['delete_strays'])
         self.exclude_strays = options['exclude_strays']
         self.will_process_strays = ((not self.exclude_strays) and
                                     (options['stray_list_output_path'] or self.will_manage_strays))
+        # set when there are too many strays to manage, so they are left for a later sync
+        self.strays_skipped = False
 
         # specifying a push strategy disables a lot of processing
         self.push_umapi = False
@@ -177,10 +215,18 @@ class RuleProcessor(object):
 
         self.prepare_umapi_infos()
 
+        if self.options['sort_merge'] and umapi_connectors.get_secondary_connectors():
+            raise user_sync.error.AssertionException("Sort-merge sync does not support secondary umapi connectors")
+
         if directory_connector is not None:
             load_directory_stats = JobStats("Load from Directory", divider="-")
             load_directory_stats.log_start(logger)
-            self.read_desired_user_groups(directory_groups, directory_connector)
+            if self.options['sort_merge']:
+                self.read_sorted_directory_users(directory_groups, directory_connector)
+            else:
+                self.read_desired_user_groups(directory_groups, directory_connector)
+            if self.sync_state is not None:
+                self.select_incremental_users()
             load_directory_stats.log_end(logger)
 
         for umapi_info in self.umapi_info_by_name.values():
@@ -204,9 +250,110 @@ class RuleProcessor(object):
             self.execute_commands(command_list, umapi_connectors.get_secondary_connectors()[umapi_name])
         self.execute_commands(primary_commands, umapi_connectors.get_primary_connector())
         umapi_connectors.execute_actions()
+        if self.directory_fingerprints is not None:
+            self.save_sync_state(umapi_connectors)
         umapi_stats.log_end(logger)
         self.log_action_summary(umapi_connectors)
 
+    def select_incremental_users(self):
+        """
+        Fingerprint each selected directory user, and unless a full sync is due, narrow the work list down to
+        the users whose fingerprint differs from the one saved by the last successful sync.  The adobe users
+        fetched are then those changed users plus the users that have left the directory since the last sync.
+        """
+        self.directory_fingerprints = fingerprints = {}
+        directory_users_by_key = {}
+        for directory_user in self.filtered_directory_user_index.data:
+            user_key = self.get_directory_user_key(directory_user)
+            fingerprints[user_key] = self.get_user_fingerprint(directory_user)
+            directory_users_by_key[user_key] = directory_user
+        if self.sync_state.should_refresh:
+            self.logger.info('Incremental sync: full sync is due, so all users will be synced')
+            return
+        if self.sync_state.get_state().get('options') != self.get_sync_options_signature():
+            self.logger.info('Incremental sync: sync options have changed, so all users will be synced')
+            self.sync_state.should_refresh = True
+            return
+
+        previous_fingerprints = self.sync_state.get_fingerprints()
+        changed_keys = {k for k, f in fingerprints.items() if previous_fingerprints.get(k) != f}
+        removed_keys = previous_fingerprints.keys() - fingerprints.keys()
+        self.logger.info('Incremental sync: %d changed and %d removed directory users',
+                         len(changed_keys), len(removed_keys))
+
+        changed_users = MultiIndex([directory_users_by_key[k] for k in changed_keys], ['email', 'username'])
+        self.filtered_directory_user_index = changed_users
+        for umapi_info in self.umapi_info_by_name.values():
+            umapi_info.desired_groups_by_user_key = MultiIndex(
+                [rec for rec in umapi_info.get_desired_groups_by_user_key().data
+                 if changed_users.get(email=rec['email'], username=rec['username']) is not None],
+                ['email', 'username'])
+        self.incremental_emails = sorted({self.parse_user_key(k)[3] for k in changed_keys | removed_keys})
+        self.incremental_unchanged_count = len(fingerprints) - len(changed_keys)
+
+    def get_user_fingerprint(self, directory_user):
+        """
+        Hash the mapped attributes and desired groups of a selected directory user
+        :type directory_user: dict
+        :rtype: str
+        """
+        state = {k: directory_user.get(k) for k in ('identity_type', 'username', 'domain', 'email',
+                                                    'firstname', 'lastname', 'country')}
+        state['groups'] = groups = {}
+        for umapi_name, umapi_info in self.umapi_info_by_name.items():
+            desired_groups = umapi_info.get_desired_groups(directory_user['email'], directory_user['username'])
+            if desired_groups is not None:
+                groups[umapi_name or ''] = sorted(g for g in desired_groups['desired_groups'] if g is not None)
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf8')).hexdigest()
+
+    def get_sync_options_signature(self):
+        """
+        Hash the options in incremental_sync_options
+        :rtype: str
+        """
+        def normalize(value):
+            if value is None or isinstance(value, (bool, int, float, str)):
+                return value
+            if hasattr(value, 'pattern'):
+                return value.pattern
+            if hasattr(value, 'get_qualified_name'):
+                return value.get_qualified_name()
+            if isinstance(value, (list, tuple)):
+                return [normalize(v) for v in value]
+            if isinstance(value, (set, frozenset)):
+                return sorted((normalize(v) for v in value), key=str)
+            return str(value)
+
+        options = {name: normalize(self.options.get(name)) for name in self.incremental_sync_options}
+        return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf8')).hexdigest()
+
+    def save_sync_state(self, umapi_connectors):
+        """
+        Save the directory fingerprints, so the next incremental sync can skip unchanged users.
+        Nothing is saved in test mode or if any action failed, so the next sync tries the changes again.
+        The sync options are saved along with them, so that changing them makes the next sync a full one.
+        If the strays were skipped for exceeding the limit, the users that left the directory are kept in
+        the state (and a due full sync stays due), so the next sync looks for them again.
+        :type umapi_connectors: UmapiConnectors
+        """
+        if self.options['test_mode']:
+            return
+        errors = sum(c.get_action_manager().get_statistics()[1] for c in umapi_connectors.connectors)
+        if errors:
+            self.logger.warning('Incremental sync: %d actions failed, so the sync state was not saved', errors)
+            return
+        fingerprints = self.directory_fingerprints
+        if self.strays_skipped:
+            self.logger.warning('Incremental sync: Adobe-only users were not processed, '
+                                'so they will be checked again by the next sync')
+            fingerprints = {**self.sync_state.get_fingerprints(), **fingerprints}
+        self.sync_state.save_fingerprints(fingerprints)
+        if not self.strays_skipped:
+            self.sync_state.set_state({'options': self.get_sync_options_signature()})
+            if self.sync_state.should_refresh:
+                self.sync_state.should_refresh = False
+                self.sync_state.update_next_refresh()
+
     def validate_and_log_additional_groups(self, umapi_info):
         """
         :param umapi_info: UmapiTargetInfo
@@ -230,8 +377,10 @@ class RuleProcessor(object):
         """
         logger = self.logger
         # find the total number of directory users and selected/filtered users
-        self.action_summary['directory_users_read'] = len(self.directory_user_index.data)
-        self.action_summary['directory_users_selected'] = len(self.filtered_directory_user_index.data)
+        # (in sort-merge mode these are counted as the users are read, since they aren't indexed)
+        if not self.options['sort_merge']:
+            self.action_summary['directory_users_read'] = len(self.directory_user_index.data)
+            self.action_summary['directory_users_selected'] = len(self.filtered_directory_user_index.data)
         # find the total number of adobe users and excluded users
         self.action_summary['primary_users_read'] = self.primary_user_count
         self.action_summary['excluded_user_count'] = self.excluded_user_count
@@ -378,6 +527,9 @@ class RuleProcessor(object):
                 self.logger.warning("Ignoring directory user with empty user key: %s", directory_user)
                 continue
 
+            # both directory indexes (and any changes made by the hook) share this one compact record
+            directory_user = DirectoryUserRecord(directory_user)
+
             self.directory_user_index.add(directory_user)
 
             if not self.is_directory_user_in_groups(directory_user, directory_group_filter):
@@ -389,65 +541,11 @@ class RuleProcessor(object):
             umapi_info = self.get_umapi_info(PRIMARY_TARGET_NAME)
             umapi_info.add_desired_group_for(directory_user['identity_type'], directory_user['domain'],
                                              directory_user['email'], directory_user['username'], None)
-
-            # set up groups in hook scope; the target groups will be used whether or not there's customer hook code
-            self.after_mapping_hook_scope['source_groups'] = set()
-            self.after_mapping_hook_scope['target_groups'] = set()
-            for group in directory_user['groups']:
-                self.after_mapping_hook_scope['source_groups'].add(group)  # this is a directory group name
-                adobe_groups = mappings.get(group)
-                if adobe_groups is not None:
-                    for adobe_group in adobe_groups:
-                        self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
-
-            # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
-            if options['after_mapping_hook'] is not None:
-                self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
-
-                target_attributes = dict()
-                target_attributes['email'] = directory_user.get('email')
-                target_attributes['username'] = directory_user.get('username')
-                target_attributes['domain'] = directory_user.get('domain')
-                target_attributes['firstname'] = directory_user.get('firstname')
-                target_attributes['lastname'] = directory_user.get('lastname')
-                target_attributes['country'] = directory_user.get('country')
-                self.after_mapping_hook_scope['target_attributes'] = target_attributes
-
-                # invoke the customer's hook code
-                self.log_after_mapping_hook_scope(before_call=True)
-                exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
-                self.log_after_mapping_hook_scope(after_call=True)
-
-                # copy modified attributes back to the user object
-                directory_user.update(self.after_mapping_hook_scope['target_attributes'])
-
-            for target_group_qualified_name in self.after_mapping_hook_scope['target_groups']:
-                target_group = AdobeGroup.lookup(target_group_qualified_name)
-                if target_group is not None:
-                    umapi_info = self.get_umapi_info(target_group.get_umapi_name())
+            for umapi_name, group_names in self.map_directory_user(directory_user, mappings).items():
+                umapi_info = self.get_umapi_info(umapi_name)
+                for group_name in group_names:
                     umapi_info.add_desired_group_for(directory_user['identity_type'], directory_user['domain'],
-                                                     directory_user['email'], directory_user['username'], target_group.get_group_name())
-                else:
-                    self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
-
-            additional_groups = self.options.get('additional_groups', [])
-            member_groups = directory_user.get('member_groups', [])
-            for member_group in member_groups:
-                for group_rule in additional_groups:
-                    source = group_rule['source']
-                    target = group_rule['target']
-                    target_name = target.get_group_name()
-                    umapi_info = self.get_umapi_info(target.get_umapi_name())
-                    if not group_rule['source'].match(member_group):
-                        continue
-                    try:
-                        rename_group = source.sub(target_name, member_group)
-                    except Exception as e:
-                        raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
-                    umapi_info.add_mapped_group(rename_group)
-                    umapi_info.add_additional_group(rename_group, member_group)
-                    umapi_info.add_desired_group_for(directory_user['identity_type'], directory_user['domain'],
-                                                     directory_user['email'], directory_user['username'], rename_group)
+                                                     directory_user['email'], directory_user['username'], group_name)
 
         self.logger.debug('Total directory users after filtering: %d', len(self.filtered_directory_user_index.data))
         if self.logger.isEnabledFor(logging.DEBUG):
@@ -455,6 +553,121 @@ class RuleProcessor(object):
                                                            for umapi_name, umapi_info
                                                            in self.umapi_info_by_name.items()]))
 
+    def map_directory_user(self, directory_user, mappings):
+        """
+        Work out the adobe groups a selected directory user should be in, running the after-mapping
+        hook (if any) on the way.  The hook may change the user's attributes, which are updated in place.
+        Additional group rules that match the user's member groups are registered with the umapi info.
+        :type directory_user: dict
+        :type mappings: dict(str, list(AdobeGroup))
+        :return: the desired group names for the user, by umapi name
+        :rtype: dict(str, set(str))
+        """
+        options = self.options
+        desired_groups = defaultdict(set)
+
+        # set up groups in hook scope; the target groups will be used whether or not there's customer hook code
+        self.after_mapping_hook_scope['source_groups'] = set()
+        self.after_mapping_hook_scope['target_groups'] = set()
+        for group in directory_user['groups']:
+            self.after_mapping_hook_scope['source_groups'].add(group)  # this is a directory group name
+            adobe_groups = mappings.get(group)
+            if adobe_groups is not None:
+                for adobe_group in adobe_groups:
+                    self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
+
+        # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
+        if options['after_mapping_hook'] is not None:
+            self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
+
+            target_attributes = dict()
+            target_attributes['email'] = directory_user.get('email')
+            target_attributes['username'] = directory_user.get('username')
+            target_attributes['domain'] = directory_user.get('domain')
+            target_attributes['firstname'] = directory_user.get('firstname')
+            target_attributes['lastname'] = directory_user.get('lastname')
+            target_attributes['country'] = directory_user.get('country')
+            self.after_mapping_hook_scope['target_attributes'] = target_attributes
+
+            # invoke the customer's hook code
+            self.log_after_mapping_hook_scope(before_call=True)
+            exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
+            self.log_after_mapping_hook_scope(after_call=True)
+
+            # copy modified attributes back to the user object
+            directory_user.update(self.after_mapping_hook_scope['target_attributes'])
+
+        for target_group_qualified_name in self.after_mapping_hook_scope['target_groups']:
+            target_group = AdobeGroup.lookup(target_group_qualified_name)
+            if target_group is not None:
+                desired_groups[target_group.get_umapi_name()].add(target_group.get_group_name())
+            else:
+                self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
+
+        additional_groups = self.options.get('additional_groups', [])
+        member_groups = directory_user.get('member_groups', [])
+        for member_group in member_groups:
+            for group_rule in additional_groups:
+                source = group_rule['source']
+                target = group_rule['target']
+                target_name = target.get_group_name()
+                umapi_info = self.get_umapi_info(target.get_umapi_name())
+                if not group_rule['source'].match(member_group):
+                    continue
+                try:
+                    rename_group = source.sub(target_name, member_group)
+                except Exception as e:
+                    raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
+                umapi_info.add_mapped_group(rename_group)
+                umapi_info.add_additional_group(rename_group, member_group)
+                desired_groups[target.get_umapi_name()].add(rename_group)
+        return desired_groups
+
+    def read_sorted_directory_users(self, mappings, directory_connector):
+        """
+        The sort-merge counterpart of read_desired_user_groups.  Instead of indexing the directory users,
+        each selected user is mapped to its desired primary groups as it is read, and the results are
+        sorted by email (spilling to temporary files as needed) for sort_merge_umapi_users.  Note that
+        this only bounds the memory used here: the directory connector may still load all of its users.
+        :type mappings: dict(str, list(AdobeGroup))
+        :type directory_connector: user_sync.connector.directory.DirectoryConnector
+        """
+        self.logger.debug('Building sorted work list...')
+
+        options = self.options
+        directory_group_filter = options['directory_group_filter']
+        if directory_group_filter is not None:
+            directory_group_filter = set(directory_group_filter)
+        extended_attributes = options.get('extended_attributes')
+
+        directory_groups = set(mappings.keys()) if self.will_process_groups() else set()
+        if directory_group_filter is not None:
+            directory_groups.update(directory_group_filter)
+        directory_users = directory_connector.load_users_and_groups(groups=directory_groups,
+                                                                    extended_attributes=extended_attributes,
+                                                                    all_users=directory_group_filter is None)
+
+        def selected_users():
+            for seq, directory_user in enumerate(directory_users):
+                user_key = self.get_directory_user_key(directory_user)
+                if not user_key:
+                    self.logger.warning("Ignoring directory user with empty user key: %s", directory_user)
+                    continue
+                self.action_summary['directory_users_read'] += 1
+                if not self.is_directory_user_in_groups(directory_user, directory_group_filter):
+                    continue
+                if not self.is_selected_user_key(user_key):
+                    continue
+                self.action_summary['directory_users_selected'] += 1
+
+                directory_user = dict(directory_user)
+                desired_groups = self.map_directory_user(directory_user, mappings)
+                yield (self.get_merge_key(directory_user['email']), seq, directory_user,
+                       self.normalize_groups(desired_groups[PRIMARY_TARGET_NAME]))
+
+        self.sorted_directory_users = ExternalSorter(key=itemgetter(0, 1)).sort(selected_users())
+        self.logger.debug('Total directory users after filtering: %d', self.action_summary['directory_users_selected'])
+
     def is_directory_user_in_groups(self, directory_user, groups):
         """
         :type directory_user: dict
@@ -482,56 +695,107 @@ class RuleProcessor(object):
             verb = "Push"
         else:
             verb = "Sync"
+        if self.options['sort_merge']:
+            umapi_info, umapi_connector = self.get_umapi_info(PRIMARY_TARGET_NAME), umapi_connectors.get_primary_connector()
+            return self.sort_merge_umapi_users(umapi_info, umapi_connector), secondary_command_lists
         exclude_unmapped_users = self.will_exclude_unmapped_users()
-        # first sync the primary connector, so the users get created in the primary
-        if umapi_connectors.get_secondary_connectors():
-            self.logger.debug('Processing %s users for primary umapi...', verb)
-        else:
-            self.logger.debug('%sing users to umapi...', verb)
-        umapi_info, umapi_connector = self.get_umapi_info(PRIMARY_TARGET_NAME), umapi_connectors.get_primary_connector()
-        if self.push_umapi:
-            primary_adds = umapi_info.get_desired_groups_by_user_key().data
-        else:
-            primary_adds, update_commands = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
-            primary_commands.extend(update_commands)
-        # save groups for new users
-
-        total_users = len(primary_adds.data)
-
-        user_count = 0
-        for primary_add in primary_adds.data:
-            user_count += 1
-            if exclude_unmapped_users and not primary_add['desired_groups']:
-                # If user is not part of any group and ignore outcast is enabled. Do not create user.
-                continue
-            user_key = self.get_user_key(primary_add['id_type'], primary_add['username'],
-                                         primary_add['domain'], primary_add['email'])
-            primary_commands.append(self.create_umapi_user(user_key, primary_add['desired_groups'], umapi_info, umapi_connector.trusted))
-
-        # then sync the secondary connectors
-        for umapi_name, umapi_connector in umapi_connectors.get_secondary_connectors().items():
-            umapi_info = self.get_umapi_info(umapi_name)
-            if len(umapi_info.get_mapped_groups()) == 0:
-                continue
-            self.logger.debug('Processing %s users for secondary umapi %s...', verb, umapi_name)
+        # start downloading the secondary users now, so it overlaps with the primary sync
+        with self.prefetch_umapi_users(umapi_connectors.get_secondary_connectors()) as prefetched_users:
+            # first sync the primary connector, so the users get created in the primary
+            if umapi_connectors.get_secondary_connectors():
+                self.logger.debug('Processing %s users for primary umapi...', verb)
+            else:
+                self.logger.debug('%sing users to umapi...', verb)
+            umapi_info, umapi_connector = self.get_umapi_info(PRIMARY_TARGET_NAME), umapi_connectors.get_primary_connector()
             if self.push_umapi:
-                secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
+                primary_adds = umapi_info.get_desired_groups_by_user_key().data
             else:
-                secondary_adds_by_user_key, update_commands = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
-                secondary_command_lists[umapi_name].extend(update_commands)
-            total_users = len(secondary_adds_by_user_key.data)
-            for secondary_add in secondary_adds_by_user_key.data:
-                # We only create users who have group mappings in the secondary umapi
-                if secondary_add['desired_groups']:
-                    user_key = self.get_user_key(secondary_add['id_type'], secondary_add['username'],
-                                                 secondary_add['domain'], secondary_add['email'])
-                    self.secondary_users_created.add(user_key)
-                    if user_key not in self.primary_users_created:
-                        # We pushed an existing user to a secondary in order to update his groups
-                        self.updated_user_keys.add(user_key)
-                    secondary_command_lists[umapi_name].append(self.create_umapi_user(user_key, secondary_add['desired_groups'],
-                                                                                      umapi_info, umapi_connector.trusted))
-        return primary_commands, secondary_command_lists
+                primary_adds, update_commands = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+                primary_commands.extend(update_commands)
+            # save groups for new users
+
+            total_users = len(primary_adds.data)
+
+            user_count = 0
+            for primary_add in primary_adds.data:
+                user_count += 1
+                if exclude_unmapped_users and not primary_add['desired_groups']:
+                    # If user is not part of any group and ignore outcast is enabled. Do not create user.
+                    continue
+                user_key = self.get_user_key(primary_add['id_type'], primary_add['username'],
+                                             primary_add['domain'], primary_add['email'])
+                primary_commands.append(self.create_umapi_user(user_key, primary_add['desired_groups'], umapi_info, umapi_connector.trusted))
+
+            # then sync the secondary connectors
+            for umapi_name, umapi_connector in umapi_connectors.get_secondary_connectors().items():
+                umapi_info = self.get_umapi_info(umapi_name)
+                if len(umapi_info.get_mapped_groups()) == 0:
+                    continue
+                self.logger.debug('Processing %s users for secondary umapi %s...', verb, umapi_name)
+                if self.push_umapi:
+                    secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
+                else:
+                    secondary_adds_by_user_key, update_commands = self.update_umapi_users_for_connector(
+                        umapi_info, umapi_connector, prefetched_users[umapi_name].result())
+                    secondary_command_lists[umapi_name].extend(update_commands)
+                total_users = len(secondary_adds_by_user_key.data)
+                for secondary_add in secondary_adds_by_user_key.data:
+                    # We only create users who have group mappings in the secondary umapi
+                    if secondary_add['desired_groups']:
+                        user_key = self.get_user_key(secondary_add['id_type'], secondary_add['username'],
+                                                     secondary_add['domain'], secondary_add['email'])
+                        self.secondary_users_created.add(user_key)
+                        if user_key not in self.primary_users_created:
+                            # We pushed an existing user to a secondary in order to update his groups
+                            self.updated_user_keys.add(user_key)
+                        secondary_command_lists[umapi_name].append(self.create_umapi_user(user_key, secondary_add['desired_groups'],
+                                                                                          umapi_info, umapi_connector.trusted))
+            return primary_commands, secondary_command_lists
+
+    @contextmanager
+    def prefetch_umapi_users(self, umapi_connectors):
+        """
+        Fetch the users of each of the given umapi connectors concurrently, in the background, yielding
+        a future for the users of each one.  Only connectors that have mapped groups are fetched, since the
+        others are not synced.  Nothing is fetched when pushing, since we don't read Adobe users in that case.
+        Leaving the context waits for the fetches to end; if it is left with an error, fetches that haven't
+        started are cancelled, and those in flight stop at their next user, so no query is left running.
+        :type umapi_connectors: dict(str, UmapiConnector)
+        :rtype: dict(str, concurrent.futures.Future)
+        """
+        umapi_names = [umapi_name for umapi_name in umapi_connectors
+                       if self.get_umapi_info(umapi_name).get_mapped_groups()]
+        if self.push_umapi or not umapi_names:
+            yield {}
+            return
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=len(umapi_names), thread_name_prefix='umapi-prefetch') as executor:
+            prefetched_users = {}
+            for umapi_name in umapi_names:
+                umapi_users = self.get_umapi_users(self.get_umapi_info(umapi_name), umapi_connectors[umapi_name])
+                prefetched_users[umapi_name] = executor.submit(self.fetch_umapi_users, umapi_users, stop)
+            try:
+                yield prefetched_users
+            except BaseException:
+                stop.set()
+                for future in prefetched_users.values():
+                    future.cancel()
+                raise
+
+    @staticmethod
+    def fetch_umapi_users(umapi_users, stop):
+        """
+        Read all the users, unless the stop event is set first
+        :type umapi_users: iterable(dict)
+        :type stop: threading.Event
+        :rtype: list(dict)
+        """
+        fetched_users = []
+        for umapi_user in umapi_users:
+            if stop.is_set():
+                raise CancelledError()
+            fetched_users.append(umapi_user)
+        return fetched_users
 
     def execute_commands(self, command_list, connector):
         # do nothing if we have no commands for this connector
@@ -643,9 +907,12 @@ class RuleProcessor(object):
             self.write_stray_key_map()
         if self.will_manage_strays:
             max_missing_option = self.options['max_adobe_only_users']
+            # an incremental sync only reads the changed adobe users, but the unchanged ones count towards the limit
+            primary_user_count = self.primary_user_count + self.incremental_unchanged_count
             if not check_max_limit(stray_count, max_missing_option, 
-                        self.primary_user_count, self.excluded_user_count, 'Adobe', self.logger):
+                        primary_user_count, self.excluded_user_count, 'Adobe', self.logger):
                 self.action_summary['primary_strays_processed'] = 0
+                self.strays_skipped = True
                 return primary_commands, secondary_command_lists
             self.logger.debug("Processing Adobe-only users...")
             return self.manage_strays(primary_commands, secondary_command_lists, umapi_connectors)
@@ -806,7 +1073,7 @@ class RuleProcessor(object):
 
         return commands
 
-    def create_umapi_user(self, user_key, groups_to_add, umapi_info, trusted):
+    def create_umapi_user(self, user_key, groups_to_add, umapi_info, trusted, directory_user=None):
         """
         Add the user to the org on the receiving end of the given umapi connector.
         If the connector is the primary connector, we ask to update the user's attributes because
@@ -819,8 +1086,10 @@ class RuleProcessor(object):
         :type groups_to_add: set
         :type umapi_info: UmapiTargetInfo
         :type trusted: bool
+        :type directory_user: dict # looked up in the directory index by user key if not given
         """
-        directory_user = self.get_from_index(self.directory_user_index, user_key)
+        if directory_user is None:
+            directory_user = self.get_directory_user(user_key)
 
         commands = self.create_umapi_commands_for_directory_user(directory_user, self.will_update_user_info(umapi_info), trusted)
         if not commands:
@@ -838,6 +1107,16 @@ class RuleProcessor(object):
             self.primary_users_created.add(user_key)
         return commands
 
+    def get_directory_user(self, user_key):
+        """
+        Look up a directory user (selected or not) by user key.  In sort-merge mode the directory users aren't
+        indexed, so they can't be looked up: the sort-merge passes the matched directory user wherever one is
+        needed, and a user with no selected match only ever becomes a stray, just as with the index.
+        """
+        if self.options['sort_merge']:
+            raise user_sync.error.AssertionException("Directory users can't be looked up by key in sort-merge mode: %s" % user_key)
+        return self.get_from_index(self.directory_user_index, user_key)
+
     def get_from_index(self, index, user_key):
         """Parse user key and try to retrieve user from provided index"""
 
@@ -845,7 +1124,7 @@ class RuleProcessor(object):
         return index.get(email=email, username=username)
 
     def update_umapi_user(self, umapi_info, user_key, attributes_to_update=None, groups_to_add=None,
-                          groups_to_remove=None, umapi_user=None):
+                          groups_to_remove=None, umapi_user=None, directory_user=None):
         # Note that the user may exist only in the directory, only in the umapi, or both at this point.
         # When we are updating an Adobe user who has been removed from the directory, we have to be careful to use
         # data from the umapi_user parameter and not try to get information from the directory.
@@ -857,6 +1136,7 @@ class RuleProcessor(object):
         :type groups_to_add: set(str)
         :type groups_to_remove: set(str)
         :type umapi_user: dict # with type, username, domain, and email entries
+        :type directory_user: dict # looked up in the directory index by user key if not given
         """
         if attributes_to_update or groups_to_add or groups_to_remove:
             self.updated_user_keys.add(user_key)
@@ -870,7 +1150,8 @@ class RuleProcessor(object):
                 self.logger.info('Managing groups in %s for user key: %s added: %s removed: %s',
                                  umapi_info.get_name(), user_key, groups_to_add, groups_to_remove)
 
-        directory_user = self.get_from_index(self.directory_user_index, user_key)
+        if directory_user is None:
+            directory_user = self.get_directory_user(user_key)
         if directory_user is not None:
             identity_type = self.get_identity_type_from_directory_user(directory_user)
         else:
@@ -900,7 +1181,7 @@ class RuleProcessor(object):
         commands.add_groups(groups_to_add)
         return commands
 
-    def update_umapi_users_for_connector(self, umapi_info, umapi_connector: UmapiConnector):
+    def update_umapi_users_for_connector(self, umapi_info, umapi_connector: UmapiConnector, umapi_users=None):
         """
         This is the main function that goes over adobe users and looks for and processes differences.
         It is called with a particular organization that it should manage groups against.
@@ -910,6 +1191,7 @@ class RuleProcessor(object):
         The use of this return value by the caller is to create the user and add him to the right groups.
         :type umapi_info: UmapiTargetInfo
         :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :type umapi_users: iterable(dict) - users already fetched from the connector, if any
         :rtype: map(string, set)
         """
         command_list = []
@@ -918,21 +1200,15 @@ class RuleProcessor(object):
         # to their groups in this umapi, make a copy, and pop off any adobe users we find.
         # That way, any key/value pairs left in the map are the unmatched adobe users and their groups.
         dir_user_groups_all = umapi_info.get_desired_groups_by_user_key()
-        dir_user_groups_update = MultiIndex([], ['email', 'username'])
-
-        # compute all static options before looping over users
-        in_primary_org = self.is_primary_org(umapi_info)
-        update_user_info = self.will_update_user_info(umapi_info)
-        process_groups = self.will_process_groups()
+        # positions in dir_user_groups_all of the desired groups records that matched an adobe user
+        dir_user_groups_update = set()
 
         # prepare the strays map if we are going to be processing them
         if self.will_process_strays:
             self.add_stray(umapi_info.get_name(), None)
 
-        if self.options['adobe_group_filter'] is not None:
-            umapi_users = self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
-        else:
-            umapi_users = umapi_connector.iter_users()
+        if umapi_users is None:
+            umapi_users = self.get_umapi_users(umapi_info, umapi_connector)
         # Walk all the adobe us
         # and adjusting their attribute and group data accordingly.
         for umapi_user in umapi_users:
@@ -950,66 +1226,187 @@ class RuleProcessor(object):
                 self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
                 continue
             umapi_info.add_umapi_user(umapi_user)
-            attribute_differences = {}
             current_groups = self.normalize_groups(umapi_user.get('groups'))
-            groups_to_add = set()
-            groups_to_remove = set()
 
             # If this adobe user matches any directory user, pop them out of the
             # map because we know they don't need to be created.
             # Also, keep track of the mapped groups for the directory user
             # so we can update the adobe user's groups as needed.
-            desired_groups_rec = self.get_from_index(dir_user_groups_all, user_key)
+            _, username, _, email = self.parse_user_key(user_key)
+            desired_groups_i = dir_user_groups_all.get_index(email=email, username=username)
             desired_groups = set()
-            if desired_groups_rec is not None:
-                dir_user_groups_update.add(desired_groups_rec)
-                desired_groups = desired_groups_rec['desired_groups']
-
-            # check for excluded users
-            if self.is_umapi_user_excluded(in_primary_org, user_key, current_groups):
-                continue
-
-            self.map_email_override(umapi_user)
-
-            directory_user = self.get_from_index(self.filtered_directory_user_index, user_key)
-            if directory_user is None:
-                # There's no selected directory user matching this adobe user
-                # so we mark this adobe user as a stray, and we mark him
-                # for removal from any mapped groups.
-                if self.exclude_strays:
-                    self.logger.debug("Excluding Adobe-only user: %s", user_key)
-                    self.excluded_user_count += 1
-                elif self.will_process_strays:
-                    self.logger.debug("Found Adobe-only user: %s", user_key)
-                    self.add_stray(umapi_info.get_name(), user_key,
-                                   None if not process_groups else current_groups & umapi_info.get_mapped_groups())
-            else:
-                # There is a selected directory user who matches this adobe user,
-                # so mark any changed umapi attributes,
-                # and mark him for addition and removal of the appropriate mapped groups
-                if update_user_info or process_groups:
-                    self.logger.debug("Adobe user matched on customer side: %s", user_key)
-                if update_user_info:
-                    attribute_differences = self.get_user_attribute_difference(directory_user, umapi_user)
-                if process_groups:
-                    groups_to_add = desired_groups - current_groups
-                    groups_to_remove = (current_groups - desired_groups) & umapi_info.get_mapped_groups()
-
-            # Finally, execute the attribute and group adjustments
-            # if we have nothing to update, omit this user
-            if not attribute_differences and not groups_to_add and not groups_to_remove:
-                continue
-            command_list.append(self.update_umapi_user(umapi_info, user_key, attribute_differences,
-                                groups_to_add, groups_to_remove, umapi_user))
+            if desired_groups_i is not None:
+                dir_user_groups_update.add(desired_groups_i)
+                desired_groups = dir_user_groups_all.data[desired_groups_i]['desired_groups']
+
+            commands = self.diff_umapi_user(umapi_info, user_key, umapi_user, current_groups, desired_groups,
+                                            self.get_from_index(self.filtered_directory_user_index, user_key))
+            if commands is not None:
+                command_list.append(commands)
         # mark the umapi's adobe users as processed and return the remaining ones in the map
         umapi_info.set_umapi_users_loaded()
-        new_user_groups = MultiIndex([], ['email', 'username'])
-        for user in dir_user_groups_all.data:
-            r = dir_user_groups_update.get(email=user['email'], username=user['username'])
-            if r is None:
-                new_user_groups.add(user)
+        new_user_groups = MultiIndex([rec for i, rec in enumerate(dir_user_groups_all.data)
+                                      if i not in dir_user_groups_update], ['email', 'username'])
         return (new_user_groups, command_list)
 
+    def sort_merge_umapi_users(self, umapi_info, umapi_connector):
+        """
+        The sort-merge counterpart of update_umapi_users_for_connector and the creation of new users.
+        As there, an adobe user matches the (last) directory user with its email or, failing that, the
+        one with its username, and later adobe users sharing either with an earlier one are ignored.
+        So the users are merged twice: first sorted by email, as the directory users already are, and
+        then by username, carrying along what the first pass matched.  Each sort spills to temporary
+        files as needed, so only the users sharing an email or username are in memory at once.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :rtype: list(user_sync.connector.connector_umapi.Commands)
+        """
+        command_list = []
+        exclude_unmapped_users = self.will_exclude_unmapped_users()
+        if self.will_process_strays:
+            self.add_stray(umapi_info.get_name(), None)
+
+        def keyed_umapi_users():
+            for seq, umapi_user in enumerate(self.get_umapi_users(umapi_info, umapi_connector)):
+                # if target is ESM, then override identity type
+                if umapi_connector.uses_business_id:
+                    umapi_user['type'] = self.options['new_account_type']
+                # AdobeID users are saved while sorting, so they are known before any user is created
+                self.filter_adobeID_user(umapi_user)
+                user_key = self.get_umapi_user_key(umapi_user)
+                if not user_key:
+                    self.logger.warning("Ignoring umapi user with empty user key: %s", umapi_user)
+                    continue
+                _, username, _, email = self.parse_user_key(user_key)
+                yield self.get_merge_key(email), seq, username, user_key, umapi_user
+
+        def merge_by_email():
+            """
+            Match the users on email, and yield them keyed by username for the second pass:
+            (username, 0, seq, (user_key, umapi_user, email match)) for each adobe user not already seen,
+            and (username, 1, seq, (directory_user, desired_groups, matched)) for each directory user.
+            """
+            umapi_users = ExternalSorter(key=itemgetter(0, 1)).sort(keyed_umapi_users())
+            merged = heapq.merge(((key, 0, item) for key, *item in umapi_users),
+                                 ((key, 1, item) for key, *item in self.sorted_directory_users),
+                                 key=itemgetter(0, 1))
+            for email, items in groupby(merged, key=itemgetter(0)):
+                umapi_items, directory_items = [], []
+                for _, side, item in items:
+                    (directory_items if side else umapi_items).append(item)
+                match = directory_items[-1] if email and directory_items else None
+                for i, (seq, username, user_key, umapi_user) in enumerate(umapi_items):
+                    if i and email:
+                        self.logger.debug("Ignoring umapi user. This user has already been processed: %s",
+                                          umapi_user)
+                        continue
+                    email_match = match[1:] if match is not None else None
+                    yield self.get_merge_key(username), 0, seq, (user_key, umapi_user, email_match)
+                for seq, directory_user, desired_groups in directory_items:
+                    matched = bool(umapi_items) and match is not None and seq == match[0]
+                    yield (self.get_merge_key(directory_user['username']), 1, seq,
+                           (directory_user, desired_groups, matched))
+
+        for username, items in groupby(ExternalSorter(key=itemgetter(0, 1, 2)).sort(merge_by_email()),
+                                       key=itemgetter(0)):
+            umapi_items, directory_items = [], []
+            for _, side, seq, item in items:
+                (directory_items if side else umapi_items).append((seq, item))
+            match = directory_items[-1][1] if username and directory_items else None
+            username_matched = False
+            for i, (_, (user_key, umapi_user, email_match)) in enumerate(umapi_items):
+                if i and username:
+                    self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
+                    continue
+                directory_user, desired_groups = None, set()
+                if email_match is not None:
+                    directory_user, desired_groups = email_match
+                elif match is not None:
+                    directory_user, desired_groups, _ = match
+                    username_matched = True
+                current_groups = self.normalize_groups(umapi_user.get('groups'))
+                commands = self.diff_umapi_user(umapi_info, user_key, umapi_user, current_groups, desired_groups,
+                                                directory_user)
+                if commands is not None:
+                    command_list.append(commands)
+            # whatever directory users are left unmatched need to be created
+            for _, (directory_user, desired_groups, matched) in directory_items:
+                if matched or (username_matched and directory_user is match[0]):
+                    continue
+                if exclude_unmapped_users and not desired_groups:
+                    # If user is not part of any group and ignore outcast is enabled. Do not create user.
+                    continue
+                user_key = self.get_directory_user_key(directory_user)
+                command_list.append(self.create_umapi_user(user_key, desired_groups, umapi_info,
+                                                           umapi_connector.trusted, directory_user))
+        umapi_info.set_umapi_users_loaded()
+        return command_list
+
+    @staticmethod
+    def get_merge_key(value):
+        """
+        The key that directory and adobe users are sorted and matched on in sort-merge mode:
+        the email or username, lowercased just as MultiIndex does.
+        :type value: str
+        :rtype: str
+        """
+        return (value or '').lower()
+
+    def diff_umapi_user(self, umapi_info, user_key, umapi_user, current_groups, desired_groups, directory_user):
+        """
+        Compare an adobe user with the selected directory user it matches (if any), and return the
+        commands needed to bring the adobe user in line.  Adobe users that don't match a selected
+        directory user are recorded as strays.
+        :type umapi_info: UmapiTargetInfo
+        :type user_key: str
+        :type umapi_user: dict
+        :type current_groups: set(str)
+        :type desired_groups: set(str)
+        :type directory_user: dict
+        :rtype: user_sync.connector.connector_umapi.Commands (or None if there's nothing to do)
+        """
+        attribute_differences = {}
+        groups_to_add = set()
+        groups_to_remove = set()
+        update_user_info = self.will_update_user_info(umapi_info)
+        process_groups = self.will_process_groups()
+
+        # check for excluded users
+        if self.is_umapi_user_excluded(self.is_primary_org(umapi_info), user_key, current_groups):
+            return None
+
+        self.map_email_override(umapi_user)
+
+        if directory_user is None:
+            # There's no selected directory user matching this adobe user
+            # so we mark this adobe user as a stray, and we mark him
+            # for removal from any mapped groups.
+            if self.exclude_strays:
+                self.logger.debug("Excluding Adobe-only user: %s", user_key)
+                self.excluded_user_count += 1
+            elif self.will_process_strays:
+                self.logger.debug("Found Adobe-only user: %s", user_key)
+                self.add_stray(umapi_info.get_name(), user_key,
+                               None if not process_groups else current_groups & umapi_info.get_mapped_groups())
+        else:
+            # There is a selected directory user who matches this adobe user,
+            # so mark any changed umapi attributes,
+            # and mark him for addition and removal of the appropriate mapped groups
+            if update_user_info or process_groups:
+                self.logger.debug("Adobe user matched on customer side: %s", user_key)
+            if update_user_info:
+                attribute_differences = self.get_user_attribute_difference(directory_user, umapi_user)
+            if process_groups:
+                groups_to_add = desired_groups - current_groups
+                groups_to_remove = (current_groups - desired_groups) & umapi_info.get_mapped_groups()
+
+        # Finally, execute the attribute and group adjustments
+        # if we have nothing to update, omit this user
+        if not attribute_differences and not groups_to_add and not groups_to_remove:
+            return None
+        return self.update_umapi_user(umapi_info, user_key, attribute_differences,
+                                      groups_to_add, groups_to_remove, umapi_user, directory_user)
+
     def map_email_override(self, umapi_user):
         """
         for users with email-type usernames that don't match the email address, we need to add some
@@ -1022,6 +1419,38 @@ class RuleProcessor(object):
         if '@' in username and username != email.lower():
             self.email_override[username] = email
 
+    def get_umapi_users(self, umapi_info, umapi_connector):
+        """
+        Iterate the users of the umapi connector, restricted to the adobe group filter if there is one
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :rtype: iterable(dict)
+        """
+        if self.incremental_emails is not None:
+            return self.get_incremental_umapi_users(umapi_info, umapi_connector)
+        if self.options['adobe_group_filter'] is not None:
+            return self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
+        return umapi_connector.iter_users()
+
+    def get_incremental_umapi_users(self, umapi_info, umapi_connector):
+        """
+        Look up just the users an incremental sync needs, restricted to the adobe group filter if there is one
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :rtype: iterable(dict)
+        """
+        filter_groups = None
+        if self.options['adobe_group_filter'] is not None:
+            filter_groups = self.normalize_groups(group.get_group_name() for group in self.options['adobe_group_filter']
+                                                  if group.get_umapi_name() == umapi_info.get_name())
+        for email in self.incremental_emails:
+            umapi_user = umapi_connector.get_user(email)
+            if umapi_user is None:
+                continue
+            if filter_groups is not None and not filter_groups & self.normalize_groups(umapi_user.get('groups')):
+                continue
+            yield umapi_user
+
     @staticmethod
     def get_umapi_user_in_groups(umapi_info, umapi_connector, groups):
         umapi_users_iters = []
@@ -1168,7 +1597,8 @@ class RuleProcessor(object):
                                             ummapi_name_column_name,
                                         ],
                                         logger=self.logger,
-                                        delimiter=delimiter)
+                                        delimiter=delimiter,
+                                        only_recognized_columns=True)
         for row in rows:
             umapi_name = row.get(ummapi_name_column_name) or PRIMARY_TARGET_NAME
             id_type = row.get(id_type_column_name)
@@ -1206,24 +1636,25 @@ class RuleProcessor(object):
         # figure out if we should include a umapi column
         secondary_count = 0
         fieldnames = ['type', 'email', 'domain']
-        rows = []
         # count the secondaries, and if there are any add the name as a column
         for umapi_name in self.stray_key_map:
             if umapi_name != PRIMARY_TARGET_NAME and self.get_stray_keys(umapi_name):
                 if not secondary_count:
                     fieldnames.append('umapi')
                 secondary_count += 1
-        for umapi_name in self.stray_key_map:
-            for user_key in self.get_stray_keys(umapi_name):
-                id_type, username, domain, email = self.parse_user_key(user_key)
+
+        def rows():
+            # the rows are written as they are made, rather than all being built first
+            for umapi_name in self.stray_key_map:
                 umapi = umapi_name if umapi_name else ""
-                if secondary_count:
-                    row_dict = {'type': id_type, 'email': email, 'domain': domain, 'umapi': umapi}
-                else:
-                    row_dict = {'type': id_type, 'email': email, 'domain': domain}
-                rows.append(row_dict)
+                for user_key in self.get_stray_keys(umapi_name):
+                    id_type, username, domain, email = self.parse_user_key(user_key)
+                    if secondary_count:
+                        yield {'type': id_type, 'email': email, 'domain': domain, 'umapi': umapi}
+                    else:
+                        yield {'type': id_type, 'email': email, 'domain': domain}
 
-        CSVAdapter.write_csv_rows(file_path, fieldnames, rows)
+        CSVAdapter.write_csv_rows(file_path, fieldnames, rows())
         user_count = len(self.stray_key_map.get(PRIMARY_TARGET_NAME, []))
         user_plural = "" if user_count == 1 else "s"
         if secondary_count > 0:
@@ -1342,17 +1773,17 @@ class UmapiTargetInfo:
             groups = set()
             if normalized_group_name is not None:
                 groups.add(normalized_group_name)
-            desired_groups_rec = {
-                'id_type': id_type,
-                'domain': domain,
-                'email': email,
-                'username': username,
-                'desired_groups': groups,
-            }
+            desired_groups_rec = DesiredGroupsRecord(
+                id_type=id_type,
+                domain=domain,
+                email=email,
+                username=username,
+                desired_groups=groups,
+            )
             self.desired_groups_by_user_key.add(desired_groups_rec)
         else:
+            # the record is shared with the index, so updating it in place is enough
             desired_groups_rec['desired_groups'].add(normalized_group_name)
-            self.desired_groups_by_user_key.update(desired_groups_rec, email=email, username=username)
 
     def add_umapi_user(self, user):
         """
@@ -1377,6 +1808,87 @@ class UmapiTargetInfo:
         return "UmapiTargetInfo('name': %s)" % self.name
 
 
+class Record(MutableMapping):
+    """
+    A dict-like record that keeps its well-known keys in slots rather than in a
+    per-record hash table, which makes it several times smaller than the equivalent
+    dict.  Subclasses list their well-known keys in __slots__.  Any other key is kept
+    in an overflow dict, which is only created if such a key is set.
+
+    Records compare equal to dicts with the same items, and support the usual dict
+    operations (get, update, items, etc.), so code that handles records does not need
+    to know it isn't dealing with a dict.
+    """
+    __slots__ = ('_extra',)
+    fields = frozenset()
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in self.__slots__:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return type(self)(self)
+
+
+class DirectoryUserRecord(Record):
+    """
+    A directory user, as returned by the directory connectors
+    """
+    __slots__ = ('identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country',
+                 'member_groups', 'source_attributes')
+    fields = frozenset(__slots__)
+
+
+class DesiredGroupsRecord(Record):
+    """
+    The identity of a directory user along with the adobe groups they should be in
+    """
+    __slots__ = ('id_type', 'domain', 'email', 'username', 'desired_groups')
+    fields = frozenset(__slots__)
+
+
 class MultiIndex:
     """
     This data structure replaces the old convention of caching users in a
@@ -1408,6 +1920,11 @@ class MultiIndex:
     the ability to update existing records. It does not support
     deletion because that would require a full reindex for each
     deletion.
+
+    Index keys are interned, so that the same lowercased key (e.g. an email
+    that is also a username, or a user that is held in several indexes) is
+    only stored once.  Large indexes should hold compact records (see
+    Record) rather than dicts.
     """
     def __init__(self, data, key_names):
         self.data = data
@@ -1441,7 +1958,7 @@ class MultiIndex:
             k = obj.get(kn)
             if k is None:
                 raise KeyError(f"Can't find key '{kn}' on object {obj=}")
-            self.index[kn][k.lower()] = i
+            self.index[kn][sys.intern(k.lower())] = i
 
     def add(self, obj):
         i = len(self.data)
@@ -1465,4 +1982,4 @@ class MultiIndex:
         for kn, keys in reindex.items():
             old, new = keys
             del self.index[kn][old]
-            self.index[kn][new] = i
+            self.index[kn][sys.intern(new)] = i
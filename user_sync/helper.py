@@ -18,10 +18,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import contextlib
 import csv
 import datetime
+import gzip
+import heapq
+import io
+import json
+import mmap
 import os
+import pickle
 import sys
+import tempfile
 
 from user_sync.error import AssertionException
 
@@ -50,28 +58,42 @@ def normal_group(group):
 
 class CSVAdapter:
     """
-    Read and write CSV files to and from lists of dictionaries
+    Read and write CSV files to and from lists of dictionaries (and read JSON-lines and Parquet files)
     """
+    # files are read and written in big chunks
+    buffer_size = 1024 * 1024
+
     @staticmethod
     def open_csv_file(name, mode, encoding=None):
         """
+        Files whose name ends in .gz are read and written with gzip compression.
         :type name: str
         :type mode: str
         :type encoding: str, but ignored in py2
         :rtype file
         """
+        gzipped = CSVAdapter.is_gzip_file(str(name))
         try:
             if mode == 'r':
                 if is_py2():
-                    return open(str(name), 'rb', buffering=1)
+                    if gzipped:
+                        return gzip.open(str(name), 'rb')
+                    return open(str(name), 'rb', buffering=CSVAdapter.buffer_size)
                 else:
-                    kwargs = dict(buffering=1, newline='', encoding=encoding)
+                    if gzipped:
+                        return gzip.open(str(name), 'rt', newline='', encoding=encoding)
+                    kwargs = dict(buffering=CSVAdapter.buffer_size, newline='', encoding=encoding)
                     return open(str(name), 'r', **kwargs)
             elif mode == 'w':
                 if is_py2():
-                    return open(str(name), 'wb')
+                    if gzipped:
+                        return gzip.open(str(name), 'wb')
+                    return open(str(name), 'wb', CSVAdapter.buffer_size)
                 else:
-                    kwargs = dict(newline='')
+                    if gzipped:
+                        compressed_file = io.BufferedWriter(gzip.GzipFile(str(name), 'wb'), CSVAdapter.buffer_size)
+                        return io.TextIOWrapper(compressed_file, encoding=encoding, newline='')
+                    kwargs = dict(buffering=CSVAdapter.buffer_size, newline='')
                     return open(str(name), 'w', **kwargs)
             else:
                 raise ValueError("File mode (%s) must be 'r' or 'w'" % mode)
@@ -79,13 +101,31 @@ class CSVAdapter:
             raise AssertionException("Can't open file '%s': %s" % (name, e))
 
     @staticmethod
-    def guess_delimiter_from_filename(filename):
+    def is_gzip_file(filename):
+        """
+        :type filename
+        :rtype bool
+        """
+        return normalize_string(os.path.splitext(filename)[1]) == '.gz'
+
+    @classmethod
+    def get_file_extension(cls, filename):
+        """
+        Get the normalized extension of a file, ignoring any .gz extension
+        :type filename
+        :rtype str
+        """
+        if cls.is_gzip_file(filename):
+            filename = os.path.splitext(filename)[0]
+        return normalize_string(os.path.splitext(filename)[1])
+
+    @classmethod
+    def guess_delimiter_from_filename(cls, filename):
         """
         :type filename
         :rtype str
         """
-        _base_name, extension = os.path.splitext(filename)
-        normalized_extension = normalize_string(extension)
+        normalized_extension = cls.get_file_extension(filename)
         if normalized_extension == '.csv':
             return ','
         if normalized_extension == '.tsv':
@@ -93,13 +133,133 @@ class CSVAdapter:
         return '\t'
 
     @classmethod
-    def read_csv_rows(cls, file_path, recognized_column_names=None, logger=None, encoding='utf8', delimiter=None):
+    def guess_format_from_filename(cls, filename):
+        """
+        :type filename
+        :rtype str: one of 'csv', 'jsonl' or 'parquet'
+        """
+        normalized_extension = cls.get_file_extension(filename)
+        if normalized_extension in ('.jsonl', '.ndjson'):
+            return 'jsonl'
+        if normalized_extension == '.parquet':
+            return 'parquet'
+        return 'csv'
+
+    @classmethod
+    def read_rows(cls, file_path, recognized_column_names=None, logger=None, encoding='utf8', delimiter=None,
+                  only_recognized_columns=False, memory_map=False):
         """
+        Read the rows of a CSV, JSON-lines or Parquet file, depending on its extension.  The rows of JSON-lines
+        and Parquet files only ever hold the recognized columns, with their values as they would be in a CSV file.
+        See read_csv_rows for the parameters, of which JSON-lines and Parquet files only use the first four.
+        :rtype iterator(dict)
+        """
+        file_format = cls.guess_format_from_filename(file_path)
+        if file_format == 'jsonl':
+            return cls.read_jsonl_rows(file_path, recognized_column_names, logger, encoding)
+        if file_format == 'parquet':
+            return cls.read_parquet_rows(file_path, recognized_column_names, logger)
+        return cls.read_csv_rows(file_path, recognized_column_names, logger, encoding, delimiter,
+                                 only_recognized_columns, memory_map)
+
+    @classmethod
+    def read_jsonl_rows(cls, file_path, recognized_column_names=None, logger=None, encoding='utf8'):
+        """
+        Read a file with one JSON object per line.  Unrecognized column names are only reported for the first row.
+        :type file_path: str
+        :type recognized_column_names: list(str)
+        :type logger: logging.Logger
+        :type encoding: str
+        :rtype iterator(dict)
+        """
+        with cls.open_csv_file(file_path, 'r', encoding) as input_file:
+            column_names = None if recognized_column_names is None else set(recognized_column_names)
+            line_read = 0
+            try:
+                for line in input_file:
+                    line_read += 1
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError as e:
+                        raise AssertionException("Invalid JSON at line %d of file '%s': %s" % (line_read, file_path, e))
+                    if not isinstance(record, dict):
+                        raise AssertionException("Line %d of file '%s' is not a JSON object" % (line_read, file_path))
+                    if column_names is None:
+                        yield {name: cls.to_column_value(value) for name, value in record.items()}
+                        continue
+                    if line_read == 1 and logger is not None:
+                        unrecognized_column_names = [name for name in record if name not in column_names]
+                        if unrecognized_column_names:
+                            logger.warn("In file '%s': unrecognized column names: %s", file_path,
+                                        unrecognized_column_names)
+                    yield {name: cls.to_column_value(record[name]) for name in recognized_column_names
+                           if name in record}
+            except UnicodeError as e:
+                raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
+
+    @classmethod
+    def read_parquet_rows(cls, file_path, recognized_column_names=None, logger=None, batch_size=65536):
+        """
+        Read a Parquet file (which needs the optional pyarrow package), a batch of rows at a time and only
+        reading the recognized columns
+        :type file_path: str
+        :type recognized_column_names: list(str)
+        :type logger: logging.Logger
+        :type batch_size: int
+        :rtype iterator(dict)
+        """
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise AssertionException("Reading Parquet file '%s' requires the pyarrow package" % file_path)
+        try:
+            parquet_file = pyarrow.parquet.ParquetFile(str(file_path))
+        except (IOError, pyarrow.ArrowException) as e:
+            raise AssertionException("Can't open file '%s': %s" % (file_path, e))
+        fieldnames = parquet_file.schema_arrow.names
+        columns = fieldnames
+        if recognized_column_names is not None:
+            unrecognized_column_names = [name for name in fieldnames if name not in recognized_column_names]
+            if len(unrecognized_column_names) > 0 and logger is not None:
+                logger.warn("In file '%s': unrecognized column names: %s", file_path, unrecognized_column_names)
+            columns = [name for name in fieldnames if name in recognized_column_names]
+        if not columns:
+            return
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            values = [batch.column(name).to_pylist() for name in columns]
+            for row_values in zip(*values):
+                yield {name: cls.to_column_value(value) for name, value in zip(columns, row_values)}
+
+    @staticmethod
+    def to_column_value(value):
+        """
+        Convert a value read from a JSON-lines or Parquet file to the string it would be in a CSV column
+        (with lists as comma-separated values)
+        :rtype str or None
+        """
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, (list, tuple)):
+            return ','.join(str(item) for item in value)
+        return str(value)
+
+    @classmethod
+    def read_csv_rows(cls, file_path, recognized_column_names=None, logger=None, encoding='utf8', delimiter=None,
+                      only_recognized_columns=False, memory_map=False):
+        """
+        With only_recognized_columns, each row holds just the recognized columns that are in the file.  The rows
+        are then read with a plain csv.reader and an index of those columns, which is much faster than building
+        a dictionary of every column.  With memory_map, the file is read through a memory map
+        (unless it is compressed).
         :type file_path: str
         :type recognized_column_names: list(str)
         :type logger: logging.Logger
         :type encoding: str
         :type delimiter: str
+        :type only_recognized_columns: bool
+        :type memory_map: bool
         """
         if is_py2():
             # in py2, we need to encode the column names, because the file is read as bytes
@@ -107,17 +267,28 @@ class CSVAdapter:
             for name in recognized_column_names:
                 encoded_names.append(name.encode(encoding, 'strict'))
             recognized_column_names = encoded_names
-        with cls.open_csv_file(file_path, 'r', encoding) as input_file:
+        if memory_map and not cls.is_gzip_file(str(file_path)):
+            input_context = cls.open_mapped_csv_file(file_path, encoding)
+        else:
+            input_context = cls.open_csv_file(file_path, 'r', encoding)
+        with input_context as input_file:
             if delimiter is None:
                 delimiter = cls.guess_delimiter_from_filename(file_path)
             try:
-                reader = csv.DictReader(input_file, delimiter=delimiter)
+                by_column = only_recognized_columns and recognized_column_names is not None
+                if by_column:
+                    reader = csv.reader(input_file, delimiter=delimiter)
+                    fieldnames = next(reader, [])
+                else:
+                    reader = csv.DictReader(input_file, delimiter=delimiter)
+                    fieldnames = reader.fieldnames
                 if recognized_column_names is not None:
-                    unrecognized_column_names = [column_name for column_name in reader.fieldnames
+                    unrecognized_column_names = [column_name for column_name in fieldnames
                                                  if column_name not in recognized_column_names]
                     if len(unrecognized_column_names) > 0 and logger is not None:
                         logger.warn("In file '%s': unrecognized column names: %s", file_path, unrecognized_column_names)
-                for row in reader:
+                rows = cls.iter_column_rows(reader, fieldnames, recognized_column_names) if by_column else reader
+                for row in rows:
                     row.pop(None, None)
                     if is_py2():
                         newrow = {}
@@ -129,33 +300,103 @@ class CSVAdapter:
             except UnicodeError as e:
                 raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
 
+    @staticmethod
+    def iter_column_rows(reader, fieldnames, column_names):
+        """
+        Turn the rows of a csv.reader into dictionaries of the given columns.  As with csv.DictReader, blank
+        lines are skipped, the last of several columns with the same name wins, and missing values are None.
+        :type reader: csv.reader
+        :type fieldnames: list(str)
+        :type column_names: list(str)
+        :rtype iterator(dict)
+        """
+        column_indexes = {name: index for index, name in enumerate(fieldnames) if name in column_names}
+        columns = list(column_indexes.items())
+        width = max(column_indexes.values()) + 1 if column_indexes else 0
+        for values in reader:
+            if not values:
+                continue
+            if len(values) >= width:
+                yield {name: values[index] for name, index in columns}
+            else:
+                count = len(values)
+                yield {name: values[index] if index < count else None for name, index in columns}
+
+    @staticmethod
+    @contextlib.contextmanager
+    def open_mapped_csv_file(name, encoding=None):
+        """
+        Open a file for reading through a memory map, as a text stream (in py2, an iterator over its lines)
+        :type name: str
+        :type encoding: str, but ignored in py2
+        :rtype io.TextIOWrapper
+        """
+        try:
+            input_file = open(str(name), 'rb')
+        except IOError as e:
+            raise AssertionException("Can't open file '%s': %s" % (name, e))
+        with input_file:
+            try:
+                mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file can't be mapped
+                yield iter(())
+                return
+            try:
+                if is_py2():
+                    yield iter(mapped.readline, b'')
+                else:
+                    buffered = io.BufferedReader(MappedFileReader(mapped), CSVAdapter.buffer_size)
+                    yield io.TextIOWrapper(buffered, encoding=encoding, newline='')
+            finally:
+                mapped.close()
+
     @classmethod
     def write_csv_rows(cls, file_path, field_names, rows, encoding='utf8', delimiter=None):
         """
+        Write the rows as they are produced, so they can come from a generator.  Fields missing from a row
+        are written empty, and a row with a field not in field_names raises a ValueError.
         :type file_path: str
         :type field_names: list(str)
-        :type rows: list(dict)
+        :type rows: iterable(dict)
         :type encoding: str
         :type delimiter: str
         """
         with cls.open_csv_file(file_path, 'w', encoding=encoding) as output_file:
             if delimiter is None:
                 delimiter = cls.guess_delimiter_from_filename(file_path)
-            writer = csv.DictWriter(output_file, fieldnames=field_names, delimiter=delimiter)
+            writer = csv.DictWriter(output_file, fieldnames=field_names, delimiter=delimiter, extrasaction='raise')
             if is_py2():
                 # in py2, we need to encode the field names in the header, because the file is written as bytes
                 header_row = {}
                 for name in field_names:
                     header_row[name] = name.encode(encoding, 'strict')
                 writer.writerow(header_row)
+                # in py2, we have to encode the field values, because the file is written as bytes
+                rows = ({name: val.encode(encoding, 'strict') for name, val in row.items()} for row in rows)
             else:
                 writer.writeheader()
-            for row in rows:
-                if is_py2():
-                    # in py2, we have to encode the field values, because the file is written as bytes
-                    for name, val in row.items():
-                        row[name] = val.encode(encoding, 'strict')
-                writer.writerow(row)
+            writer.writerows(rows)
+
+
+class MappedFileReader(io.RawIOBase):
+    """
+    A raw binary stream over a memory map, so that it can be read through the io module's buffers and decoders
+    """
+    def __init__(self, mapped):
+        """
+        :type mapped: mmap.mmap
+        """
+        super(MappedFileReader, self).__init__()
+        self.mapped = mapped
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.mapped.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
 
 
 class JobStats:
@@ -191,3 +432,57 @@ class JobStats:
         header = " End %s (Total time: %s) " % (self.name, rounded_time)
         line = self.create_divider(header)
         logger.info(line)
+
+
+class ExternalSorter:
+    """
+    Sort a stream of items by key without holding the whole stream in memory.
+    Items are collected into runs of at most run_size items; when the stream doesn't fit
+    in one run, each run is sorted and spilled to a temporary file, and the runs are then
+    merged back in key order as the result is iterated.
+    """
+    def __init__(self, key, run_size=100000, temp_dir=None):
+        """
+        :param key: function returning the sort key of an item
+        :param run_size: maximum number of items held in memory at once
+        :param temp_dir: directory for the spill files (system default if None)
+        """
+        self.key = key
+        self.run_size = run_size
+        self.temp_dir = temp_dir
+
+    def sort(self, items):
+        """
+        Consume all the items and return an iterator over them in key order.
+        Items must be picklable if the stream is larger than a single run.
+        :type items: iterable
+        :rtype: iterator
+        """
+        run_files = []
+        run = []
+        for item in items:
+            run.append(item)
+            if len(run) >= self.run_size:
+                run_files.append(self.spill(run))
+                run = []
+        run.sort(key=self.key)
+        if not run_files:
+            return iter(run)
+        return heapq.merge(*[self.read_run(f) for f in run_files], iter(run), key=self.key)
+
+    def spill(self, run):
+        run.sort(key=self.key)
+        run_file = tempfile.TemporaryFile(dir=self.temp_dir)
+        for item in run:
+            pickle.dump(item, run_file, pickle.HIGHEST_PROTOCOL)
+        run_file.seek(0)
+        return run_file
+
+    @staticmethod
+    def read_run(run_file):
+        with run_file:
+            while True:
+                try:
+                    yield pickle.load(run_file)
+                except EOFError:
+                    return